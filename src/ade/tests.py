@@ -1,3 +1,121 @@
-from django.test import TestCase
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+
+from ade import views
+from core import brownout, hedging, metrics, rules
+
+
+class ToolSelectionTests(SimpleTestCase):
+    def game(self, turns, hp=20):
+        game = views.GameManager({})
+        game.initialize_new_game()
+        game.hp = hp
+        game.messages += [{"role": "user", "content": f"azione {index}"} for index in range(turns)]
+        return game
+
+    def names(self, tools):
+        return [tool["function"]["name"] for tool in tools]
+
+    def test_class_tool_only_every_few_turns(self):
+        self.assertIn("change_player_class", self.names(views.select_tools(self.game(views.CLASS_TOOL_EVERY))))
+        self.assertNotIn("change_player_class", self.names(views.select_tools(self.game(1))))
+
+    def test_small_tools_are_always_offered(self):
+        # Il sottoinsieme non cambia con gli HP: il prefisso in cache resta valido
+        self.assertEqual(views.select_tools(self.game(1, hp=20)), views.select_tools(self.game(1, hp=5)))
+        self.assertIn("heal_damage", self.names(views.select_tools(self.game(1))))
+
+    def test_cached_tokens_recorded_per_subset(self):
+        usage = SimpleNamespace(prompt_tokens=1000, prompt_tokens_details=SimpleNamespace(cached_tokens=800))
+        before = metrics.snapshot()["counters"].get(f"tools.cached_tokens.{views.GAME_ID}.tutti", 0)
+        views.record_tools_cache(views.GAME_TOOLS, usage)
+        after = metrics.snapshot()["counters"][f"tools.cached_tokens.{views.GAME_ID}.tutti"]
+        self.assertEqual(after - before, 800)
+
+
+class LocalTurnTests(SimpleTestCase):
+    def test_local_turns_are_not_counted_as_played(self):
+        game = views.GameManager({})
+        game.initialize_new_game()
+        before = views.player_turns(game)
+        list(rules.local_turn(game, "inventario", *rules.resolve(game, "inventario")))
+        self.assertEqual(views.player_turns(game), before)
+        game.messages.append({"role": "user", "content": "apro la porta"})
+        self.assertEqual(views.player_turns(game), before + 1)
+
+
+class Notices(list):
+    def add(self, level, message, extra_tags=""):
+        self.append(message)
+
+
+def delta(content=None, tool_calls=None):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content, tool_calls=tool_calls))])
+
+
+class FakeCompletion:
+    """Risposta in streaming già pronta, come quella restituita da `hedging.astream_chat_completion`."""
+
+    def __init__(self, *chunks):
+        self.model = views.MODEL
+        self.chunks = chunks
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+    async def close(self):
+        pass
+
+
+DAMAGE_CALL = SimpleNamespace(
+    index=0, id="call_1", function=SimpleNamespace(name="take_damage", arguments='{"amount": 3, "reason": "morso"}'),
+)
+
+
+@override_settings(LLM_GAMES={**settings.LLM_GAMES, views.GAME_ID: {"single_round_trip": True}})
+class SecondCallTests(SimpleTestCase):
+    def setUp(self):
+        self.game = views.GameManager({})
+        self.game.initialize_new_game()
+        self.request = SimpleNamespace(_messages=Notices())
+        self.calls = []
+        load = mock.patch.object(brownout, "skip_optional", lambda call: False)
+        load.start()
+        self.addCleanup(load.stop)
+
+    def counter(self, outcome):
+        return metrics.snapshot()["counters"].get(f"tools.second_call.{outcome}.{views.GAME_ID}", 0)
+
+    async def play(self, *completions):
+        completions = iter(completions)
+
+        async def fake_stream(game_id, model, messages, **kwargs):
+            self.calls.append(kwargs["tool_choice"])
+            return next(completions)
+
+        with mock.patch.object(hedging, "astream_chat_completion", fake_stream):
+            return [event async for event in views.play_ai_turn(self.request, self.game, "affronto il lupo")]
+
+    async def test_narration_with_tool_calls_skips_the_second_call(self):
+        narration = "Il lupo balza fuori dal cespuglio e ti azzanna il braccio prima che tu riesca a scansarti. " * 2
+        avoided = self.counter("avoided")
+        events = await self.play(FakeCompletion(delta(narration), delta(tool_calls=[DAMAGE_CALL])))
+        self.assertEqual(self.calls, ["auto"])
+        self.assertEqual(self.counter("avoided"), avoided + 1)
+        self.assertEqual("".join(data["text"] for name, data in events if name == "token"), narration)
+        self.assertEqual(self.game.hp, self.game.max_hp - 3)
+
+    async def test_short_narration_still_gets_the_second_call(self):
+        made = self.counter("made")
+        events = await self.play(
+            FakeCompletion(delta("Ahi!"), delta(tool_calls=[DAMAGE_CALL])),
+            FakeCompletion(delta("Il lupo ti morde e fugge nel bosco.")),
+        )
+        self.assertEqual(self.calls, ["auto", "none"])
+        self.assertEqual(self.counter("made"), made + 1)
+        self.assertEqual(self.game.messages[-1], {"role": "assistant", "content": "Il lupo ti morde e fugge nel bosco."})
+        self.assertEqual([name for name, _ in events].count("message"), 2)
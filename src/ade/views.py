@@ -22,21 +22,29 @@ import logging
 import os
 import random
 import re
+import time
 from datetime import datetime
 
-from openai import OpenAI
-from decouple import config
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib import messages as flash
 from django.http import JsonResponse
+from django.views.decorators.http import require_POST
 from django.shortcuts import redirect, render
-from django.urls import reverse
+from django.urls import NoReverseMatch, reverse
+
+from core import admission, brownout, hedging, history, idempotency, llm, memory, metrics, openings, resilience, routing, rules, tokens, toolargs
+from core.context import build_prompt
+from core.gamestate import VersionedState, asnapshot_due, clear_saved, replace_saved
+from core.ratelimit import rate_limited
+from core.state import aload_request_state
+from core.streaming import StreamedReply, drain, notice_events, sse_response
 
 # --- CONFIGURAZIONE E COSTANTI ---
 
-# Caricamento delle configurazioni dall'esterno
-API_KEY = config("API_KEY")
-API_URL = "https://openrouter.ai/api/v1/"
+# Modello usato dal gioco (impostazioni di connessione in config/settings.py)
 MODEL = "anthropic/claude-3-sonnet"
+GAME_ID = "ade"  # Chiave del gioco nelle impostazioni condivise (es. LLM_OPENINGS)
 
 # Classi del personaggio che cambiano a seconda delle azioni di gioco
 ARCHETYPES = {
@@ -105,8 +113,23 @@ SKILL_MAP = {
 LOG_DIR = "ade/saves"
 STARTING_HP = 20
 MAX_SAVE_FILES = 10  # Limite massimo di file di salvataggio per utente
+# Sotto questa lunghezza il testo che accompagna le chiamate agli strumenti non è
+# considerato una narrazione e serve la seconda chiamata
+MIN_NARRATION_CHARS = 80
+# Lo strumento per il cambio di classe viene offerto solo ogni N turni del giocatore
+CLASS_TOOL_EVERY = 5
 INITIAL_STATS = {"carisma": 2, "prontezza": 1, "cervello": 3, "fegato": 1}
 
+# Oggetti consumabili: parola chiave nel nome dell'oggetto -> effetto (risolti senza l'AI)
+CONSUMABLES = {
+    "pane": {"heal": 3, "message": "🍞 Hai mangiato {item}: +{healed} HP. HP attuali: {hp}/{max_hp}"},
+    "erbe": {"heal": 5, "message": "🌿 Hai masticato {item}: +{healed} HP. HP attuali: {hp}/{max_hp}"},
+    "benda": {"heal": 4, "message": "🩹 Hai usato {item}: +{healed} HP. HP attuali: {hp}/{max_hp}"},
+    "unguento": {"heal": 6, "message": "🫙 Hai applicato {item}: +{healed} HP. HP attuali: {hp}/{max_hp}"},
+    "pozione": {"heal": 10, "message": "🧪 Hai bevuto {item}: +{healed} HP. HP attuali: {hp}/{max_hp}"},
+    "elisir": {"heal": 15, "message": "⚗️ Hai bevuto {item}: +{healed} HP. HP attuali: {hp}/{max_hp}"},
+}
+
 # Costanti per le chiavi di sessione (evita "stringhe magiche")
 SESSION_MESSAGES = "ade_messages"
 SESSION_HP = "hp"
@@ -118,6 +141,9 @@ SESSION_CURRENT_OBJECTIVE = "objective"
 SESSION_MAX_HP = 'max_hp'
 HP_PER_LEVEL = 10
 SESSION_PLAYER_CLASS = "player_class"
+SESSION_SUMMARY = "ade_summary"
+SESSION_SUMMARY_UPTO = "ade_summary_upto"
+SESSION_VERSION = "ade_version"  # versione dello stato, per il salvataggio con compare-and-swap
 
 # LISTA DEI TOOL PER INTERAGIRE CON L'AI
 GAME_TOOLS = [
@@ -214,6 +240,9 @@ GAME_TOOLS = [
     }
 ]
 
+# Schema degli argomenti di ogni strumento, per riparare e validare le chiamate dell'AI
+TOOL_PARAMETERS = {tool["function"]["name"]: tool["function"]["parameters"] for tool in GAME_TOOLS}
+
 # System prompt per l'AI, separato dalla logica della vista
 SYSTEM_PROMPT = (
     "Agisci come un Dungeon Master AI, un narratore sobrio e spietato. L'ambientazione è il Dominio Cinereo, il regno dei morti. Non è un luogo di punizione, ma una metropoli infinita di echi e memorie dove le anime dei defunti continuano le loro eterne esistenze."
@@ -233,12 +262,12 @@ SYSTEM_PROMPT = (
     "  * heal_damage: quando il giocatore si cura, riposa o riceve assistenza"
     "  * add_to_inventory: quando il giocatore trova, riceve o ottiene oggetti"
     "  * set_new_objective: quando il giocatore completa un obiettivo importante"
-    "  * change_player_class: quando il comportamento del giocatore cambia significativamente"
+    "  * change_player_class: quando il comportamento del giocatore cambia significativamente (solo nei turni in cui lo strumento è disponibile)"
     "- Non limitarti a descrivere le conseguenze: APPLICA le conseguenze usando gli strumenti"
     "- Ogni situazione pericolosa dovrebbe avere conseguenze reali (danno, perdita di oggetti, etc.)"
     "- Ricompensa l'esplorazione e la risoluzione dei problemi con oggetti utili"
 
-    "ANALISI DELLO STILE DI GIOCO: Monitora le azioni del giocatore e usa change_player_class quando appropriato:"
+    "ANALISI DELLO STILE DI GIOCO: Monitora le azioni del giocatore; nei turni in cui change_player_class è disponibile, usalo se la classe non rispecchia più il suo stile:"
     "- Inquisitore: interroga, collega indizi, scopre segreti"
     "- Centurione: affronta pericoli direttamente, usa la forza"
     "- Spettro: agisce nell'ombra, usa astuzia e sorpresa"
@@ -311,6 +340,9 @@ def save_game_to_file(request, game_data):
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     file_path = _get_save_path(username, timestamp)
 
+    # Il file contiene la cronologia completa, anche se la partita ne ha caricata solo una finestra
+    game_data = {**game_data, "messages": history.full_history(game_data["messages"])}
+
     try:
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
         with open(file_path, "w", encoding="utf-8") as f:
@@ -333,11 +365,28 @@ def load_game_from_file(filename):
 
 # --- LIVELLO DI LOGICA DI BUSINESS (Game Logic Layer) ---
 
-class GameManager:
+class GameManager(VersionedState):
     """
     Gestisce lo stato e la logica del gioco per una sessione utente.
     Incapsula HP, inventario, statistiche, progressione e interazioni.
     """
+    GAME_ID = GAME_ID
+    STATE_KEYS = {
+        "hp": SESSION_HP,
+        "max_hp": SESSION_MAX_HP,
+        "inventory": SESSION_INVENTORY,
+        "stats": SESSION_STATS,
+        "level": SESSION_LEVEL,
+        "objectives_completed": SESSION_OBJECTIVES_COMPLETED,
+        "current_objective": SESSION_CURRENT_OBJECTIVE,
+        "player_class": SESSION_PLAYER_CLASS,
+        "messages": SESSION_MESSAGES,
+        "summary": SESSION_SUMMARY,
+        "summary_upto": SESSION_SUMMARY_UPTO,
+    }
+    VERSION_KEY = SESSION_VERSION
+    MERGE_RULES = {"hp": "add", "inventory": "multiset", "stats": "counters", "messages": "append"}
+
     def __init__(self, session):
         self.session = session
         self.hp = session.get(SESSION_HP)
@@ -353,6 +402,9 @@ class GameManager:
         self.messages = session.get(SESSION_MESSAGES, [])
         self.max_hp = session.get(SESSION_MAX_HP)
         self.player_class = session.get(SESSION_PLAYER_CLASS, "Inquisitore")
+        self.summary = session.get(SESSION_SUMMARY, "")
+        self.summary_upto = session.get(SESSION_SUMMARY_UPTO, 0)
+        self.track_version()
 
     def is_initialized(self):
         """Controlla se la sessione di gioco è già stata inizializzata."""
@@ -370,24 +422,14 @@ class GameManager:
         self.max_hp = STARTING_HP
         self.hp = self.max_hp
         self.player_class = "Inquisitore"
+        self.summary = ""
+        self.summary_upto = 0
         
         # Aggiunge le informazioni iniziali come primo messaggio
         stato_hp = f"[INFO] Il personaggio ha attualmente {self.hp} / {self.max_hp} punti ferita."
         stato_inventario = f"[INFO] Il personaggio non possiede oggetti."
         self.messages.append({"role": "user", "content": f"{stato_hp} {stato_inventario}"})
 
-    def save_state_to_session(self):
-        """Salva lo stato corrente del gioco nella sessione Django."""
-        self.session[SESSION_HP] = self.hp
-        self.session[SESSION_INVENTORY] = self.inventory
-        self.session[SESSION_STATS] = self.stats
-        self.session[SESSION_LEVEL] = self.level
-        self.session[SESSION_OBJECTIVES_COMPLETED] = self.objectives_completed
-        self.session[SESSION_CURRENT_OBJECTIVE] = self.current_objective
-        self.session[SESSION_MESSAGES] = self.messages
-        self.session[SESSION_MAX_HP] = self.max_hp
-        self.session[SESSION_PLAYER_CLASS] = self.player_class
-
     def get_state_for_savefile(self):
         """Restituisce un dizionario con i dati da salvare su file."""
         return {
@@ -400,8 +442,23 @@ class GameManager:
             "objectives_completed": self.objectives_completed,
             "max_hp": self.max_hp,
             "player_class": self.player_class,
+            "summary": self.summary,
+            "summary_upto": self.summary_upto,
         }
     
+    def get_public_state(self):
+        """Restituisce lo stato mostrato nella sidebar, usato per gli aggiornamenti in streaming."""
+        return {
+            "hp": self.hp,
+            "max_hp": self.max_hp,
+            "inventario": self.inventory,
+            "objective": self.current_objective,
+            "level": self.level,
+            "stats": self.stats,
+            "game_over": self.hp <= 0,
+            "player_class": self.player_class,
+        }
+
     def change_class(self, new_class_name):
         """Cambia la classe del giocatore e applica i bonus associati."""
         new_class_name = new_class_name.capitalize()
@@ -508,6 +565,10 @@ class GameManager:
             )
         return None
 
+    def use_item(self, item_name):
+        """Usa un consumabile dell'inventario (vedi CONSUMABLES). None se l'oggetto non si può usare."""
+        return rules.use_consumable(self, item_name, CONSUMABLES)
+
         # TIRO DEL DADO
     def process_dice_roll(self, user_input):
         """Gestisce un tiro di dado e lo formatta."""
@@ -546,114 +607,283 @@ class GameManager:
         return roll_result
 
 
+# --- LIVELLO DI SERVIZIO (Service Layer) ---
+
+def single_round_trip():
+    """Vero se la narrazione deve arrivare insieme alle chiamate agli strumenti (una sola chiamata)."""
+    return settings.LLM_GAMES.get(GAME_ID, {}).get("single_round_trip", False)
+
+
+def player_turns(game):
+    """
+    Numero di turni giocati: messaggi del giocatore, esclusi quelli locali e le note di gioco.
+    Per le partite salvate nel database si contano i messaggi della finestra caricata.
+    """
+    return sum(
+        1 for msg in game.messages
+        if msg.get("role") == "user" and not msg.get("local") and not msg["content"].startswith("[")
+    )
+
+
+def select_tools(game):
+    """
+    Sceglie gli strumenti da offrire all'AI in questo turno. L'ordine resta quello di
+    `GAME_TOOLS`: a parità di sottoinsieme il prefisso del prompt è identico e resta
+    in cache. Gli strumenti precedono il system prompt nella chiave della cache,
+    quindi ogni cambio di sottoinsieme la invalida: si esclude solo lo strumento
+    più grande, e gli strumenti piccoli restano sempre (vedi `record_tools_cache`).
+    """
+    excluded = set()
+    if player_turns(game) % CLASS_TOOL_EVERY:
+        excluded.add("change_player_class")
+    tools = [tool for tool in GAME_TOOLS if tool["function"]["name"] not in excluded]
+
+    saved = tokens.tools_tokens(GAME_TOOLS) - tokens.tools_tokens(tools)
+    metrics.observe(f"tools.tokens_saved.{GAME_ID}", saved)
+    metrics.incr(f"tools.tokens_saved_total.{GAME_ID}", saved)
+    logger.debug(f"Strumenti offerti: {len(tools)}/{len(GAME_TOOLS)}, {saved} token risparmiati")
+    return tools
+
+
+def record_tools_cache(tools, usage):
+    """
+    Token del prompt e token letti dalla cache del provider, per sottoinsieme di
+    strumenti offerto: il rapporto tra i due dice se i token risparmiati da
+    `select_tools` compensano il prefisso in cache perso a ogni cambio di sottoinsieme.
+    """
+    if usage is None:
+        return
+    offered = {tool["function"]["name"] for tool in tools}
+    missing = [tool["function"]["name"] for tool in GAME_TOOLS if tool["function"]["name"] not in offered]
+    subset = "senza_" + "_".join(missing) if missing else "tutti"
+    metrics.incr(f"tools.prompt_tokens.{GAME_ID}.{subset}", usage.prompt_tokens or 0)
+    metrics.incr(f"tools.cached_tokens.{GAME_ID}.{subset}", llm.cached_tokens(usage))
+
+
+def build_messages_for_ai(game, tools, model=MODEL):
+    """
+    Prepara i messaggi per la prima chiamata, aggiungendo in coda il contesto della partita.
+    I turni vecchi sono sostituiti dal riassunto "STORIA FINORA" e il prompt (strumenti
+    compresi) viene adattato al budget di token del modello.
+    """
+    context_message = (
+        f"[CONTESTO PARTITA] Il giocatore è di livello {game.level}. "
+        f"Ha {game.hp}/{game.max_hp} HP. "
+        f"Inventario: {', '.join(game.inventory) or 'vuoto'}. "
+        f"Obiettivo attuale: {game.current_objective}. "
+        f"Crea una sfida appropriata per il suo livello."
+    )
+    if single_round_trip():
+        # In coda e non nel system prompt, per non invalidare il prefisso in cache
+        context_message += (
+            " Quando usi gli strumenti, scrivi comunque nello stesso messaggio la narrazione "
+            "completa del turno, come se i loro effetti fossero già avvenuti."
+        )
+    return build_prompt(game, model, tail=[{"role": "user", "content": context_message}], tools=tools)
+
+
+async def play_turn(request, game, user_input):
+    """
+    Esegue un turno con il Tool Calling e produce gli eventi `(nome, dati)` per il client.
+    Il testo del DM viene inoltrato man mano che arriva, sia dalla prima chiamata
+    sia dalla seconda (quella narrativa dopo l'esecuzione degli strumenti).
+    Con `single_round_trip` la seconda chiamata si fa solo se la prima non contiene
+    già la narrazione: gli effetti degli strumenti vengono comunque applicati in locale.
+    """
+    # Comandi deterministici (inventario, HP, aiuto...) e partita finita: risposta locale, niente AI
+    resolved = rules.resolve(game, user_input)
+    if resolved is not None:
+        for event in rules.local_turn(game, user_input, *resolved):
+            yield event
+        return
+
+    # Turno con l'AI: prima serve un posto tra quelli del worker (coda equa per giocatore)
+    async for event in admission.admitted(request, play_ai_turn(request, game, user_input)):
+        yield event
+
+
+async def play_ai_turn(request, game, user_input):
+    """Parte di `play_turn` che coinvolge l'AI, eseguita solo dopo l'ammissione."""
+    # Gestione tiro di dado
+    if "tiro" in user_input.lower():
+        user_input = game.process_dice_roll(user_input)
+
+    game.messages.append({"role": "user", "content": user_input})
+    yield "user", {"content": user_input}
+
+    # --- NUOVO FLUSSO CON TOOL CALLING ---
+    # I turni di routine vanno al modello economico, le scene chiave a quello premium
+    route = routing.route(GAME_ID, game, user_input, MODEL)
+    started = time.monotonic()
+    usages = []
+    # Un'unica scadenza per entrambe le chiamate del turno
+    deadline = resilience.Deadline()
+    try:
+        # 1. Prima chiamata all'AI per ottenere la risposta o le chiamate agli strumenti,
+        #    offrendo solo gli strumenti utili in questo turno
+        tools = select_tools(game)
+        reply = StreamedReply()
+        stream = await hedging.astream_chat_completion(
+            GAME_ID,
+            route.model,
+            build_messages_for_ai(game, tools, route.model),
+            extra_headers={"X-Title": "ADE RPG"},
+            deadline=deadline,
+            tools=tools,
+            tool_choice="auto",
+            temperature=0.7  # Aggiunge un po' di creatività
+        )
+        yield "message", {}
+        try:
+            async for chunk in stream:
+                text = reply.feed(chunk)
+                if text:
+                    yield "token", {"text": text}
+        finally:
+            # Anche se la lettura si interrompe: la richiesta va chiusa e tolta da quelle in corso
+            await stream.close()
+
+        llm.record_usage(stream.model, reply.usage)
+        record_tools_cache(tools, reply.usage)
+        usages.append((stream.model, reply.usage))
+        tool_calls = reply.tool_calls
+
+        # CORREZIONE CRITICA: Gestire correttamente il contenuto della risposta
+        # Aggiungi SEMPRE il messaggio dell'AI alla cronologia, anche se è vuoto
+        message_to_add = {
+            "role": "assistant",
+            "content": reply.content,
+        }
+
+        # Se ci sono tool_calls, aggiungili al messaggio
+        if tool_calls:
+            message_to_add["tool_calls"] = [tc.model_dump() for tc in tool_calls]
+
+        game.messages.append(message_to_add)
+
+        # 2. Gestione tool calls
+        if tool_calls:
+            success = process_tool_calls(tool_calls, game, request)
+
+            metrics.incr(f"tools.turns.{GAME_ID}")
+            narrated = single_round_trip() and len((reply.content or "").strip()) >= MIN_NARRATION_CHARS
+
+            if success and narrated:
+                # 3. La narrazione è già arrivata con gli strumenti: niente seconda chiamata
+                metrics.incr(f"tools.second_call.avoided.{GAME_ID}")
+            elif success and brownout.skip_optional("second_call"):
+                # 3. Sotto carico la seconda chiamata salta: basta il testo della prima, se c'è
+                if not reply.content:
+                    game.messages.append({"role": "assistant", "content": "Cosa fai?"})
+                    yield "token", {"text": "Cosa fai?"}
+            elif success:
+                # 3. Seconda chiamata all'AI per la risposta narrativa.
+                #    Gli stessi strumenti vengono rimandati (senza poterli usare) perché fanno
+                #    parte del prefisso in cache: toglierli lo invaliderebbe.
+                final_stream = await hedging.astream_chat_completion(
+                    GAME_ID,
+                    route.model,
+                    build_prompt(game, route.model, tools=tools),
+                    extra_headers={"X-Title": "ADE RPG"},
+                    deadline=deadline,
+                    tools=tools,
+                    tool_choice="none",
+                    temperature=0.7
+                )
+                metrics.incr(f"tools.second_call.made.{GAME_ID}")
+                final_reply = StreamedReply()
+                yield "message", {}
+                try:
+                    async for chunk in final_stream:
+                        text = final_reply.feed(chunk)
+                        if text:
+                            yield "token", {"text": text}
+                finally:
+                    await final_stream.close()
+                llm.record_usage(final_stream.model, final_reply.usage)
+                usages.append((final_stream.model, final_reply.usage))
+
+                if final_reply.content:  # Solo se c'è contenuto
+                    game.messages.append({"role": "assistant", "content": final_reply.content})
+                else:
+                    # Fallback se l'AI non risponde
+                    game.messages.append({"role": "assistant", "content": "Cosa fai?"})
+                    yield "token", {"text": "Cosa fai?"}
+            else:
+                # Errore nella gestione dei tool
+                flash.error(request, "Errore nella gestione delle azioni di gioco.")
+
+        elif not reply.content:
+            # Caso raro: nessun tool call e nessun contenuto
+            game.messages.append({"role": "assistant", "content": "Cosa fai?"})
+            yield "token", {"text": "Cosa fai?"}
+
+        routing.record(GAME_ID, route, time.monotonic() - started, usages)
+
+    except Exception as e:
+        logger.error(f"Errore nella chiamata all'AI: {e}")
+        flash.error(request, "Errore di comunicazione con l'AI. Riprova.")
+        game.messages.append({"role": "assistant", "content": "Si è verificato un errore. Cosa fai?"})
+        yield "message", {}
+        yield "token", {"text": "Si è verificato un errore. Cosa fai?"}
+
+
 # --- LIVELLO DI PRESENTAZIONE (View Layer) ---
 
-def chat_ade(request):
+@rate_limited(GAME_ID, "chat")
+async def chat_ade(request):
     """
     Vista principale della chat, ora potenziata con il Tool Calling.
+
+    È asincrona: durante l'attesa dell'AI il worker resta libero di servire altre richieste.
     """
-    game = GameManager(request.session)
+    await aload_request_state(request)
+    game = await GameManager.aload(request)
 
     if not game.is_initialized():
         game.initialize_new_game()
-        game.save_state_to_session()
+        # Se il pool ha una scena d'apertura pronta, la partita parte già narrata
+        opening = await openings.atake(GAME_ID)
+        if opening:
+            game.messages.append({"role": "assistant", "content": opening})
+        await game.asave(request)
         return redirect(reverse("ade:chat-ade")) # Ricarica per mostrare il primo messaggio
 
     if request.method == "POST":
+        turn = None
         # Gestione dell'uso di un oggetto
         if "use_item" in request.POST:
             item_to_use = request.POST.get("use_item")
             message = game.use_item(item_to_use)
             if message:
                 flash.add_message(request, flash.SUCCESS, message)
+                # L'AI deve sapere che l'oggetto è stato consumato
+                game.messages.append({"role": "user", "content": f"[INFO DI GIOCO] {message}"})
+            else:
+                flash.add_message(request, flash.WARNING, f"Non puoi usare '{item_to_use}' in questo modo.")
         
         # Gestione dell'input dell'utente
         if "user_input" in request.POST:
             user_input = request.POST.get("user_input", "").strip()
             if not user_input:                                 # Questo blocco serve per evitare problemi qualora l'utente inviasse un messaggio vuoto.
                 return redirect(reverse("ade:chat-ade")) # Questo controllo trasforma il messaggio vuoto in una stringa vuota "" e ricarica la opagina, interrompendo il codice ed evitando di chiamare l'API inutilmente
-                # Gestione tiro di dado
-            if "tiro" in user_input.lower():
-                user_input = game.process_dice_roll(user_input)
-
-            game.messages.append({"role": "user", "content": user_input})
-                
-            # --- NUOVO FLUSSO CON TOOL CALLING ---
-
-            # 1. Prepara i messaggi e il contesto
-            messages_for_ai = list(game.messages)
-            context_message = (
-                f"[CONTESTO PARTITA] Il giocatore è di livello {game.level}. "
-                f"Ha {game.hp}/{game.max_hp} HP. "
-                f"Inventario: {', '.join(game.inventory) or 'vuoto'}. "
-                f"Obiettivo attuale: {game.current_objective}. "
-                f"Crea una sfida appropriata per il suo livello."
-            )
-            messages_for_ai.append({"role": "user", "content": context_message})
-
-            # 2. Prima chiamata all'AI per ottenere la risposta o le chiamate agli strumenti
-            client = OpenAI(base_url=API_URL, api_key=API_KEY)
-            
-            try:
-                response = client.chat.completions.create(
-                    model=MODEL,
-                    messages=messages_for_ai,
-                    tools=GAME_TOOLS,
-                    tool_choice="auto",
-                    temperature=0.7  # Aggiunge un po' di creatività
-                )
-                
-                response_message = response.choices[0].message
-                
-                # CORREZIONE CRITICA: Gestire correttamente il contenuto della risposta
-                # Aggiungi SEMPRE il messaggio dell'AI alla cronologia, anche se è vuoto
-                message_to_add = {
-                    "role": "assistant",
-                    "content": response_message.content or "",  # Gestisce il caso None
-                }
-                
-                # Se ci sono tool_calls, aggiungili al messaggio
-                if response_message.tool_calls:
-                    message_to_add["tool_calls"] = [tc.model_dump() for tc in response_message.tool_calls]
-                
-                game.messages.append(message_to_add)
-
-                # 3. Gestione tool calls
-                if response_message.tool_calls:
-                    success = process_tool_calls(response_message.tool_calls, game, request)
-                    
-                    if success:
-                        # 4. Seconda chiamata all'AI per la risposta narrativa
-                        final_response = client.chat.completions.create(
-                            model=MODEL,
-                            messages=game.messages,
-                            temperature=0.7
-                        )
-                        final_reply = final_response.choices[0].message.content
-                        
-                        if final_reply:  # Solo se c'è contenuto
-                            game.messages.append({"role": "assistant", "content": final_reply})
-                        else:
-                            # Fallback se l'AI non risponde
-                            game.messages.append({"role": "assistant", "content": "Cosa fai?"})
-                    else:
-                        # Errore nella gestione dei tool
-                        flash.error(request, "Errore nella gestione delle azioni di gioco.")
-                
-                else:
-                    # Se non ci sono tool_calls ma c'è contenuto, va bene così
-                    if not response_message.content:
-                        # Caso raro: nessun tool call e nessun contenuto
-                        game.messages.append({"role": "assistant", "content": "Cosa fai?"})
-                        
-            except Exception as e:
-                logger.error(f"Errore nella chiamata all'AI: {e}")
-                flash.error(request, "Errore di comunicazione con l'AI. Riprova.")
-                game.messages.append({"role": "assistant", "content": "Si è verificato un errore. Cosa fai?"})
+            turn = idempotency.Turn(request, GAME_ID)
+            if not await turn.claim():
+                # Doppio clic o F5 durante l'attesa: si mostra il turno già avviato
+                await turn.follow(request)
+                return redirect(reverse("ade:chat-ade"))
+            await drain(turn.record(play_turn(request, game, user_input)))
 
         # Salvataggio dello stato
-        game.save_state_to_session()
-        save_game_to_file(request, game.get_state_for_savefile())
+        saved = await game.asave(request)
+        if turn is not None:
+            # I doppioni di questo invio attendono lo stato salvato (o rigiocano un turno scartato)
+            await turn.settle(saved)
+        # I turni vecchi si riassumono in background: né la risposta né la coda aspettano
+        await memory.asummarize_later(request, game, MODEL, extra_headers={"X-Title": "ADE RPG"})
+        # Il file con la cronologia completa si scrive a intervalli, non a ogni turno
+        if await asnapshot_due(request, GameManager):
+            await sync_to_async(save_game_to_file)(request, game.get_state_for_savefile())
         return redirect(reverse("ade:chat-ade"))
 
     # Preparazione del contesto per il template (GET)
@@ -663,6 +893,7 @@ def chat_ade(request):
     context = {
         'messages_log': messages_for_template,
         'username': request.user.username if request.user.is_authenticated else 'Giocatore',
+        'turn_key': idempotency.new_key(),
         'hp': game.hp,
         'inventario': game.inventory,
         'objective': game.current_objective,
@@ -674,6 +905,45 @@ def chat_ade(request):
     }
     return render(request, "ade/chat.html", context)
 
+@require_POST
+@rate_limited(GAME_ID, "chat")
+async def chat_stream(request):
+    """
+    Variante in streaming della chat: inoltra i token del DM come Server-Sent Events
+    mentre la risposta viene generata. Stato e salvataggi vengono aggiornati a fine stream.
+    """
+    await aload_request_state(request)
+    game = await GameManager.aload(request)
+    user_input = request.POST.get("user_input", "").strip()
+    if not game.is_initialized() or not user_input:
+        return JsonResponse({"error": "Turno non valido."}, status=400)
+
+    turn = idempotency.Turn(request, GAME_ID)
+    if not await turn.claim():
+        # Stesso invio ripetuto: riceve gli eventi del turno originale
+        return sse_response(turn.replay())
+
+    async def events():
+        async for event in play_turn(request, game, user_input):
+            yield event
+
+        # La risposta è già partita: la partita va salvata qui, prima degli ultimi eventi
+        if not await game.asave(request):
+            # Turno scartato per un conflitto: i doppioni non devono riceverlo come concluso
+            await turn.abandon()
+        # I turni vecchi si riassumono in background, dopo il salvataggio
+        await memory.asummarize_later(request, game, MODEL, extra_headers={"X-Title": "ADE RPG"})
+        # Il file con la cronologia completa si scrive a intervalli, non a ogni turno
+        if await asnapshot_due(request, GameManager):
+            await sync_to_async(save_game_to_file)(request, game.get_state_for_savefile())
+
+        yield "state", game.get_public_state()
+        for event in notice_events(request):
+            yield event
+        yield "done", {}
+
+    return sse_response(turn.record(events()))
+
 # Funzione separata per gestire i tool calls
 def process_tool_calls(tool_calls, game, request):
     
@@ -692,12 +962,21 @@ def process_tool_calls(tool_calls, game, request):
         for tool_call in tool_calls:
             function_name = tool_call.function.name
             
-            # Parsing sicuro degli argomenti
+            # Parsing sicuro degli argomenti: quelli malformati (virgole finali, apici singoli,
+            # JSON troncato, tipi sbagliati) vengono riparati in locale invece di perdere l'effetto
             try:
-                function_args = json.loads(tool_call.function.arguments)
-            except json.JSONDecodeError as e:
+                function_args, repaired = toolargs.parse_arguments(
+                    tool_call.function.arguments, TOOL_PARAMETERS.get(function_name)
+                )
+            except ValueError as e:
                 logger.error(f"Errore nel parsing degli argomenti per {function_name}: {e}")
+                metrics.incr(f"tools.args.failed.{GAME_ID}")
                 continue
+            if repaired:
+                logger.info(f"Argomenti riparati per {function_name}: {tool_call.function.arguments!r} -> {function_args}")
+                metrics.incr(f"tools.args.repaired.{GAME_ID}")
+            else:
+                metrics.incr(f"tools.args.ok.{GAME_ID}")
             
             function_response = ""
             
@@ -707,37 +986,15 @@ def process_tool_calls(tool_calls, game, request):
                 items_added = []
                 items_already_present = []
                 
-                # CORREZIONE: Assicurati che items_to_add sia sempre una lista
-                if isinstance(items_to_add, str):
-                    # Se è una stringa, potrebbe essere una lista separata da virgole
-                    if ',' in items_to_add:
-                        items_to_add = [item.strip() for item in items_to_add.split(',')]
-                    else:
-                        items_to_add = [items_to_add]
-                elif not isinstance(items_to_add, list):
-                    # Se non è né stringa né lista, prova a convertirla
-                    items_to_add = list(items_to_add) if items_to_add else []
-                
+                # Gli argomenti sono già stati adattati allo schema: `items` è una lista di stringhe
                 for item in items_to_add:
-                    # CORREZIONE: Assicurati che item sia una stringa
-                    if isinstance(item, str):
-                        was_added = game.add_to_inventory(item)
-                        if was_added:
-                            items_added.append(item)
-                            ai_message_parts.append(f"Oggetto '{item}' aggiunto con successo.")
-                        else:
-                            items_already_present.append(item)
-                            ai_message_parts.append(f"Oggetto '{item}' era già presente nell'inventario.")
+                    was_added = game.add_to_inventory(item)
+                    if was_added:
+                        items_added.append(item)
+                        ai_message_parts.append(f"Oggetto '{item}' aggiunto con successo.")
                     else:
-                        # Se l'item non è una stringa, convertilo
-                        item_str = str(item)
-                        was_added = game.add_to_inventory(item_str)
-                        if was_added:
-                            items_added.append(item_str)
-                            ai_message_parts.append(f"Oggetto '{item_str}' aggiunto con successo.")
-                        else:
-                            items_already_present.append(item_str)
-                            ai_message_parts.append(f"Oggetto '{item_str}' era già presente nell'inventario.")
+                        items_already_present.append(item)
+                        ai_message_parts.append(f"Oggetto '{item}' era già presente nell'inventario.")
                 
                 # Crea notifiche separate per oggetti aggiunti e già presenti
                 if items_added:
@@ -805,14 +1062,11 @@ def process_tool_calls(tool_calls, game, request):
         return False
 
 
+@rate_limited(GAME_ID, "reset", methods=None, redirect_to="ade:chat-ade")
 def reset_session(request):
     """Pulisce la sessione di gioco e reindirizza alla chat."""
-    keys_to_clear = [
-        SESSION_MESSAGES, SESSION_HP, SESSION_INVENTORY, SESSION_STATS,
-        SESSION_LEVEL, SESSION_OBJECTIVES_COMPLETED, SESSION_CURRENT_OBJECTIVE, SESSION_PLAYER_CLASS
-    ]
-    for key in keys_to_clear:
-        request.session.pop(key, None)
+    # I turni ancora in corso sulla vecchia partita non devono sovrascrivere quella nuova
+    clear_saved(request, GameManager)
     
     flash.add_message(request, flash.INFO, "Nuova partita iniziata.")
     return redirect(reverse("ade:chat-ade"))
@@ -838,29 +1092,39 @@ def load_game_session(request, filename):
         flash.add_message(request, flash.ERROR, "Accesso non autorizzato a questo salvataggio.")
         return redirect(reverse("ade:chat-ade"))
 
+    # Il salvataggio è di un altro gioco: lo carica la vista di quel gioco, nella sua partita
+    app_name = request.GET.get('app', GAME_ID)
+    if app_name != GAME_ID:
+        try:
+            return redirect(reverse(f"{app_name}:load_game_session", args=[filename]))
+        except NoReverseMatch:
+            flash.add_message(request, flash.ERROR, "Il salvataggio non appartiene a nessun gioco conosciuto.")
+            return redirect(reverse("ade:chat-ade"))
+
     session_data = load_game_from_file(filename)
     
     if session_data:
-        # Popola la sessione con i dati caricati
-        request.session[SESSION_MESSAGES] = session_data.get("messages", [])
-        request.session[SESSION_HP] = session_data.get("hp", STARTING_HP)
-        request.session[SESSION_INVENTORY] = session_data.get("inventario", [])
-        request.session[SESSION_STATS] = session_data.get("stats", INITIAL_STATS)
-        request.session[SESSION_LEVEL] = session_data.get("level", 1)
-        request.session[SESSION_OBJECTIVES_COMPLETED] = session_data.get("objectives_completed", 0)
-        request.session[SESSION_CURRENT_OBJECTIVE] = session_data.get("objective", "")
-        request.session[SESSION_PLAYER_CLASS] = session_data.get("player_class", "")
+        # Sostituisce la partita salvata con i dati caricati
+        saved = {
+            SESSION_MESSAGES: session_data.get("messages", []),
+            SESSION_HP: session_data.get("hp", STARTING_HP),
+            SESSION_MAX_HP: session_data.get("max_hp", STARTING_HP),
+            SESSION_INVENTORY: session_data.get("inventario", []),
+            SESSION_STATS: session_data.get("stats", INITIAL_STATS),
+            SESSION_LEVEL: session_data.get("level", 1),
+            SESSION_OBJECTIVES_COMPLETED: session_data.get("objectives_completed", 0),
+            SESSION_CURRENT_OBJECTIVE: session_data.get("objective", ""),
+            SESSION_PLAYER_CLASS: session_data.get("player_class", ""),
+            SESSION_SUMMARY: session_data.get("summary", ""),
+            SESSION_SUMMARY_UPTO: session_data.get("summary_upto", 0),
+        }
+        replace_saved(request, GameManager, saved)
         
         flash.add_message(request, flash.SUCCESS, f"Partita '{filename}' caricata con successo!")
     else:
         flash.add_message(request, flash.ERROR, "Errore nel caricamento della partita.")
 
-    # Logica di reindirizzamento basata sul parametro 'app'
-    app_name = request.GET.get('app', 'ade')
-    if app_name == 'bmovie':
-        return redirect(reverse("bmovie:chat"))
-    else:
-        return redirect(reverse("ade:chat-ade"))
+    return redirect(reverse("ade:chat-ade"))
     
 
 # CORREZIONE 4: Debugging e logging migliorati
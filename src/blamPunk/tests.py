@@ -1,3 +1,20 @@
 from django.test import TestCase
+from django.urls import reverse
 
-# Create your tests here.
+from core.models import Game
+
+
+class LoadGameSessionTests(TestCase):
+    filename = "sessione_anonimo_20260101.json"
+
+    def test_other_game_save_goes_to_its_own_loader(self):
+        response = self.client.get(reverse("blamPunk:load_game_session", args=[self.filename]), {"app": "bmovie"})
+        self.assertRedirects(
+            response, reverse("bmovie:load_game_session", args=[self.filename]), fetch_redirect_response=False,
+        )
+        self.assertFalse(Game.objects.exists())
+
+    def test_unknown_game_is_rejected(self):
+        response = self.client.get(reverse("blamPunk:load_game_session", args=[self.filename]), {"app": "admin"})
+        self.assertRedirects(response, reverse("blamPunk:chat-dark"), fetch_redirect_response=False)
+        self.assertFalse(Game.objects.exists())
@@ -5,6 +5,7 @@ app_name = "hackergame"
 
 urlpatterns = [
 path('chatdark/', views.chat_view, name='chat-dark'),
+path('chatdark/stream/', views.chat_stream, name='chat-stream'),
 path("reset/", views.reset_session, name="reset_session"),  # 👈 questa è la chiave
 
 path("load/", views.load_game_list, name="load_game_list"),
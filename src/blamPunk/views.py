@@ -24,19 +24,29 @@ import random
 import re
 from datetime import datetime
 
-from openai import OpenAI
-from decouple import config
+from asgiref.sync import sync_to_async
 from django.contrib import messages as flash
 from django.http import JsonResponse
+from django.views.decorators.http import require_POST
 from django.shortcuts import redirect, render
-from django.urls import reverse
+from django.urls import NoReverseMatch, reverse
+
+from core import admission, hedging, history, idempotency, memory, openings, resilience, rules
+from core.context import build_prompt
+from core.gamestate import VersionedState, asnapshot_due, clear_saved, replace_saved
+from core.ratelimit import rate_limited
+from core.parsing import parse_reply
+from core.structured import ReplyReader
+from core.state import aload_request_state
+from core.streaming import drain, iter_text, notice_events, sse_response
 
 # --- CONFIGURAZIONE E COSTANTI ---
 
-# Caricamento delle configurazioni dall'esterno
-API_KEY = config("API_KEY")
-API_URL = "https://openrouter.ai/api/v1/"
+# Modello usato dal gioco (impostazioni di connessione in config/settings.py)
 MODEL = "google/gemini-2.0-flash-001"
+GAME_ID = "blamPunk"  # Chiave del gioco nelle impostazioni condivise (es. LLM_OPENINGS)
+# Campi di stato che il DM può cambiare (modalità con output strutturato, vedi core/structured.py)
+STATE_FIELDS = ("hp", "damage", "heal", "new_class", "items", "objective")
 
 # Classi del personaggio che cambiano a seconda delle azioni di gioco
 ARCHETYPES = {
@@ -53,6 +63,17 @@ STARTING_HP = 20
 MAX_SAVE_FILES = 10  # Limite massimo di file di salvataggio per utente
 INITIAL_STATS = {"Carisma": 2, "Prontezza": 1, "Cervello": 3, "Fegato": 1}
 
+# Oggetti consumabili: parola chiave nel nome dell'oggetto -> effetto (risolti senza l'AI)
+CONSUMABLES = {
+    "razione": {"heal": 4, "message": "🥫 Hai consumato {item}: +{healed} HP. HP attuali: {hp}/{max_hp}"},
+    "acqua": {"heal": 2, "message": "💧 Hai bevuto {item}: +{healed} HP. HP attuali: {hp}/{max_hp}"},
+    "benda": {"heal": 4, "message": "🩹 Hai usato {item}: +{healed} HP. HP attuali: {hp}/{max_hp}"},
+    "siringa": {"heal": 8, "message": "💉 Hai iniettato {item}: +{healed} HP. HP attuali: {hp}/{max_hp}"},
+    "stimolante": {"heal": 6, "message": "💉 Hai assunto {item}: +{healed} HP. HP attuali: {hp}/{max_hp}"},
+    "medikit": {"heal": 12, "message": "🧰 Hai usato {item}: +{healed} HP. HP attuali: {hp}/{max_hp}"},
+    "kit medico": {"heal": 12, "message": "🧰 Hai usato {item}: +{healed} HP. HP attuali: {hp}/{max_hp}"},
+}
+
 # Costanti per le chiavi di sessione (evita "stringhe magiche")
 SESSION_MESSAGES = "blame_messages"
 SESSION_HP = "hp"
@@ -64,6 +85,9 @@ SESSION_CURRENT_OBJECTIVE = "objective"
 SESSION_MAX_HP = 'max_hp'
 HP_PER_LEVEL = 10
 SESSION_PLAYER_CLASS = "player_class"
+SESSION_SUMMARY = "blame_summary"
+SESSION_SUMMARY_UPTO = "blame_summary_upto"
+SESSION_VERSION = "blame_version"  # versione dello stato, per il salvataggio con compare-and-swap
 
 # System prompt per l'AI, separato dalla logica della vista
 SYSTEM_PROMPT = (
@@ -153,6 +177,9 @@ def save_game_to_file(request, game_data):
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     file_path = _get_save_path(username, timestamp)
 
+    # Il file contiene la cronologia completa, anche se la partita ne ha caricata solo una finestra
+    game_data = {**game_data, "messages": history.full_history(game_data["messages"])}
+
     try:
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
         with open(file_path, "w", encoding="utf-8") as f:
@@ -175,11 +202,28 @@ def load_game_from_file(filename):
 
 # --- LIVELLO DI LOGICA DI BUSINESS (Game Logic Layer) ---
 
-class GameManager:
+class GameManager(VersionedState):
     """
     Gestisce lo stato e la logica del gioco per una sessione utente.
     Incapsula HP, inventario, statistiche, progressione e interazioni.
     """
+    GAME_ID = GAME_ID
+    STATE_KEYS = {
+        "hp": SESSION_HP,
+        "max_hp": SESSION_MAX_HP,
+        "inventory": SESSION_INVENTORY,
+        "stats": SESSION_STATS,
+        "level": SESSION_LEVEL,
+        "objectives_completed": SESSION_OBJECTIVES_COMPLETED,
+        "current_objective": SESSION_CURRENT_OBJECTIVE,
+        "player_class": SESSION_PLAYER_CLASS,
+        "messages": SESSION_MESSAGES,
+        "summary": SESSION_SUMMARY,
+        "summary_upto": SESSION_SUMMARY_UPTO,
+    }
+    VERSION_KEY = SESSION_VERSION
+    MERGE_RULES = {"hp": "add", "inventory": "multiset", "stats": "counters", "messages": "append"}
+
     def __init__(self, session):
         self.session = session
         self.hp = session.get(SESSION_HP)
@@ -191,6 +235,9 @@ class GameManager:
         self.messages = session.get(SESSION_MESSAGES, [])
         self.max_hp = session.get(SESSION_MAX_HP)
         self.player_class = session.get(SESSION_PLAYER_CLASS, "Investigatore")
+        self.summary = session.get(SESSION_SUMMARY, "")
+        self.summary_upto = session.get(SESSION_SUMMARY_UPTO, 0)
+        self.track_version()
 
     def is_initialized(self):
         """Controlla se la sessione di gioco è già stata inizializzata."""
@@ -208,24 +255,14 @@ class GameManager:
         self.max_hp = STARTING_HP
         self.hp = self.max_hp
         self.player_class = "Investigatore"
+        self.summary = ""
+        self.summary_upto = 0
         
         # Aggiunge le informazioni iniziali come primo messaggio
         stato_hp = f"[INFO] Il personaggio ha attualmente {self.hp} / {self.max_hp} punti ferita."
         stato_inventario = f"[INFO] Il personaggio non possiede oggetti."
         self.messages.append({"role": "user", "content": f"{stato_hp} {stato_inventario}"})
 
-    def save_state_to_session(self):
-        """Salva lo stato corrente del gioco nella sessione Django."""
-        self.session[SESSION_HP] = self.hp
-        self.session[SESSION_INVENTORY] = self.inventory
-        self.session[SESSION_STATS] = self.stats
-        self.session[SESSION_LEVEL] = self.level
-        self.session[SESSION_OBJECTIVES_COMPLETED] = self.objectives_completed
-        self.session[SESSION_CURRENT_OBJECTIVE] = self.current_objective
-        self.session[SESSION_MESSAGES] = self.messages
-        self.session[SESSION_MAX_HP] = self.max_hp
-        self.session[SESSION_PLAYER_CLASS] = self.player_class
-
     def get_state_for_savefile(self):
         """Restituisce un dizionario con i dati da salvare su file."""
         return {
@@ -238,8 +275,22 @@ class GameManager:
             "objectives_completed": self.objectives_completed,
             "max_hp": self.max_hp,
             "player_class": self.player_class,
+            "summary": self.summary,
+            "summary_upto": self.summary_upto,
         }
     
+    def get_public_state(self):
+        """Restituisce lo stato mostrato nella sidebar, usato per gli aggiornamenti in streaming."""
+        return {
+            "hp": self.hp,
+            "max_hp": self.max_hp,
+            "inventario": self.inventory,
+            "objective": self.current_objective,
+            "level": self.level,
+            "stats": self.stats,
+            "game_over": self.hp <= 0,
+        }
+
     def change_class(self, new_class_name):
         """Cambia la classe del giocatore e applica i bonus associati."""
         new_class_name = new_class_name.capitalize()
@@ -307,6 +358,10 @@ class GameManager:
             )
         return None
 
+    def use_item(self, item_name):
+        """Usa un consumabile dell'inventario (vedi CONSUMABLES). None se l'oggetto non si può usare."""
+        return rules.use_consumable(self, item_name, CONSUMABLES)
+
         # TIRO DEL DADO
     def process_dice_roll(self, user_input):
         """Gestisce un tiro di dado e lo formatta."""
@@ -364,91 +419,162 @@ class GameManager:
 
 
 
-def get_ai_response(messages):
-    """Invia i messaggi all'API di OpenRouter e restituisce la risposta."""
+async def stream_ai_response(messages, **kwargs):
+    """Invia i messaggi all'API di OpenRouter e restituisce la risposta un frammento alla volta."""
     try:
-        client = OpenAI(
-            base_url=API_URL,
-            api_key=API_KEY,
-        )
-        completion = client.chat.completions.create(
+        stream = await hedging.astream_chat_completion(
+            GAME_ID,
+            MODEL,
+            messages,
             extra_headers={
-                "HTTP-Referer": "http://localhost",  # Optional. Site URL for rankings on openrouter.ai.
                 "X-Title": "BlamPunk RPG",  # Optional. Site title for rankings on openrouter.ai.
             },
-            model=MODEL,
-            messages=messages,
-            timeout=30
+            **kwargs,
         )
-        return completion.choices[0].message.content
+        try:
+            async for text in iter_text(stream):
+                yield text
+        finally:
+            # Anche se chi legge si ferma prima o solleva un'eccezione
+            await stream.close()
     except Exception as e:  # Catching a more general Exception for now, can refine later
         logger.error(f"Errore nella chiamata API: {e}")
-        return None
+
+
+def build_messages_for_ai(game, extra_tail=()):
+    """
+    Prepara la lista di messaggi da inviare all'AI, arricchita con il contesto della partita.
+    `extra_tail` sono altre istruzioni da mettere in coda (es. il formato JSON).
+    """
+    # 1. Crea il messaggio di contesto con lo stato attuale della partita
+    context_message = (
+        f"[CONTESTO PARTITA] Il giocatore è di livello {game.level}. "
+        f"Ha {game.hp}/{game.max_hp} HP. "
+        f"Inventario: {', '.join(game.inventory) or 'vuoto'}. "
+        f"Crea una sfida appropriata per il suo livello."
+    )
+
+    # 2. Costruisce una lista temporanea per non sporcare la cronologia reale: i turni vecchi
+    #    sono sostituiti dal riassunto "STORIA FINORA" e il tutto viene adattato al budget
+    #    di token del modello. Il contesto va in coda con ruolo "user", così l'AI lo leggerà
+    #    come un'istruzione diretta.
+    return build_prompt(game, MODEL, tail=[{"role": "user", "content": context_message}, *extra_tail])
+
+
+async def play_turn(request, game, user_input):
+    """
+    Esegue un turno di gioco e produce gli eventi `(nome, dati)` per il client,
+    inoltrando il testo del DM man mano che arriva. I cambiamenti di stato vengono
+    applicati appena il loro tag è completo, senza attendere la fine della risposta.
+    """
+    # Comandi deterministici (inventario, HP, aiuto...) e partita finita: risposta locale, niente AI
+    resolved = rules.resolve(game, user_input)
+    if resolved is not None:
+        for event in rules.local_turn(game, user_input, *resolved):
+            yield event
+        return
+
+    # Turno con l'AI: prima serve un posto tra quelli del worker (coda equa per giocatore)
+    async for event in admission.admitted(request, play_ai_turn(request, game, user_input)):
+        yield event
+
+
+async def play_ai_turn(request, game, user_input):
+    """Parte di `play_turn` che coinvolge l'AI, eseguita solo dopo l'ammissione."""
+    # Gestione tiro di dado
+    if "tiro" in user_input.lower():
+        user_input = game.process_dice_roll(user_input)
+
+    game.messages.append({"role": "user", "content": user_input})
+    yield "user", {"content": user_input}
+
+    # Chiama l'AI usando la lista di messaggi "arricchita". Il lettore segue la modalità
+    # del gioco: testo con frasi magiche (regex) oppure JSON con narrazione e stato.
+    reader = ReplyReader(GAME_ID, STATE_FIELDS)
+    reader.record_turn(user_input)
+    messages_for_ai = build_messages_for_ai(game, reader.prompt_tail())
+    # I messaggi di gioco prodotti durante lo streaming (es. level up) vanno dopo la risposta
+    reply_index = len(game.messages)
+    # Scadenza del turno: un provider lento o in errore non tiene occupato il worker oltre questo limite
+    deadline = resilience.Deadline()
+    async for text in stream_ai_response(messages_for_ai, deadline=deadline, **reader.request_kwargs()):
+        shown = reader.feed(text)
+        if shown:
+            yield "token", {"text": shown}
+        # I tag completati si applicano subito: la sidebar si aggiorna mentre il DM scrive
+        for update in reader.updates():
+            apply_reply_state(request, update, game)
+            yield "state", game.get_public_state()
+    reply, parsed = reader.finish()
+    if reply and not reader.shown:
+        yield "token", {"text": reply}
+
+    if reply:
+        game.messages.insert(reply_index, {"role": "assistant", "content": reply})
+
+        # Aggiornamento dello stato con i cambiamenti annunciati dall'AI
+        apply_reply_state(request, parsed, game)
+    else:
+        flash.add_message(request, flash.ERROR, "Errore nella risposta dell'AI. Riprova più tardi.")
 
 
 # --- LIVELLO DI PRESENTAZIONE (View Layer) ---
 
-def chat_view(request):
+@rate_limited(GAME_ID, "chat")
+async def chat_view(request):
     """
     Vista principale della chat, ora più snella e funge da orchestratore.
+
+    È asincrona: durante l'attesa dell'AI il worker resta libero di servire altre richieste.
     """
-    game = GameManager(request.session)
+    await aload_request_state(request)
+    game = await GameManager.aload(request)
 
     if not game.is_initialized():
         game.initialize_new_game()
-        game.save_state_to_session()
+        # Se il pool ha una scena d'apertura pronta, la partita parte già narrata
+        opening = await openings.atake(GAME_ID)
+        if opening:
+            game.messages.append({"role": "assistant", "content": opening})
+            parse_ai_reply(request, opening, game)
+        await game.asave(request)
         return redirect(reverse("blamPunk:chat-dark")) # Ricarica per mostrare il primo messaggio
 
     if request.method == "POST":
+        turn = None
         # Gestione dell'uso di un oggetto
         if "use_item" in request.POST:
             item_to_use = request.POST.get("use_item")
             message = game.use_item(item_to_use)
             if message:
                 flash.add_message(request, flash.SUCCESS, message)
+                # L'AI deve sapere che l'oggetto è stato consumato
+                game.messages.append({"role": "user", "content": f"[INFO DI GIOCO] {message}"})
+            else:
+                flash.add_message(request, flash.WARNING, f"Non puoi usare '{item_to_use}' in questo modo.")
         
         # Gestione dell'input dell'utente
         elif "user_input" in request.POST:
             user_input = request.POST.get("user_input", "").strip()
             if user_input:
-                # Gestione tiro di dado
-                if "tiro" in user_input.lower():
-                    user_input = game.process_dice_roll(user_input)
-
-                game.messages.append({"role": "user", "content": user_input})
-                
-                # Chiamata all'AI
-                 # 1. Crea una copia temporanea dei messaggi per non sporcare la cronologia reale
-                messages_for_ai = list(game.messages)
-                
-                # 2. Crea il messaggio di contesto usando l'oggetto 'game' che è già definito qui
-                context_message = (
-                    f"[CONTESTO PARTITA] Il giocatore è di livello {game.level}. "
-                    f"Ha {game.hp}/{game.max_hp} HP. "
-                    f"Inventario: {', '.join(game.inventory) or 'vuoto'}. "
-                    f"Crea una sfida appropriata per il suo livello."
-                )
-                
-                # 3. Aggiungi il messaggio di contesto alla lista temporanea.
-                #    Lo inseriamo come ruolo "user" così l'AI lo leggerà come un'istruzione diretta.
-                messages_for_ai.append({"role": "user", "content": context_message})
-
-                # 4. Chiama l'AI usando la lista di messaggi "arricchita"
-                reply = get_ai_response(messages_for_ai)
-                
-                if reply:
-                    game.messages.append({"role": "assistant", "content": reply})
-                    
-                    # Parsing della risposta dell'AI
-                    parse_ai_reply(request, reply, game)
-                else:
-                    flash.add_message(request, flash.ERROR, "Errore nella risposta dell'AI. Riprova più tardi.")
+                turn = idempotency.Turn(request, GAME_ID)
+                if not await turn.claim():
+                    # Doppio clic o F5 durante l'attesa: si mostra il turno già avviato
+                    await turn.follow(request)
+                    return redirect(reverse("blamPunk:chat-dark"))
+                await drain(turn.record(play_turn(request, game, user_input)))
 
         # Salvataggio dello stato dopo ogni azione POST
-        game.save_state_to_session()
-        
-        # Salvataggio asincrono su file
-        save_game_to_file(request, game.get_state_for_savefile())
+        saved = await game.asave(request)
+        if turn is not None:
+            # I doppioni di questo invio attendono lo stato salvato (o rigiocano un turno scartato)
+            await turn.settle(saved)
+        # I turni vecchi si riassumono in background: né la risposta né la coda aspettano
+        await memory.asummarize_later(request, game, MODEL, extra_headers={"X-Title": "BlamPunk RPG"})
+
+        # Il file con la cronologia completa si scrive a intervalli, non a ogni turno
+        if await asnapshot_due(request, GameManager):
+            await sync_to_async(save_game_to_file)(request, game.get_state_for_savefile())
 
         # Reindirizza per evitare il reinvio del form con F5
         return redirect(reverse("blamPunk:chat-dark"))
@@ -458,6 +584,7 @@ def chat_view(request):
     context = {
         'messages_log': messages_for_template,
         'username': request.user.username if request.user.is_authenticated else 'Giocatore',
+        'turn_key': idempotency.new_key(),
         'hp': game.hp,
         'inventario': game.inventory,
         'objective': game.current_objective,
@@ -467,63 +594,80 @@ def chat_view(request):
     }
     return render(request, "blamPunk/chat_dark.html", context)
 
+@require_POST
+@rate_limited(GAME_ID, "chat")
+async def chat_stream(request):
+    """
+    Variante in streaming della chat: inoltra i token del DM come Server-Sent Events
+    mentre la risposta viene generata. Stato e salvataggi vengono aggiornati a fine stream.
+    """
+    await aload_request_state(request)
+    game = await GameManager.aload(request)
+    user_input = request.POST.get("user_input", "").strip()
+    if not game.is_initialized() or not user_input:
+        return JsonResponse({"error": "Turno non valido."}, status=400)
+
+    turn = idempotency.Turn(request, GAME_ID)
+    if not await turn.claim():
+        # Stesso invio ripetuto: riceve gli eventi del turno originale
+        return sse_response(turn.replay())
+
+    async def events():
+        async for event in play_turn(request, game, user_input):
+            yield event
+
+        # La risposta è già partita: la partita va salvata qui, prima degli ultimi eventi
+        if not await game.asave(request):
+            # Turno scartato per un conflitto: i doppioni non devono riceverlo come concluso
+            await turn.abandon()
+        # I turni vecchi si riassumono in background, dopo il salvataggio
+        await memory.asummarize_later(request, game, MODEL, extra_headers={"X-Title": "BlamPunk RPG"})
+        # Il file con la cronologia completa si scrive a intervalli, non a ogni turno
+        if await asnapshot_due(request, GameManager):
+            await sync_to_async(save_game_to_file)(request, game.get_state_for_savefile())
+
+        yield "state", game.get_public_state()
+        for event in notice_events(request):
+            yield event
+        yield "done", {}
+
+    return sse_response(turn.record(events()))
+
 def parse_ai_reply(request, reply, game):
     """Esegue il parsing della risposta dell'AI e aggiorna lo stato del gioco."""
-    
-    # --- NUOVA LOGICA ROBUSTA PER GLI HP ---
-    # Cerca prima uno stato assoluto, che è più affidabile.
-    hp_status_match = re.search(r"(?:Punti ferita|HP) attuali:\s*(\d+)", reply, re.IGNORECASE)
-    
-    if hp_status_match:
-        # Se l'AI ci dice gli HP finali, sincronizziamo direttamente lo stato.
-        new_hp = int(hp_status_match.group(1))
-        game.hp = min(new_hp, game.max_hp) # Usiamo min() per sicurezza, non si sa mai
-    else:
-        # Altrimenti, cerchiamo i cambiamenti relativi (danno o guarigione).
-        damage_match = re.search(r"Hai perso\s+(\d+)\s+punti ferita", reply, re.IGNORECASE)
-        if damage_match:
-            damage = int(damage_match.group(1))
-            game.take_damage(damage)
-            flash.add_message(request, flash.WARNING, f"Hai perso {damage} HP!")
-
-        heal_match = re.search(r"Hai guarito\s+(\d+)\s+punti ferita", reply, re.IGNORECASE)
-        if heal_match:
-            amount_healed = int(heal_match.group(1))
-            game.heal_damage(amount_healed)
-            flash.add_message(request, flash.INFO, f"Hai recuperato {amount_healed} HP!")
-            
-    # --- FINE NUOVA LOGICA HP ---
-
-    # --- NUOVA LOGICA PER IL CAMBIO DI CLASSE ---
-    class_match = re.search(r"\[CLASS_CHANGE\]\s*(\w+)", reply, re.IGNORECASE)
-    if class_match:
-        new_class = class_match.group(1)
-        message = game.change_class(new_class)
+    apply_reply_state(request, parse_reply(reply), game)
+
+
+def apply_reply_state(request, parsed, game):
+    """Applica allo stato del gioco i cambiamenti estratti dalla risposta (da regex o da JSON)."""
+    # --- HP ---
+    # Se l'AI ci dice gli HP finali, sincronizziamo direttamente lo stato
+    # (in quel caso il parser ignora danni e guarigioni, già conteggiati).
+    if parsed.hp is not None:
+        game.hp = min(parsed.hp, game.max_hp) # Usiamo min() per sicurezza, non si sa mai
+    if parsed.damage is not None:
+        game.take_damage(parsed.damage)
+        flash.add_message(request, flash.WARNING, f"Hai perso {parsed.damage} HP!")
+    if parsed.heal is not None:
+        game.heal_damage(parsed.heal)
+        flash.add_message(request, flash.INFO, f"Hai recuperato {parsed.heal} HP!")
+
+    # --- CAMBIO DI CLASSE ---
+    if parsed.new_class:
+        message = game.change_class(parsed.new_class)
         if message:
             flash.add_message(request, flash.SUCCESS, message)
 
-    # Parsing oggetti raccolti
-    collected_match = re.search(r"Hai raccolto:?\s*([^\]\.\[]+)", reply, re.IGNORECASE)
-    if collected_match:
-        items_string = collected_match.group(1)
-        items_list = items_string.split(',')
-
-    # 3. Itera su ogni elemento della lista.
-        for item in items_list:
-            # 4. Pulisci ogni singolo oggetto da spazi bianchi extra e assicurati che non sia vuoto.
-            clean_item = item.strip()
-            if clean_item:
-                # 5. Aggiungi l'oggetto pulito all'inventario.
-                message = game.add_to_inventory(clean_item)
-                if message:
-                    flash.add_message(request, flash.INFO, message)
+    # Oggetti raccolti
+    for item in parsed.items:
+        message = game.add_to_inventory(item)
+        if message:
+            flash.add_message(request, flash.INFO, message)
 
     # Parsing OBIETTIVI
-    obj_match = re.search(r"\[OBJECTIVE\]\s*(.*)", reply, re.IGNORECASE)
-    if obj_match:
-        new_objective = obj_match.group(1).strip()
-        game.current_objective = new_objective
-        flash.add_message(request, flash.INFO, f"🎯 Nuovo obiettivo: {new_objective}")
+    if parsed.objective is not None:
+        game.current_objective = parsed.objective
+        flash.add_message(request, flash.INFO, f"🎯 Nuovo obiettivo: {parsed.objective}")
         
         levelup_message = game.increment_objective_and_check_levelup()
         if levelup_message:
@@ -531,14 +675,11 @@ def parse_ai_reply(request, reply, game):
             info_message_for_ai = f"[INFO DI GIOCO] {levelup_message}"
             game.messages.append({"role": "user", "content": info_message_for_ai})
 
+@rate_limited(GAME_ID, "reset", methods=None, redirect_to="blamPunk:chat-dark")
 def reset_session(request):
     """Pulisce la sessione di gioco e reindirizza alla chat."""
-    keys_to_clear = [
-        SESSION_MESSAGES, SESSION_HP, SESSION_INVENTORY, SESSION_STATS,
-        SESSION_LEVEL, SESSION_OBJECTIVES_COMPLETED, SESSION_CURRENT_OBJECTIVE, SESSION_PLAYER_CLASS
-    ]
-    for key in keys_to_clear:
-        request.session.pop(key, None)
+    # I turni ancora in corso sulla vecchia partita non devono sovrascrivere quella nuova
+    clear_saved(request, GameManager)
     
     flash.add_message(request, flash.INFO, "Nuova partita iniziata.")
     return redirect(reverse("blamPunk:chat-dark"))
@@ -564,26 +705,36 @@ def load_game_session(request, filename):
         flash.add_message(request, flash.ERROR, "Accesso non autorizzato a questo salvataggio.")
         return redirect(reverse("blamPunk:chat-dark"))
 
+    # Il salvataggio è di un altro gioco: lo carica la vista di quel gioco, nella sua partita
+    app_name = request.GET.get('app', GAME_ID)
+    if app_name != GAME_ID:
+        try:
+            return redirect(reverse(f"{app_name}:load_game_session", args=[filename]))
+        except NoReverseMatch:
+            flash.add_message(request, flash.ERROR, "Il salvataggio non appartiene a nessun gioco conosciuto.")
+            return redirect(reverse("blamPunk:chat-dark"))
+
     session_data = load_game_from_file(filename)
     
     if session_data:
-        # Popola la sessione con i dati caricati
-        request.session[SESSION_MESSAGES] = session_data.get("messages", [])
-        request.session[SESSION_HP] = session_data.get("hp", STARTING_HP)
-        request.session[SESSION_INVENTORY] = session_data.get("inventario", [])
-        request.session[SESSION_STATS] = session_data.get("stats", INITIAL_STATS)
-        request.session[SESSION_LEVEL] = session_data.get("level", 1)
-        request.session[SESSION_OBJECTIVES_COMPLETED] = session_data.get("objectives_completed", 0)
-        request.session[SESSION_CURRENT_OBJECTIVE] = session_data.get("objective", "")
-        request.session[SESSION_PLAYER_CLASS] = session_data.get("player_class", "")
+        # Sostituisce la partita salvata con i dati caricati
+        saved = {
+            SESSION_MESSAGES: session_data.get("messages", []),
+            SESSION_HP: session_data.get("hp", STARTING_HP),
+            SESSION_MAX_HP: session_data.get("max_hp", STARTING_HP),
+            SESSION_INVENTORY: session_data.get("inventario", []),
+            SESSION_STATS: session_data.get("stats", INITIAL_STATS),
+            SESSION_LEVEL: session_data.get("level", 1),
+            SESSION_OBJECTIVES_COMPLETED: session_data.get("objectives_completed", 0),
+            SESSION_CURRENT_OBJECTIVE: session_data.get("objective", ""),
+            SESSION_PLAYER_CLASS: session_data.get("player_class", ""),
+            SESSION_SUMMARY: session_data.get("summary", ""),
+            SESSION_SUMMARY_UPTO: session_data.get("summary_upto", 0),
+        }
+        replace_saved(request, GameManager, saved)
         
         flash.add_message(request, flash.SUCCESS, f"Partita '{filename}' caricata con successo!")
     else:
         flash.add_message(request, flash.ERROR, "Errore nel caricamento della partita.")
 
-    # Logica di reindirizzamento basata sul parametro 'app'
-    app_name = request.GET.get('app', 'blamPunk')
-    if app_name == 'bmovie':
-        return redirect(reverse("bmovie:chat"))
-    else:
-        return redirect(reverse("blamPunk:chat-dark"))
+    return redirect(reverse("blamPunk:chat-dark"))
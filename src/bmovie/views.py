@@ -5,18 +5,28 @@ import random
 import re
 from datetime import datetime
 
-from openai import OpenAI
-from decouple import config
+from asgiref.sync import sync_to_async
 from django.contrib import messages as flash
 from django.http import JsonResponse
+from django.views.decorators.http import require_POST
 from django.shortcuts import redirect, render
 from django.urls import reverse
 
+from core import admission, hedging, history, idempotency, memory, openings, resilience, rules
+from core.context import build_prompt
+from core.gamestate import VersionedState, asnapshot_due, clear_saved, replace_saved
+from core.ratelimit import rate_limited
+from core.parsing import parse_reply
+from core.structured import ReplyReader
+from core.state import aload_request_state
+from core.streaming import drain, iter_text, notice_events, sse_response
+
 # --- CONFIGURAZIONE E COSTANTI ---
 
-API_KEY = config("API_KEY")
-API_URL = "https://openrouter.ai/api/v1/"
 MODEL = "google/gemini-2.0-flash-001"
+GAME_ID = "bmovie"  # Chiave del gioco nelle impostazioni condivise (es. LLM_OPENINGS)
+# Campi di stato che il DM può cambiare (modalità con output strutturato, vedi core/structured.py)
+STATE_FIELDS = ("hp", "damage", "heal", "items", "objective")
 
 # --- COSTANTI DI GIOCO SEMPLIFICATE ---
 LOG_DIR = "bzak/saves"
@@ -24,6 +34,15 @@ STARTING_HP = 20
 MAX_SAVE_FILES = 10
 INITIAL_STATS = {"Fortuna": 2} # Unica statistica
 
+# Oggetti consumabili: parola chiave nel nome dell'oggetto -> effetto (risolti senza l'AI)
+CONSUMABLES = {
+    "caffè": {"heal": 3, "message": "☕ Hai bevuto {item}. Il cuore accelera, le palpebre obbediscono: +{healed} HP ({hp}/{max_hp})"},
+    "ciambella": {"heal": 4, "message": "🍩 Hai divorato {item}: +{healed} HP ({hp}/{max_hp}). La dieta può aspettare."},
+    "panino": {"heal": 5, "message": "🥪 Hai mangiato {item}: +{healed} HP ({hp}/{max_hp})"},
+    "pronto soccorso": {"heal": 12, "message": "🧰 Hai usato {item}: +{healed} HP ({hp}/{max_hp})"},
+    "pozione": {"heal": 10, "message": "🧪 Hai bevuto {item}: +{healed} HP ({hp}/{max_hp}). Sapeva di fragola e rimpianti."},
+}
+
 # --- COSTANTI DI SESSIONE SEMPLIFICATE ---
 SESSION_MESSAGES = "bzak_messages"
 SESSION_HP = "hp_bzak"
@@ -31,6 +50,9 @@ SESSION_INVENTORY = "inventario_bzak"
 SESSION_STATS = "stats_bzak"
 SESSION_CURRENT_OBJECTIVE = "objective_bzak"
 SESSION_MAX_HP = 'max_hp_bzak'
+SESSION_SUMMARY = "summary_bzak"
+SESSION_SUMMARY_UPTO = "summary_upto_bzak"
+SESSION_VERSION = "version_bzak"  # versione dello stato, per il salvataggio con compare-and-swap
 # RIMOSSE le costanti non necessarie: SESSION_LEVEL, SESSION_OBJECTIVES_COMPLETED, HP_PER_LEVEL
 
 # System prompt per l'AI (invariato, è il cuore dell'ambientazione)
@@ -127,6 +149,9 @@ def save_game_to_file(request, game_data):
     _manage_save_files_limit(username)
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     file_path = _get_save_path(username, timestamp)
+    # Il file contiene la cronologia completa, anche se la partita ne ha caricata solo una finestra
+    game_data = {**game_data, "messages": history.full_history(game_data["messages"])}
+
     try:
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
         with open(file_path, "w", encoding="utf-8") as f:
@@ -148,8 +173,22 @@ def load_game_from_file(filename):
 
 # --- LIVELLO DI LOGICA DI BUSINESS (Game Logic Layer) ---
 
-class GameManager:
+class GameManager(VersionedState):
     """Gestisce lo stato e la logica del gioco per una sessione utente (versione semplificata)."""
+    GAME_ID = GAME_ID
+    STATE_KEYS = {
+        "hp": SESSION_HP,
+        "max_hp": SESSION_MAX_HP,
+        "inventory": SESSION_INVENTORY,
+        "stats": SESSION_STATS,
+        "current_objective": SESSION_CURRENT_OBJECTIVE,
+        "messages": SESSION_MESSAGES,
+        "summary": SESSION_SUMMARY,
+        "summary_upto": SESSION_SUMMARY_UPTO,
+    }
+    VERSION_KEY = SESSION_VERSION
+    MERGE_RULES = {"hp": "add", "inventory": "multiset", "stats": "counters", "messages": "append"}
+
     def __init__(self, session):
         self.session = session
         self.hp = session.get(SESSION_HP)
@@ -158,7 +197,10 @@ class GameManager:
         self.stats = session.get(SESSION_STATS, {})
         self.current_objective = session.get(SESSION_CURRENT_OBJECTIVE, "")
         self.messages = session.get(SESSION_MESSAGES, [])
+        self.summary = session.get(SESSION_SUMMARY, "")
+        self.summary_upto = session.get(SESSION_SUMMARY_UPTO, 0)
         # RIMOSSI level e objectives_completed
+        self.track_version()
 
     def is_initialized(self):
         """Controlla se la sessione di gioco è già stata inizializzata."""
@@ -172,22 +214,14 @@ class GameManager:
         self.stats = INITIAL_STATS.copy()
         self.current_objective = "Sopravvivi al lunedì mattina. E scopri perché il tuo tostapane parla in aramaico."
         self.messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        self.summary = ""
+        self.summary_upto = 0
         # RIMOSSI level e objectives_completed
         
         stato_hp = f"[INFO] Punti Ferita iniziali: {self.hp}/{self.max_hp}."
         stato_inventario = f"[INFO] Inventario: vuoto come le promesse di un politico."
         self.messages.append({"role": "user", "content": f"{stato_hp} {stato_inventario}"})
 
-    def save_state_to_session(self):
-        """Salva lo stato corrente del gioco nella sessione Django."""
-        self.session[SESSION_HP] = self.hp
-        self.session[SESSION_MAX_HP] = self.max_hp
-        self.session[SESSION_INVENTORY] = self.inventory
-        self.session[SESSION_STATS] = self.stats
-        self.session[SESSION_CURRENT_OBJECTIVE] = self.current_objective
-        self.session[SESSION_MESSAGES] = self.messages
-        # RIMOSSO il salvataggio di level e objectives_completed
-
     def get_state_for_savefile(self):
         """Restituisce un dizionario con i dati da salvare su file."""
         return {
@@ -197,9 +231,21 @@ class GameManager:
             "inventario": self.inventory,
             "objective": self.current_objective,
             "stats": self.stats,
+            "summary": self.summary,
+            "summary_upto": self.summary_upto,
         }
         # RIMOSSI level e objectives_completed dal dizionario
 
+    def get_public_state(self):
+        """Restituisce lo stato mostrato nella sidebar, usato per gli aggiornamenti in streaming."""
+        return {
+            'hp': self.hp,
+            'inventario': self.inventory,
+            'objective': self.current_objective,
+            'stats': self.stats,
+            'game_over': self.hp <= 0,
+        }
+
     def heal_damage(self, amount):
         """Aumenta gli HP del giocatore."""
         self.hp = min(self.max_hp, self.hp + amount)
@@ -218,6 +264,10 @@ class GameManager:
             return f"📦 Oggetto aggiunto all'inventario: {item}"
         return None
 
+    def use_item(self, item_name):
+        """Usa un consumabile dell'inventario (vedi CONSUMABLES). None se l'oggetto non si può usare."""
+        return rules.use_consumable(self, item_name, CONSUMABLES)
+
     # --- METODO RIMOSSO ---
     # `increment_objective_and_check_levelup` è stato completamente rimosso perché non c'è progressione.
 
@@ -238,60 +288,129 @@ class GameManager:
 # --- LIVELLO DI SERVIZIO (Service Layer) ---
 # Invariato
 
-def get_ai_response(messages):
-    """Invia i messaggi all'API di OpenRouter e restituisce la risposta."""
+async def stream_ai_response(messages, **kwargs):
+    """Invia i messaggi all'API di OpenRouter e restituisce la risposta un frammento alla volta."""
     try:
-        client = OpenAI(base_url=API_URL, api_key=API_KEY)
-        completion = client.chat.completions.create(
-            extra_headers={"HTTP-Referer": "http://localhost", "X-Title": "BMovie RPG"},
-            model=MODEL, messages=messages, timeout=30
-        )
-        return completion.choices[0].message.content
+        stream = await hedging.astream_chat_completion(GAME_ID, MODEL, messages, extra_headers={"X-Title": "BMovie RPG"}, **kwargs)
+        try:
+            async for text in iter_text(stream):
+                yield text
+        finally:
+            # Anche se chi legge si ferma prima o solleva un'eccezione
+            await stream.close()
     except Exception as e:
         logger.error(f"Errore nella chiamata API: {e}")
-        return None
+
+async def play_turn(request, game, user_input):
+    """Esegue un turno di gioco e produce gli eventi `(nome, dati)` per il client."""
+    # Comandi deterministici (inventario, HP, aiuto...) e partita finita: risposta locale, niente AI
+    resolved = rules.resolve(game, user_input)
+    if resolved is not None:
+        for event in rules.local_turn(game, user_input, *resolved):
+            yield event
+        return
+
+    # Turno con l'AI: prima serve un posto tra quelli del worker (coda equa per giocatore)
+    async for event in admission.admitted(request, play_ai_turn(request, game, user_input)):
+        yield event
+
+
+async def play_ai_turn(request, game, user_input):
+    """Parte di `play_turn` che coinvolge l'AI, eseguita solo dopo l'ammissione."""
+    # MODIFICATO: cerca "tiro" per coerenza con `process_dice_roll`
+    if "tiro" in user_input.lower():
+        user_input = game.process_dice_roll(user_input)
+
+    game.messages.append({"role": "user", "content": user_input})
+    yield "user", {"content": user_input}
+
+    # Il lettore segue la modalità del gioco: frasi magiche (regex) o JSON con narrazione e stato
+    reader = ReplyReader(GAME_ID, STATE_FIELDS)
+    reader.record_turn(user_input)
+    # I turni vecchi arrivano all'AI come riassunto "STORIA FINORA", entro il budget di token
+    messages_for_ai = build_prompt(game, MODEL, tail=reader.prompt_tail())
+    # I messaggi di gioco prodotti durante lo streaming (es. level up) vanno dopo la risposta
+    reply_index = len(game.messages)
+    # Scadenza del turno: un provider lento o in errore non tiene occupato il worker oltre questo limite
+    deadline = resilience.Deadline()
+    async for text in stream_ai_response(messages_for_ai, deadline=deadline, **reader.request_kwargs()):
+        shown = reader.feed(text)
+        if shown:
+            yield "token", {"text": shown}
+        # I tag completati si applicano subito: la sidebar si aggiorna mentre il DM scrive
+        for update in reader.updates():
+            apply_reply_state(request, update, game)
+            yield "state", game.get_public_state()
+    reply, parsed = reader.finish()
+    if reply and not reader.shown:
+        yield "token", {"text": reply}
+
+    if reply:
+        game.messages.insert(reply_index, {"role": "assistant", "content": reply})
+        apply_reply_state(request, parsed, game)
+    else:
+        flash.add_message(request, flash.ERROR, "Errore di connessione con il Grande Cthulhu. Riprova.")
 
 # --- LIVELLO DI PRESENTAZIONE (View Layer) ---
 
-def chat_view(request):
-    """Vista principale della chat (versione semplificata)."""
-    game = GameManager(request.session)
+@rate_limited(GAME_ID, "chat")
+async def chat_view(request):
+    """
+    Vista principale della chat (versione semplificata).
+    È asincrona: durante l'attesa dell'AI il worker resta libero di servire altre richieste.
+    """
+    await aload_request_state(request)
+    game = await GameManager.aload(request)
 
     if not game.is_initialized():
         game.initialize_new_game()
-        game.save_state_to_session()
+        # Se il pool ha una scena d'apertura pronta, la partita parte già narrata
+        opening = await openings.atake(GAME_ID)
+        if opening:
+            game.messages.append({"role": "assistant", "content": opening})
+            parse_ai_reply(request, opening, game)
+        await game.asave(request)
         return redirect(reverse("bmovie:chat"))
 
     if request.method == "POST":
-        # La logica `use_item` andrebbe implementata se necessaria, altrimenti rimossa.
-        # Per ora la lascio commentata come promemoria.
-        # if "use_item" in request.POST:
-        #     ...
-        
-        if "user_input" in request.POST:
+        turn = None
+        # Gestione dell'uso di un oggetto
+        if "use_item" in request.POST:
+            item_to_use = request.POST.get("use_item")
+            message = game.use_item(item_to_use)
+            if message:
+                flash.add_message(request, flash.SUCCESS, message)
+                # L'AI deve sapere che l'oggetto è stato consumato
+                game.messages.append({"role": "user", "content": f"[INFO DI GIOCO] {message}"})
+            else:
+                flash.add_message(request, flash.WARNING, f"Non puoi usare '{item_to_use}' in questo modo.")
+
+        elif "user_input" in request.POST:
             user_input = request.POST.get("user_input", "").strip()
             if user_input:
-                # MODIFICATO: cerca "tiro" per coerenza con `process_dice_roll`
-                if "tiro" in user_input.lower():
-                    user_input = game.process_dice_roll(user_input)
-
-                game.messages.append({"role": "user", "content": user_input})
-                reply = get_ai_response(game.messages)
-                
-                if reply:
-                    game.messages.append({"role": "assistant", "content": reply})
-                    parse_ai_reply(request, reply, game)
-                else:
-                    flash.add_message(request, flash.ERROR, "Errore di connessione con il Grande Cthulhu. Riprova.")
-
-        game.save_state_to_session()
-        save_game_to_file(request, game.get_state_for_savefile())
+                turn = idempotency.Turn(request, GAME_ID)
+                if not await turn.claim():
+                    # Doppio clic o F5 durante l'attesa: si mostra il turno già avviato
+                    await turn.follow(request)
+                    return redirect(reverse("bmovie:chat"))
+                await drain(turn.record(play_turn(request, game, user_input)))
+
+        saved = await game.asave(request)
+        if turn is not None:
+            # I doppioni di questo invio attendono lo stato salvato (o rigiocano un turno scartato)
+            await turn.settle(saved)
+        # I turni vecchi si riassumono in background: né la risposta né la coda aspettano
+        await memory.asummarize_later(request, game, MODEL, extra_headers={"X-Title": "BMovie RPG"})
+        # Il file con la cronologia completa si scrive a intervalli, non a ogni turno
+        if await asnapshot_due(request, GameManager):
+            await sync_to_async(save_game_to_file)(request, game.get_state_for_savefile())
         return redirect(reverse("bmovie:chat"))
 
     messages_for_template = [msg for msg in game.messages if msg.get("role") != "system"]
     context = {
         'messages_log': messages_for_template,
         'username': request.user.username if request.user.is_authenticated else 'Giocatore',
+        'turn_key': idempotency.new_key(),
         'hp': game.hp,
         'inventario': game.inventory,
         'objective': game.current_objective,
@@ -301,45 +420,68 @@ def chat_view(request):
     # RIMOSSO 'level' dal contesto
     return render(request, "bmovie/chat.html", context)
 
+@require_POST
+@rate_limited(GAME_ID, "chat")
+async def chat_stream(request):
+    """Variante in streaming della chat: i token del DM arrivano al browser come Server-Sent Events."""
+    await aload_request_state(request)
+    game = await GameManager.aload(request)
+    user_input = request.POST.get("user_input", "").strip()
+    if not game.is_initialized() or not user_input:
+        return JsonResponse({"error": "Turno non valido."}, status=400)
+
+    turn = idempotency.Turn(request, GAME_ID)
+    if not await turn.claim():
+        # Stesso invio ripetuto: riceve gli eventi del turno originale
+        return sse_response(turn.replay())
+
+    async def events():
+        async for event in play_turn(request, game, user_input):
+            yield event
+        # La risposta è già partita: la partita va salvata qui, prima degli ultimi eventi
+        if not await game.asave(request):
+            # Turno scartato per un conflitto: i doppioni non devono riceverlo come concluso
+            await turn.abandon()
+        # I turni vecchi si riassumono in background, dopo il salvataggio
+        await memory.asummarize_later(request, game, MODEL, extra_headers={"X-Title": "BMovie RPG"})
+        # Il file con la cronologia completa si scrive a intervalli, non a ogni turno
+        if await asnapshot_due(request, GameManager):
+            await sync_to_async(save_game_to_file)(request, game.get_state_for_savefile())
+        yield "state", game.get_public_state()
+        for event in notice_events(request):
+            yield event
+        yield "done", {}
+
+    return sse_response(turn.record(events()))
+
 def parse_ai_reply(request, reply, game):
     """Esegue il parsing della risposta dell'AI e aggiorna lo stato del gioco."""
-    
-    # Parsing HP (invariato)
-    hp_status_match = re.search(r"(?:Punti ferita|HP) attuali:\s*(\d+)", reply, re.IGNORECASE)
-    if hp_status_match:
-        new_hp = int(hp_status_match.group(1))
-        game.hp = min(new_hp, game.max_hp)
-    else:
-        damage_match = re.search(r"Hai perso\s+(\d+)\s+punti ferita", reply, re.IGNORECASE)
-        if damage_match: game.take_damage(int(damage_match.group(1)))
-        heal_match = re.search(r"Hai guarito\s+(\d+)\s+punti ferita", reply, re.IGNORECASE)
-        if heal_match: game.heal_damage(int(heal_match.group(1)))
+    apply_reply_state(request, parse_reply(reply), game)
+
+def apply_reply_state(request, parsed, game):
+    """Applica allo stato del gioco i cambiamenti estratti dalla risposta (da regex o da JSON)."""
+    # Parsing HP: lo stato assoluto, se presente, esclude danni e guarigioni
+    if parsed.hp is not None:
+        game.hp = min(parsed.hp, game.max_hp)
+    if parsed.damage is not None: game.take_damage(parsed.damage)
+    if parsed.heal is not None: game.heal_damage(parsed.heal)
             
-    # Parsing oggetti raccolti (invariato)
-    collected_match = re.search(r"Hai raccolto:?\s*(.*?)\.", reply, re.IGNORECASE)
-    if collected_match:
-        items = [item.strip() for item in collected_match.group(1).split('*') if item.strip()]
-        for item in items:
-            message = game.add_to_inventory(item)
-            if message: flash.add_message(request, flash.INFO, message)
+    # Parsing oggetti raccolti
+    for item in parsed.items:
+        message = game.add_to_inventory(item)
+        if message: flash.add_message(request, flash.INFO, message)
 
     # Parsing Obiettivo
-    obj_match = re.search(r"\[OBJECTIVE\]\s*(.*)", reply, re.IGNORECASE)
-    if obj_match:
-        new_objective = obj_match.group(1).strip()
-        game.current_objective = new_objective
-        flash.add_message(request, flash.INFO, f"🎯 Nuovo obiettivo: {new_objective}")
+    if parsed.objective is not None:
+        game.current_objective = parsed.objective
+        flash.add_message(request, flash.INFO, f"🎯 Nuovo obiettivo: {parsed.objective}")
         # RIMOSSA la chiamata a increment_objective_and_check_levelup
 
+@rate_limited(GAME_ID, "reset", methods=None, redirect_to="bmovie:chat")
 def reset_session(request):
     """Pulisce la sessione di gioco e reindirizza alla chat."""
-    keys_to_clear = [
-        SESSION_MESSAGES, SESSION_HP, SESSION_INVENTORY, SESSION_STATS,
-        SESSION_CURRENT_OBJECTIVE, SESSION_MAX_HP
-    ]
-    # RIMOSSE le chiavi di sessione non più usate
-    for key in keys_to_clear:
-        request.session.pop(key, None)
+    # I turni ancora in corso sulla vecchia partita non devono sovrascrivere quella nuova
+    clear_saved(request, GameManager)
     
     flash.add_message(request, flash.INFO, "Una nuova, folle avventura ha inizio!")
     return redirect(reverse("bmovie:chat"))
@@ -361,12 +503,17 @@ def load_game_session(request, filename):
     # ... Logica di controllo utente ...
     session_data = load_game_from_file(filename)
     if session_data:
-        request.session[SESSION_MESSAGES] = session_data.get("messages", [])
-        request.session[SESSION_HP] = session_data.get("hp", STARTING_HP)
-        request.session[SESSION_MAX_HP] = session_data.get("max_hp", STARTING_HP)
-        request.session[SESSION_INVENTORY] = session_data.get("inventario", [])
-        request.session[SESSION_STATS] = session_data.get("stats", INITIAL_STATS)
-        request.session[SESSION_CURRENT_OBJECTIVE] = session_data.get("objective", "")
+        saved = {
+            SESSION_MESSAGES: session_data.get("messages", []),
+            SESSION_HP: session_data.get("hp", STARTING_HP),
+            SESSION_MAX_HP: session_data.get("max_hp", STARTING_HP),
+            SESSION_INVENTORY: session_data.get("inventario", []),
+            SESSION_STATS: session_data.get("stats", INITIAL_STATS),
+            SESSION_CURRENT_OBJECTIVE: session_data.get("objective", ""),
+            SESSION_SUMMARY: session_data.get("summary", ""),
+            SESSION_SUMMARY_UPTO: session_data.get("summary_upto", 0),
+        }
+        replace_saved(request, GameManager, saved)
         # RIMOSSO il caricamento di level e objectives_completed
         flash.add_message(request, flash.SUCCESS, f"Partita '{filename}' caricata con successo!")
     else:
@@ -376,14 +523,8 @@ def load_game_session(request, filename):
 # Endpoint API semplificato
 def get_game_state(request):
     """Endpoint API per ottenere lo stato corrente del gioco."""
-    game = GameManager(request.session)
+    game = GameManager.load(request)
     if not game.is_initialized():
         return JsonResponse({"error": "Sessione non inizializzata"}, status=404)
-    return JsonResponse({
-        'hp': game.hp,
-        'inventario': game.inventory,
-        'objective': game.current_objective,
-        'stats': game.stats,
-        'game_over': game.hp <= 0,
-    })
+    return JsonResponse(game.get_public_state())
     # RIMOSSO 'level' dal JSON di risposta
\ No newline at end of file
@@ -3,6 +3,11 @@ ASGI config for rpgAI project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+This is the production entry point (gunicorn with uvicorn workers, see
+deployment/gunicorn.service): the chat views are async, so a single worker
+can keep many turns in flight while waiting for the LLM. The lifespan wrapper
+binds the pooled LLM client to the server's event loop and closes it on shutdown.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -13,4 +18,8 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from core.llm import asgi_lifespan  # noqa: E402  (dopo il setup di Django)
+
+application = asgi_lifespan(django_application)
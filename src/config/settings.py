@@ -58,6 +58,7 @@ INSTALLED_APPS = [
     'hackergame',
     'users.apps.UsersConfig',
     'ade',
+    'core',
 
     'django.contrib.sites',
     'django.contrib.sitemaps',
@@ -100,6 +101,9 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'config.wsgi.application'
 
+# Entry point di produzione: le viste di gioco sono asincrone (vedi deployment/gunicorn.service)
+ASGI_APPLICATION = 'config.asgi.application'
+
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
@@ -111,6 +115,18 @@ DATABASES = {
     }
 }
 
+# Cache condivisa tra i worker di gunicorn: limiti di frequenza, turni doppi, posti
+# globali e lucchetti devono valere per tutti i processi. Con la cache locale di
+# default ogni worker avrebbe la sua (vedi il controllo in core/checks.py).
+# La tabella si crea con `manage.py createcachetable`; in produzione meglio Redis:
+# CACHE_BACKEND=django.core.cache.backends.redis.RedisCache, CACHE_LOCATION=redis://127.0.0.1:6379
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': config('CACHE_LOCATION', default='django_cache'),
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -172,3 +188,205 @@ EMAIL_USE_TLS = True
 #EMAIL_HOST_PASSWORD = "EMAIL_HOST_PASSWORD" #https://myaccount.google.com/apppasswords
 DEFAULT_FROM_EMAIL = f"thedungeon.ai - <{EMAIL_HOST_USER}>"
 SIGNALS_DEFAULT_FROM_EMAIL = DEFAULT_FROM_EMAIL
+
+
+# --- LLM (OpenRouter) ---
+# Client condiviso in core/llm.py: un solo pool di connessioni keep-alive per processo.
+
+LLM_API_URL = config("LLM_API_URL", default="https://openrouter.ai/api/v1/")
+LLM_API_KEY = config("API_KEY")
+
+LLM_HTTP_POOL = {
+    # Sotto ASGI un solo worker tiene molti turni in volo: il pool deve poterli servire tutti
+    "max_connections": config("LLM_POOL_MAX_CONNECTIONS", default=200, cast=int),
+    "max_keepalive_connections": config("LLM_POOL_MAX_KEEPALIVE", default=50, cast=int),
+    "keepalive_expiry": 60.0,  # secondi di inattività prima di chiudere una connessione
+}
+
+# Timeout (secondi) del client HTTP; il timeout di lettura del singolo modello è in LLM_MODELS
+LLM_TIMEOUTS = {
+    "connect": 5.0,
+    "read": 60.0,
+    "write": 10.0,
+    "pool": 5.0,
+}
+
+LLM_DEFAULT_HEADERS = {
+    "HTTP-Referer": "http://localhost",  # Optional. Site URL for rankings on openrouter.ai.
+}
+
+# Parametri di default per ogni modello, sovrascrivibili dal chiamante
+LLM_MODELS = {
+    "google/gemini-2.0-flash-001": {
+        "timeout": 30,
+    },
+    "anthropic/claude-3-sonnet": {
+        "timeout": 60,
+    },
+}
+
+# Ritentativi, scadenza del turno e circuit breaker delle chiamate al modello (core/resilience.py)
+LLM_RESILIENCE = {
+    "max_attempts": 3,        # tentativi per chiamata, solo per errori transitori (rete, 429, 5xx)
+    "backoff_base": 0.5,      # secondi; l'attesa cresce esponenzialmente con jitter
+    "backoff_cap": 4.0,
+    "turn_deadline": config("LLM_TURN_DEADLINE", default=90.0, cast=float),  # secondi per turno, tutte le chiamate comprese
+    "breaker_failures": 5,    # errori consecutivi che aprono il circuito di un modello
+    "breaker_cooldown": 30.0, # secondi di fallimento immediato prima della chiamata di prova
+}
+
+# Richieste duplicate sul modello di riserva quando il primo token tarda (core/hedging.py)
+LLM_HEDGING = {
+    "percentile": 95,       # si duplica oltre questo percentile del tempo al primo token del modello
+    "default_delay": 4.0,   # secondi, finché non ci sono abbastanza campioni
+    "min_delay": 1.0,       # mai prima di così, per non raddoppiare i costi nei momenti normali
+}
+
+# Limitazione della frequenza per giocatore (core/ratelimit.py): secchielli di `capacity`
+# richieste che si ricaricano di `per_minute` al minuto. Per utente, o per IP se anonimo.
+RATE_LIMITS = {
+    "default": {
+        "chat": {"capacity": 8, "per_minute": 10},   # ogni POST alla chat costa una chiamata al modello
+        "reset": {"capacity": 3, "per_minute": 2},
+    },
+    "ade": {
+        "chat": {"capacity": 6, "per_minute": 6},    # scene chiave sul modello premium
+    },
+}
+
+# Invio idempotente dei turni (core/idempotency.py): i doppi invii con la stessa `turn_key`
+# attendono il turno già avviato invece di chiamare di nuovo il modello
+TURN_IDEMPOTENCY = {
+    "ttl": 600,           # secondi per cui un turno concluso resta riconoscibile
+    "wait": LLM_RESILIENCE["turn_deadline"] + 30.0,  # attesa massima di un doppione sul turno originale
+    "poll": 0.25,         # secondi tra un controllo e l'altro della cache
+}
+
+# Cronologia delle partite salvate nel database (core/history.py): a ogni turno si caricano
+# il prompt di sistema e solo la finestra di messaggi che serve
+GAME_HISTORY = {
+    "recent_messages": 60,  # messaggi recenti caricati sempre (quelli mostrati nella chat)
+    "max_window": 300,      # messaggi caricati al massimo, anche se non ancora riassunti
+    "snapshot_interval": 600,  # secondi minimi tra due file di salvataggio della stessa partita
+}
+
+# Controllo di ammissione dei turni AI, per worker (core/admission.py)
+LLM_ADMISSION = {
+    "max_concurrent": config("LLM_MAX_CONCURRENT_TURNS", default=100, cast=int),
+    "per_user": 1,        # turni AI contemporanei per giocatore: gli invii a raffica aspettano il proprio turno
+    "max_queue": config("LLM_MAX_QUEUED_TURNS", default=200, cast=int),
+    "max_wait": 15.0,     # secondi di attesa massima in coda prima di rispondere "DM occupato"
+    # Limite tra tutti i processi (richiede una cache condivisa come Redis); None = disattivato
+    "global_max": config("LLM_GLOBAL_MAX_TURNS", default=None, cast=lambda v: int(v) if v else None),
+    "global_ttl": 300,    # secondi di vita di un posto condiviso: più della durata massima di un turno
+    "global_poll": 0.2,   # secondi tra un tentativo e l'altro sui posti condivisi
+}
+
+# Degrado controllato sotto carico (core/brownout.py). Il livello N scatta quando le richieste
+# in corso nel processo arrivano a inflight[N-1] o il p90 del tempo al primo token a latency[N-1]
+LLM_BROWNOUT = {
+    "inflight": [
+        config("LLM_BROWNOUT_INFLIGHT_1", default=40, cast=int),
+        config("LLM_BROWNOUT_INFLIGHT_2", default=80, cast=int),
+        config("LLM_BROWNOUT_INFLIGHT_3", default=150, cast=int),
+    ],
+    "latency": [6.0, 12.0, 20.0],  # secondi
+    "window": 60.0,     # secondi di campioni di latenza considerati
+    "recovery": 20.0,   # secondi di carico più basso prima di scendere di livello
+    "levels": [
+        {},
+        {"max_tokens": 800, "context_ratio": 0.75},
+        {"max_tokens": 500, "context_ratio": 0.5, "skip_optional": True},
+        {"max_tokens": 350, "context_ratio": 0.35, "skip_optional": True, "fast_model": "google/gemini-2.0-flash-001"},
+    ],
+}
+
+# Prezzi dei modelli in dollari per milione di token, per stimare il costo dei turni
+LLM_PRICES = {
+    "google/gemini-2.0-flash-001": {"prompt": 0.10, "completion": 0.40},
+    "anthropic/claude-3-sonnet": {"prompt": 3.00, "completion": 15.00},
+}
+
+# Classificazione dei turni per scegliere la fascia di modello (core/routing.py)
+LLM_ROUTING = {
+    "key_score": 2,            # punteggio da cui il turno va al modello premium
+    "long_input_chars": 160,   # un messaggio lungo vale un punto
+    "high_level": 3,           # da questo livello in su le scene pesano di più
+    "low_hp_ratio": 0.3,       # HP sotto questa frazione del massimo: scena tesa
+    "recent_messages": 6,      # messaggi in cui cercare strumenti usati di recente
+}
+
+# Modelli a cui inviare i punti di cache (cache_control) sul prefisso stabile del prompt:
+# prompt di sistema e schemi degli strumenti vengono letti dalla cache del provider
+LLM_PROMPT_CACHE_MODELS = [
+    "anthropic/claude-3-sonnet",
+]
+
+# Riassunto progressivo dei turni vecchi (core/memory.py)
+LLM_MEMORY = {
+    "trigger_messages": 40,   # messaggi non riassunti oltre cui si piega la cronologia
+    "trigger_tokens": 8000,   # ...oppure token stimati oltre cui si piega
+    "keep_recent": 16,        # messaggi recenti inviati sempre alla lettera
+    "model": "google/gemini-2.0-flash-001",  # modello economico per i riassunti (None = quello del gioco)
+    "max_tokens": 600,
+    "fold_lock": 120,         # secondi in cui un riassunto in background esclude gli altri sulla stessa partita
+}
+
+# Budget di token del prompt per modello (core/context.py): oltre il budget i turni
+# vecchi vengono prima accorciati e poi scartati
+LLM_CONTEXT = {
+    "default_budget": 8000,
+    "budgets": {
+        "google/gemini-2.0-flash-001": 16000,
+        "anthropic/claude-3-sonnet": 12000,
+    },
+    "condense_chars": 400,  # lunghezza massima delle risposte del DM nei turni condensati
+}
+
+# Pool di scene d'apertura pre-generate (core/openings.py, comando warm_openings)
+LLM_OPENINGS = {
+    "target_depth": config("LLM_OPENINGS_DEPTH", default=5, cast=int),  # scene pronte per gioco
+    "games": {
+        "blamPunk": "blamPunk.views",
+        "bmovie": "bmovie.views",
+        "hackergame": "hackergame.views",
+        "ade": "ade.views",
+    },
+}
+
+# Impostazioni per gioco, indicizzate con il GAME_ID delle app
+LLM_GAMES = {
+    "blamPunk": {
+        # Il DM risponde in JSON (narrazione + cambiamenti di stato) invece che con frasi magiche
+        "structured_output": config("BLAMPUNK_STRUCTURED_OUTPUT", default=False, cast=bool),
+        # Modelli di riserva, in ordine, se il principale fallisce (core/hedging.py)
+        "fallbacks": config("BLAMPUNK_FALLBACKS", default="", cast=Csv()),
+        # Duplica la richiesta sul primo modello di riserva se il primo token tarda
+        "hedge": config("BLAMPUNK_HEDGE", default=False, cast=bool),
+    },
+    "bmovie": {
+        "structured_output": config("BMOVIE_STRUCTURED_OUTPUT", default=False, cast=bool),
+        "fallbacks": config("BMOVIE_FALLBACKS", default="", cast=Csv()),
+        "hedge": config("BMOVIE_HEDGE", default=False, cast=bool),
+    },
+    "hackergame": {
+        "structured_output": config("HACKERGAME_STRUCTURED_OUTPUT", default=False, cast=bool),
+        "fallbacks": config("HACKERGAME_FALLBACKS", default="", cast=Csv()),
+        "hedge": config("HACKERGAME_HEDGE", default=False, cast=bool),
+    },
+    "ade": {
+        # Usa già il tool calling: la narrazione arriva insieme alle chiamate agli strumenti
+        # e la seconda chiamata si fa solo se manca
+        "single_round_trip": config("ADE_SINGLE_ROUND_TRIP", default=True, cast=bool),
+        # Le riserve devono supportare il tool calling
+        "fallbacks": config("ADE_FALLBACKS", default="", cast=Csv()),
+        "hedge": config("ADE_HEDGE", default=False, cast=bool),
+        # Modello per fascia di turno: quelli di routine vanno al modello economico.
+        # Spento finché `routing.cache_hit_rate` non mostra che cambiare modello tra un turno
+        # e l'altro non fa perdere la cache del prefisso sul modello premium
+        "tiers": {
+            "routine": config("ADE_ROUTINE_MODEL", default="google/gemini-2.0-flash-001"),
+            "key": "anthropic/claude-3-sonnet",
+        } if config("ADE_ROUTING", default=False, cast=bool) else None,
+    },
+}
@@ -40,6 +40,7 @@ urlpatterns = [
     path('bmovie/', include('bmovie.urls', namespace="bmovie")),
     path('hacker-game/', include('hackergame.urls', namespace="hackergame")),
     path('ade/', include('ade.urls', namespace="ade")),
+    path('core/', include('core.urls', namespace="core")),
     path('', include('home.urls', namespace="home")),
     path("privacy/", TemplateView.as_view(template_name="privacy-policy.html"), name="privacy"),
     path('accounts/', include('django.contrib.auth.urls')),
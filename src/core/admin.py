@@ -0,0 +1,17 @@
+from django.contrib import admin
+
+from core.models import Game, OpeningScene
+
+
+# Register your models here.
+@admin.register(OpeningScene)
+class OpeningSceneAdmin(admin.ModelAdmin):
+    list_display = ("game", "model", "created_at")
+    list_filter = ("game",)
+
+
+@admin.register(Game)
+class GameAdmin(admin.ModelAdmin):
+    list_display = ("game", "user", "version", "message_count", "updated_at")
+    list_filter = ("game",)
+    list_select_related = ("user",)
@@ -0,0 +1,205 @@
+"""
+Controllo di ammissione dei turni che chiamano il modello.
+
+Ogni worker accetta al massimo `LLM_ADMISSION["max_concurrent"]` turni AI
+contemporanei e al massimo `per_user` per giocatore. Gli altri aspettano in una
+coda equa: i giocatori in attesa vengono serviti a turno (round robin), quindi
+chi invia il form a raffica non scavalca gli altri. L'attesa è limitata
+(`max_wait`) e la coda ha una lunghezza massima (`max_queue`): oltre, il turno
+viene rifiutato subito con un messaggio "il DM è occupato" invece di accumulare
+latenza.
+
+Con `global_max` il limite vale anche tra processi diversi, tramite `global_max`
+posti nella cache di Django (serve una cache condivisa, es. Redis). Ogni posto è
+una chiave con la sua scadenza: un processo terminato a metà turno libera il suo
+posto da solo, senza falsare il conteggio degli altri.
+
+Metriche: `admission.wait` (secondi di attesa in coda), `admission.rejected.<motivo>`,
+indicatori `admission.active` e `admission.waiting`.
+"""
+
+import asyncio
+import logging
+import random
+import time
+import uuid
+import weakref
+from collections import OrderedDict, defaultdict, deque
+
+from django.conf import settings
+from django.contrib import messages as flash
+from django.core.cache import cache
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+BUSY_MESSAGE = "🎲 Il DM è sommerso di giocatori in questo momento. Riprova tra qualche secondo."
+GLOBAL_SLOT_KEY = "admission:slot:{}"
+
+
+class Busy(Exception):
+    """Il turno non è stato ammesso: coda piena o attesa troppo lunga. L'argomento è il motivo."""
+
+
+class FairQueue:
+    """Semaforo con coda equa per giocatore, legato a un event loop."""
+
+    def __init__(self, capacity, per_user, max_queue):
+        self.capacity = capacity
+        self.per_user = per_user
+        self.max_queue = max_queue
+        self.active = 0
+        self._by_user = defaultdict(int)  # posti occupati da ogni giocatore
+        self._waiting = OrderedDict()     # giocatore -> future in attesa, nell'ordine in cui servirli
+
+    @property
+    def waiting(self):
+        return sum(len(queue) for queue in self._waiting.values())
+
+    def _update_gauges(self):
+        metrics.set_gauge("admission.active", self.active)
+        metrics.set_gauge("admission.waiting", self.waiting)
+
+    def _grant(self, user):
+        self.active += 1
+        self._by_user[user] += 1
+
+    def _remove(self, user, future):
+        queue = self._waiting.get(user)
+        if queue and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self._waiting[user]
+
+    def _dispatch(self):
+        """Assegna i posti liberi ai giocatori in coda, uno per giocatore a ogni giro."""
+        for user in list(self._waiting):
+            if self.active >= self.capacity:
+                break
+            if self._by_user[user] >= self.per_user:
+                continue
+            queue = self._waiting.pop(user)
+            future = queue.popleft()
+            if queue:
+                self._waiting[user] = queue  # Torna in fondo: gli altri passano prima
+            self._grant(user)
+            future.set_result(None)
+
+    async def acquire(self, user, timeout):
+        """Attende un posto per `user`; solleva `Busy` se la coda è piena o l'attesa scade."""
+        if user not in self._waiting and self.active < self.capacity and self._by_user[user] < self.per_user:
+            self._grant(user)
+            self._update_gauges()
+            return
+        if self.waiting >= self.max_queue:
+            raise Busy("coda_piena")
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user, deque()).append(future)
+        self._update_gauges()
+        try:
+            await asyncio.wait_for(future, timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                self.release(user)  # Posto assegnato proprio mentre si rinunciava
+            else:
+                self._remove(user, future)
+            if isinstance(e, asyncio.TimeoutError):
+                raise Busy("attesa_scaduta") from None
+            raise
+        finally:
+            self._update_gauges()
+
+    def release(self, user):
+        self.active -= 1
+        self._by_user[user] -= 1
+        if not self._by_user[user]:
+            del self._by_user[user]
+        self._dispatch()
+        self._update_gauges()
+
+
+# Una coda per event loop, come i client HTTP in core/llm.py
+_queues = weakref.WeakKeyDictionary()
+
+
+def _queue():
+    loop = asyncio.get_running_loop()
+    queue = _queues.get(loop)
+    if queue is None:
+        options = settings.LLM_ADMISSION
+        queue = FairQueue(options["max_concurrent"], options["per_user"], options["max_queue"])
+        _queues[loop] = queue
+    return queue
+
+
+def user_key(request):
+    """Chiave della coda: l'utente autenticato o, in mancanza, la sessione."""
+    if request.user.is_authenticated:
+        return f"user:{request.user.pk}"
+    return f"session:{request.session.session_key}"
+
+
+async def _acquire_global(deadline):
+    """
+    Prende uno dei posti condivisi tra processi, riprovando fino a `deadline`.
+    Restituisce `(chiave, gettone)` del posto, da passare a `_release_global`.
+    """
+    options = settings.LLM_ADMISSION
+    slots = [GLOBAL_SLOT_KEY.format(index) for index in range(options["global_max"])]
+    token = uuid.uuid4().hex
+    while True:
+        taken = await cache.aget_many(slots)
+        free = [slot for slot in slots if slot not in taken]
+        random.shuffle(free)  # Processi diversi non si contendono tutti il primo posto libero
+        for slot in free:
+            # Il posto scade da solo: un processo terminato a metà turno non lo blocca per sempre
+            if await cache.aadd(slot, token, timeout=options["global_ttl"]):
+                return slot, token
+        if time.monotonic() >= deadline:
+            raise Busy("limite_globale")
+        await asyncio.sleep(options["global_poll"])
+
+
+async def _release_global(slot, token):
+    # Solo se il posto è ancora nostro: se è scaduto potrebbe averlo preso un altro turno
+    if await cache.aget(slot) == token:
+        await cache.adelete(slot)
+
+
+async def admitted(request, events):
+    """
+    Esegue il turno `events` dopo aver ottenuto un posto. Se il turno non viene
+    ammesso il giocatore riceve un avviso e il suo messaggio non viene registrato,
+    così può semplicemente reinviarlo.
+    """
+    options = settings.LLM_ADMISSION
+    user = user_key(request)
+    queue = _queue()
+    started = time.monotonic()
+    global_slot = None
+    try:
+        await queue.acquire(user, options["max_wait"])
+        try:
+            if options.get("global_max"):
+                global_slot = await _acquire_global(started + options["max_wait"])
+        except BaseException:
+            queue.release(user)
+            raise
+    except Busy as e:
+        metrics.incr(f"admission.rejected.{e}")
+        logger.warning(f"Turno di {user} non ammesso: {e}")
+        flash.warning(request, BUSY_MESSAGE)
+        await events.aclose()
+        return
+    metrics.observe("admission.wait", time.monotonic() - started)
+
+    try:
+        async for event in events:
+            yield event
+    finally:
+        await events.aclose()
+        if global_slot is not None:
+            await _release_global(*global_slot)
+        queue.release(user)
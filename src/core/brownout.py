@@ -0,0 +1,119 @@
+"""
+Modalità "brownout": degrado controllato sotto carico.
+
+Quando molti giocatori sono a metà turno, chiedere a tutti una narrazione
+completa al modello più lento fa crollare la latenza di ognuno. Il controllore
+osserva le richieste al modello in corso nel processo e il tempo al primo token
+recente, e ne ricava un livello da 0 (normale) a 3. Ogni livello, configurato in
+`LLM_BROWNOUT["levels"]`, può:
+-   abbassare `max_tokens` (`max_tokens`);
+-   ridurre il budget del contesto (`context_ratio`);
+-   saltare le chiamate facoltative: seconda chiamata di ade e riassunto (`skip_optional`);
+-   passare a un modello più veloce (`fast_model`).
+
+Il livello sale subito, ma scende solo dopo `recovery` secondi di carico più
+basso, per non oscillare. Livello e richieste in corso sono negli indicatori
+`brownout.level` e `brownout.inflight`.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_inflight = 0
+_ttft = deque(maxlen=metrics.SAMPLE_SIZE)  # coppie (istante, secondi al primo token)
+_level = 0
+_calm_since = None
+
+
+def request_started():
+    global _inflight
+    with _lock:
+        _inflight += 1
+        metrics.set_gauge("brownout.inflight", _inflight)
+
+
+def request_finished():
+    global _inflight
+    with _lock:
+        _inflight = max(0, _inflight - 1)
+        metrics.set_gauge("brownout.inflight", _inflight)
+
+
+def observe_ttft(seconds):
+    """Registra il tempo al primo token di una risposta."""
+    with _lock:
+        _ttft.append((time.monotonic(), seconds))
+
+
+def _pressure(now):
+    """Livello giustificato dal carico attuale, senza isteresi."""
+    options = settings.LLM_BROWNOUT
+    recent = sorted(seconds for at, seconds in _ttft if now - at <= options["window"])
+    latency = recent[int(0.9 * (len(recent) - 1))] if recent else 0.0
+    level = 0
+    for index, (inflight, ttft) in enumerate(zip(options["inflight"], options["latency"]), start=1):
+        if _inflight >= inflight or latency >= ttft:
+            level = index
+    return level
+
+
+def level():
+    """Livello di brownout corrente (0 = servizio pieno)."""
+    global _level, _calm_since
+    now = time.monotonic()
+    with _lock:
+        target = _pressure(now)
+        if target >= _level:
+            _calm_since = None
+            if target > _level:
+                logger.warning(f"Brownout: livello {_level} -> {target} ({_inflight} richieste in corso)")
+                _level = target
+        elif _calm_since is None:
+            _calm_since = now
+        elif now - _calm_since >= settings.LLM_BROWNOUT["recovery"]:
+            logger.info(f"Brownout: livello {_level} -> {target}")
+            _level = target
+            _calm_since = None
+        metrics.set_gauge("brownout.level", _level)
+        return _level
+
+
+def policy():
+    """Impostazioni di degrado del livello corrente."""
+    return settings.LLM_BROWNOUT["levels"][level()]
+
+
+def skip_optional(call):
+    """Vero se la chiamata facoltativa `call` va saltata per alleggerire il carico."""
+    if policy().get("skip_optional"):
+        metrics.incr(f"brownout.skipped.{call}")
+        return True
+    return False
+
+
+def context_ratio():
+    """Frazione del budget di contesto utilizzabile al livello corrente."""
+    return policy().get("context_ratio", 1.0)
+
+
+def adjust(model, kwargs):
+    """
+    Applica il livello corrente a una chiamata: restituisce il modello da usare e
+    i parametri con `max_tokens` limitato.
+    """
+    current = policy()
+    if current.get("fast_model"):
+        model = current["fast_model"]
+    cap = current.get("max_tokens")
+    if cap:
+        kwargs = {**kwargs, "max_tokens": min(kwargs.get("max_tokens", cap), cap)}
+    return model, kwargs
@@ -0,0 +1,30 @@
+"""Controlli di sistema di Django (`manage.py check`, eseguiti anche all'avvio)."""
+
+from django.conf import settings
+from django.core.checks import Warning, register
+
+PROCESS_LOCAL_CACHES = {
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+}
+
+
+@register()
+def shared_cache_check(app_configs, **kwargs):
+    """
+    Limiti di frequenza, turni doppi e posti globali passano dalla cache: se è
+    locale al processo, con più worker ognuno applica i limiti per conto suo.
+    """
+    backend = settings.CACHES["default"]["BACKEND"]
+    if backend not in PROCESS_LOCAL_CACHES or settings.DEBUG:
+        return []
+    return [
+        Warning(
+            f"La cache predefinita ({backend}) non è condivisa tra i processi.",
+            hint=(
+                "Con più worker i limiti di frequenza valgono per worker e i turni inviati due volte "
+                "non vengono riconosciuti: usa DatabaseCache o Redis (CACHES in config/settings.py)."
+            ),
+            id="core.W001",
+        )
+    ]
@@ -0,0 +1,138 @@
+"""
+Assemblaggio del prompt entro un budget di token per modello.
+
+Ogni turno il prompt viene costruito così:
+    [prompt di sistema] + [STORIA FINORA] + [turni recenti] + [messaggi di coda]
+e ne viene misurata la dimensione con il conteggio locale di `core/tokens.py`.
+Se supera il budget del modello (`LLM_CONTEXT`), si sacrifica prima il
+contenuto meno importante:
+    1. le risposte lunghe del DM nei turni vecchi vengono accorciate,
+       partendo dal turno più vecchio;
+    2. se non basta, i turni vecchi vengono scartati, sempre dal più vecchio.
+Prompt di sistema, riassunto, ultimo turno e messaggi di coda (es. il
+[CONTESTO PARTITA]) vengono inviati sempre.
+
+Per i modelli con cache del prompt lato provider (`LLM_PROMPT_CACHE_MODELS`)
+il prompt di sistema e il riassunto ricevono un punto di cache (`cache_control`):
+insieme agli strumenti, che il provider mette sempre davanti, formano un prefisso
+identico byte per byte da un turno all'altro e vengono letti dalla cache.
+"""
+
+import logging
+
+from django.conf import settings
+
+from core import brownout, llm, memory, metrics, tokens
+from core.history import first_loaded
+
+logger = logging.getLogger(__name__)
+
+# Campi dei messaggi accettati dall'API: il resto (es. il conteggio `tokens`) resta locale
+API_FIELDS = ("role", "content", "name", "tool_calls", "tool_call_id")
+
+
+def model_budget(model):
+    """Budget di token del prompt per il modello indicato, ridotto in brownout."""
+    options = settings.LLM_CONTEXT
+    return int(options["budgets"].get(model, options["default_budget"]) * brownout.context_ratio())
+
+
+def _clean(msg):
+    return {key: value for key, value in msg.items() if key in API_FIELDS}
+
+
+def _split_turns(history):
+    """Divide la cronologia in turni, ognuno aperto da un messaggio del giocatore."""
+    turns = []
+    for index, msg in enumerate(history):
+        if not turns or memory.starts_turn(history, index):
+            turns.append([])
+        turns[-1].append(msg)
+    return turns
+
+
+def _condense(turn, limit):
+    """Copia del turno con le risposte del DM più lunghe di `limit` caratteri accorciate."""
+    condensed = []
+    for msg in turn:
+        content = msg.get("content") or ""
+        if msg.get("role") == "assistant" and len(content) > limit:
+            msg = {**_clean(msg), "content": content[:limit].rstrip() + " […]"}
+        condensed.append(msg)
+    return condensed
+
+
+def _cache_breakpoint(msg):
+    """Copia del messaggio con il contenuto marcato come fine di un prefisso da mettere in cache."""
+    return {
+        **msg,
+        "content": [{"type": "text", "text": msg["content"], "cache_control": {"type": "ephemeral"}}],
+    }
+
+
+def build_prompt(game, model, tail=(), tools=None):
+    """
+    Restituisce i messaggi da inviare a `model` per la partita `game`, adattati
+    al budget. `tail` sono messaggi da aggiungere in coda (non salvati in cronologia),
+    `tools` gli schemi degli strumenti inviati con la richiesta, che contano nel budget.
+    """
+    head = game.messages[:1]
+    summary = memory.summary_message(game)
+    if summary:
+        head.append(summary)
+    tail = list(tail)
+
+    # I messaggi non riassunti prima della finestra caricata restano fuori: sono i più
+    # vecchi, quelli che il budget scarterebbe per primi, e il prossimo riassunto li recupera
+    start = max(memory.first_unsummarized(game), first_loaded(game.messages))
+    # I turni risolti dal motore di regole locale non riguardano il modello
+    history = [msg for msg in game.messages[start:] if not msg.get("local")]
+    older = _split_turns(history)
+    last = older.pop() if older else []
+
+    budget = model_budget(model)
+    older_tokens = [tokens.messages_tokens(turn) for turn in older]
+    used = (
+        tokens.messages_tokens(head) + tokens.messages_tokens(last) + tokens.messages_tokens(tail)
+        + tokens.tools_tokens(tools) + sum(older_tokens)
+    )
+
+    # 1. Accorcia le risposte dei turni vecchi, dal più vecchio
+    condensed = 0
+    limit = settings.LLM_CONTEXT["condense_chars"]
+    for index, turn in enumerate(older):
+        if used <= budget:
+            break
+        short = _condense(turn, limit)
+        saved = older_tokens[index] - tokens.messages_tokens(short)
+        if saved > 0:
+            older[index] = short
+            older_tokens[index] -= saved
+            used -= saved
+            condensed += 1
+
+    # 2. Scarta i turni vecchi finché il prompt non rientra nel budget
+    dropped = 0
+    while older and used > budget:
+        used -= older_tokens.pop(0)
+        older.pop(0)
+        dropped += 1
+
+    messages = head + [msg for turn in older for msg in turn] + last + tail
+    if used > budget:
+        logger.warning(f"Prompt oltre il budget anche dopo i tagli: {used}/{budget} token ({model})")
+    logger.info(
+        f"Contesto {model}: {used}/{budget} token, {len(messages)} messaggi "
+        f"({condensed} turni condensati, {dropped} scartati)"
+    )
+    metrics.observe("context.prompt_tokens", used)
+    metrics.observe("context.budget_used_pct", round(100 * used / budget, 1))
+    metrics.incr("context.turns_condensed", condensed)
+    metrics.incr("context.turns_dropped", dropped)
+
+    messages = [_clean(msg) for msg in messages]
+    if llm.supports_prompt_cache(model):
+        # Il prefisso stabile è fatto dai messaggi di testa: sistema ed eventuale riassunto
+        for index in range(len(head)):
+            messages[index] = _cache_breakpoint(messages[index])
+    return messages
@@ -0,0 +1,464 @@
+"""
+Stato di gioco versionato: niente più aggiornamenti persi tra schede e worker.
+
+Prima ogni turno riscriveva per intero lo stato caricato all'inizio della
+richiesta: con due turni contemporanei (due schede, o due worker) il secondo
+salvataggio cancellava in silenzio messaggi e cambiamenti del primo.
+
+Ogni partita ha ora un numero di versione. Il salvataggio è un
+"compare-and-swap": riesce solo se la versione salvata è ancora quella letta
+all'inizio del turno, e la incrementa. Se nel frattempo un'altra richiesta ha
+salvato, i cambiamenti dei due turni vengono fusi rispetto allo stato di
+partenza, campo per campo, secondo le regole di `MERGE_RULES`:
+-   `append`: la cronologia dei messaggi, che cresce solo in coda; i messaggi
+    nuovi di questo turno si accodano a quelli dell'altro;
+-   `add`: valori numerici come gli HP; si sommano le due variazioni;
+-   `multiset`: l'inventario; si applicano oggetti aggiunti e tolti da questo turno;
+-   `counters`: dizionari di valori numerici come le statistiche, chiave per chiave;
+-   `exclusive` (predefinita): vale il valore cambiato; se l'hanno cambiato
+    entrambi i turni in modo diverso la fusione non è possibile.
+Il riassunto della memoria è derivato dalla cronologia: si tiene quello che ne
+copre la parte più lunga, purché valido anche nella cronologia fusa.
+
+Se la fusione non è possibile (es. la partita è stata ricominciata in un'altra
+scheda) il turno viene rifiutato: lo stato torna quello salvato e il giocatore
+riceve un avviso.
+
+Lo stato sta nel modello `Game`, una riga per giocatore e gioco: gli utenti
+autenticati sono identificati dall'utente, gli anonimi da una chiave d'ospite
+nella sessione (`GUEST_KEY`, l'unico dato di gioco rimasto lì). Ogni richiesta
+legge solo la riga del gioco richiesto, e le pagine che non sono di gioco
+caricano una sessione di pochi byte. Ogni salvataggio è un UPDATE delle sole
+colonne cambiate, condizionato sulla versione. La cronologia è nella tabella
+`GameMessage` (core/history.py): si carica solo la finestra che serve e ogni
+turno inserisce solo i suoi messaggi nuovi.
+
+Le partite ancora nella sessione (salvate prima di questo archivio) vengono
+importate alla prima visita del gioco e le loro chiavi rimosse dalla sessione
+dopo il primo salvataggio.
+
+Metriche: `gamestate.saved|merged|rejected.<gioco>`.
+"""
+
+import copy
+import logging
+import uuid
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import messages as flash
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from core import history, metrics
+from core.history import MessageLog
+from core.models import Game, GameMessage
+
+logger = logging.getLogger(__name__)
+
+CONFLICT_MESSAGE = (
+    "⚠️ La partita è stata aggiornata in un'altra scheda e il tuo ultimo turno era in conflitto: "
+    "non è stato salvato. Ricarica la pagina per vedere lo stato attuale."
+)
+MAX_ATTEMPTS = 3    # fusioni consecutive prima di rinunciare
+GUEST_KEY = "guest"  # unica chiave di gioco nella sessione: identifica le partite dei giocatori anonimi
+HISTORY_FIELD = "messages"  # attributo della cronologia, salvata riga per riga in GameMessage
+
+
+class StateConflict(Exception):
+    """I cambiamenti di due turni sullo stesso campo non si possono fondere."""
+
+
+def snapshot(state, rules):
+    """Copia dello stato di partenza, che i cambiamenti del turno non devono toccare."""
+    # La cronologia non viene mai modificata, solo allungata: basta una copia superficiale
+    return {
+        name: value.copy() if rules.get(name) == "append" and value is not None else copy.deepcopy(value)
+        for name, value in state.items()
+    }
+
+
+def _exclusive(name, base, mine, theirs):
+    if mine == base or mine == theirs:
+        return theirs
+    if theirs == base:
+        return mine
+    raise StateConflict(name)
+
+
+def _append(name, base, mine, theirs):
+    extends = theirs.startswith(base) if isinstance(theirs, MessageLog) else theirs[:len(base)] == base
+    if not extends:
+        raise StateConflict(name)  # Cronologia riscritta altrove (nuova partita o caricamento)
+    return theirs + mine[len(base):]
+
+
+def _add(name, base, mine, theirs):
+    return theirs + (mine - base)
+
+
+def _multiset(name, base, mine, theirs):
+    added = Counter(mine) - Counter(base)
+    removed = Counter(base) - Counter(mine)
+    remaining = Counter(theirs) - removed
+    merged = []
+    for item in theirs:
+        if remaining[item] > 0:
+            merged.append(item)
+            remaining[item] -= 1
+    return merged + list(added.elements())
+
+
+def _counters(name, base, mine, theirs):
+    merged = dict(theirs)
+    for key, value in mine.items():
+        before = base.get(key)
+        if value == before:
+            continue
+        if isinstance(value, (int, float)) and isinstance(before, (int, float)) and key in theirs:
+            merged[key] = theirs[key] + (value - before)
+        else:
+            merged[key] = _exclusive(f"{name}.{key}", before, value, theirs.get(key))
+    return merged
+
+
+RULES = {
+    "exclusive": _exclusive,
+    "append": _append,
+    "add": _add,
+    "multiset": _multiset,
+    "counters": _counters,
+}
+
+
+def merge(base, mine, theirs, rules):
+    """
+    Fonde i cambiamenti di questo turno (`mine`) con quelli salvati nel frattempo
+    (`theirs`), rispetto allo stato di partenza comune (`base`). Solleva
+    `StateConflict` se non è possibile.
+    """
+    merged = {}
+    for name, value in mine.items():
+        if name in ("summary", "summary_upto"):
+            continue  # Il riassunto si sceglie sotto, non si fonde campo per campo
+        rule = rules.get(name, "exclusive")
+        if None in (base[name], value, theirs[name]):
+            rule = "exclusive"  # Partita non inizializzata da una delle due parti
+        merged[name] = RULES[rule](name, base[name], value, theirs[name])
+
+    if "summary_upto" in mine:
+        # Vale il riassunto più lungo, ma quello di questo turno solo se copre messaggi
+        # già presenti all'inizio: quelli nuovi nella cronologia fusa cambiano posizione
+        upto = mine["summary_upto"]
+        if theirs["summary_upto"] < upto <= len(base["messages"] or []):
+            merged["summary"], merged["summary_upto"] = mine["summary"], upto
+        else:
+            merged["summary"], merged["summary_upto"] = theirs["summary"], theirs["summary_upto"]
+
+    if merged.get("hp") is not None and merged.get("max_hp") is not None:
+        merged["hp"] = min(merged["hp"], merged["max_hp"])
+    return merged
+
+
+class ModelStore:
+    """
+    Stato salvato in una riga di `Game`, con la cronologia in `GameMessage`. Il
+    compare-and-swap è un UPDATE delle sole colonne cambiate, condizionato sulla
+    versione, più l'INSERT dei messaggi nuovi, nella stessa transazione.
+    """
+
+    def __init__(self, game, owner, row_id):
+        self.game = game
+        self.owner = owner  # filtro del giocatore, da `player()`
+        self.row_id = row_id
+
+    @staticmethod
+    def rows(game_class, owner):
+        return Game.objects.filter(game=game_class.GAME_ID, **owner)
+
+    @staticmethod
+    def columns(game_class):
+        fields = [name for name in game_class.STATE_KEYS if name != HISTORY_FIELD]
+        return [*fields, "version", "message_count"]
+
+    @staticmethod
+    def to_mapping(game_class, row, messages):
+        """Riga -> valori con le chiavi di stato del gioco. Le colonne vuote prendono i valori predefiniti."""
+        if row is None:
+            return {}
+        mapping = {
+            key: getattr(row, name)
+            for name, key in game_class.STATE_KEYS.items()
+            if name != HISTORY_FIELD and getattr(row, name) is not None
+        }
+        if row.message_count:
+            mapping[game_class.STATE_KEYS[HISTORY_FIELD]] = messages
+        mapping[game_class.VERSION_KEY] = row.version
+        return mapping
+
+    @classmethod
+    def build(cls, game_class, owner, row, messages):
+        game = game_class(cls.to_mapping(game_class, row, messages))
+        game.store = cls(game, owner, row.pk if row else None)
+        return game
+
+    async def aload(self):
+        game_class = type(self.game)
+        row = await self.rows(game_class, self.owner).only(*self.columns(game_class)).afirst()
+        messages = await MessageLog.aload(row) if row else None
+        saved = game_class(self.to_mapping(game_class, row, messages))
+        return saved.state(), saved.version
+
+    async def acompare_and_swap(self, expected):
+        return await sync_to_async(self._compare_and_swap)(expected)
+
+    def _compare_and_swap(self, expected):
+        state = self.game.state()
+        messages = state.pop(HISTORY_FIELD)
+        with transaction.atomic():
+            if expected == 0:
+                # Prima partita del giocatore in questo gioco: la riga non esiste ancora
+                try:
+                    with transaction.atomic():
+                        row = Game.objects.create(
+                            game=self.game.GAME_ID, message_count=len(messages), **self.owner, **state,
+                        )
+                except IntegrityError:
+                    return False  # Creata nel frattempo da un'altra richiesta
+                self.row_id = row.pk
+                saved_length = 0
+            else:
+                base = self.game.base
+                changed = {name: value for name, value in state.items() if value != base[name]}
+                updated = self.rows(type(self.game), self.owner).filter(version=expected).update(
+                    version=expected + 1, updated_at=timezone.now(), message_count=len(messages), **changed,
+                )
+                if not updated:
+                    return False
+                # Una cronologia ancora da salvare (riga appena azzerata) non è una `MessageLog`
+                saved = base[HISTORY_FIELD]
+                saved_length = len(saved) if isinstance(saved, MessageLog) else 0
+            GameMessage.objects.bulk_create(history.new_rows(self.row_id, messages, saved_length))
+        return True
+
+
+def player(request):
+    """
+    Filtro che identifica le partite del giocatore: l'utente se autenticato,
+    altrimenti la chiave d'ospite della sessione (creata alla prima visita a un gioco).
+    """
+    if request.user.is_authenticated:
+        return {"user": request.user}
+    guest = request.session.get(GUEST_KEY)
+    if guest is None:
+        guest = request.session[GUEST_KEY] = uuid.uuid4().hex
+    return {"guest": guest}
+
+
+def player_key(request):
+    """Identificativo del giocatore per le chiavi di cache (`user:<pk>` o `guest:<chiave>`)."""
+    owner = player(request)
+    return f"user:{owner['user'].pk}" if "user" in owner else f"guest:{owner['guest']}"
+
+
+async def asnapshot_due(request, game_class):
+    """
+    Vero se è ora di scrivere il file di salvataggio della partita. Il file contiene
+    la cronologia completa, quindi scriverlo costa quanto la campagna è lunga: lo si
+    fa al massimo una volta ogni `GAME_HISTORY["snapshot_interval"]` secondi per
+    giocatore e gioco, non a ogni turno.
+    """
+    interval = settings.GAME_HISTORY["snapshot_interval"]
+    return await cache.aadd(f"gamestate:snapshot:{game_class.GAME_ID}:{player_key(request)}", 1, timeout=interval)
+
+
+def replace_saved(request, game_class, saved):
+    """
+    Sostituisce la partita salvata con `saved` (valori con le chiavi di stato del
+    gioco; le chiavi assenti tornano ai valori predefiniti). La versione cresce,
+    così i turni ancora in corso sulla vecchia partita non la sovrascrivono.
+    """
+    owner = player(request)
+    columns = {name: saved.get(key) for name, key in game_class.STATE_KEYS.items()}
+    messages = columns.pop(HISTORY_FIELD) or []
+    rows = ModelStore.rows(game_class, owner)
+    with transaction.atomic():
+        if not rows.update(version=F("version") + 1, updated_at=timezone.now(), message_count=len(messages), **columns):
+            try:
+                with transaction.atomic():
+                    Game.objects.create(
+                        game=game_class.GAME_ID, message_count=len(messages), **owner, **columns,
+                    )
+            except IntegrityError:
+                rows.update(version=F("version") + 1, updated_at=timezone.now(), message_count=len(messages), **columns)
+        row_id = rows.values_list("pk", flat=True).get()
+        GameMessage.objects.filter(game_id=row_id).delete()
+        GameMessage.objects.bulk_create(history.new_rows(row_id, messages, 0))
+    # La partita nella sessione, se c'era, è ormai superata
+    game_class.forget_session(request.session)
+
+
+def clear_saved(request, game_class):
+    """Cancella la partita salvata: alla prossima visita ne inizia una nuova."""
+    replace_saved(request, game_class, {})
+
+
+class VersionedState:
+    """
+    Stato di gioco con numero di versione, da usare come base dei `GameManager`.
+
+    Le sottoclassi dichiarano `GAME_ID`, gli attributi che compongono lo stato
+    con la loro chiave (`STATE_KEYS`, attributo -> chiave), la chiave della
+    versione (`VERSION_KEY`) e le regole di fusione (`MERGE_RULES`). `__init__`
+    riceve un mapping con quelle chiavi (i valori di una riga di `Game`, o la
+    sessione delle partite precedenti all'archivio) e termina chiamando `track_version()`.
+
+    Le viste ottengono la partita con `aload(request)` (o `load` nelle viste sincrone).
+    """
+
+    GAME_ID = None
+    STATE_KEYS = {}
+    VERSION_KEY = None
+    MERGE_RULES = {}
+    store = None
+    from_session = False  # partita importata dalla sessione, da rimuovere dopo il primo salvataggio
+    games = []            # sottoclassi registrate, per le chiavi di sessione condivise tra giochi
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        VersionedState.games.append(cls)
+
+    @classmethod
+    async def aload(cls, request):
+        """La partita del giocatore, dal modello `Game`: si leggono solo le righe di questo gioco."""
+        owner = player(request)
+        rows = ModelStore.rows(cls, owner).only(*ModelStore.columns(cls))
+        row = await rows.afirst()
+        if row is None and await sync_to_async(cls._adopt_guest_game)(request):
+            row = await rows.afirst()
+        messages = await MessageLog.aload(row) if row else None
+        game = ModelStore.build(cls, owner, row, messages)
+        if row is None:
+            game = cls._import_session(request, game)
+        elif cls.STATE_KEYS[HISTORY_FIELD] in request.session:
+            cls.forget_session(request.session)
+        return game
+
+    @classmethod
+    def load(cls, request):
+        """Versione sincrona di `aload`, in sola lettura."""
+        owner = player(request)
+        rows = ModelStore.rows(cls, owner).only(*ModelStore.columns(cls))
+        row = rows.first()
+        if row is None and cls._adopt_guest_game(request):
+            row = rows.first()
+        messages = MessageLog.load(row) if row else None
+        game = ModelStore.build(cls, owner, row, messages)
+        if row is None:
+            game = cls._import_session(request, game)
+        return game
+
+    @classmethod
+    def _adopt_guest_game(cls, request):
+        """
+        Al login la partita giocata da ospite passa all'utente, se lui non ne ha
+        già una: la chiave d'ospite sopravvive al login insieme alla sessione.
+        """
+        guest = request.session.get(GUEST_KEY)
+        if not request.user.is_authenticated or guest is None:
+            return False
+        try:
+            adopted = Game.objects.filter(guest=guest, game=cls.GAME_ID).update(user=request.user, guest=None)
+        except IntegrityError:
+            return False  # L'utente ha appena iniziato una partita in un'altra richiesta
+        if adopted:
+            logger.info(f"{cls.GAME_ID}: partita da ospite assegnata a {request.user}")
+        return bool(adopted)
+
+    @classmethod
+    def _import_session(cls, request, game):
+        """
+        Una partita iniziata prima dell'archivio dedicato è ancora nella sessione:
+        la si riprende da lì. Al primo salvataggio passa nel modello e le sue
+        chiavi vengono tolte dalla sessione.
+        """
+        legacy = cls(request.session)
+        if not legacy.is_initialized():
+            return game
+        game.load_state(legacy.state())
+        game.from_session = True
+        logger.info(f"{cls.GAME_ID}: partita di {request.user} importata dalla sessione")
+        return game
+
+    @classmethod
+    def forget_session(cls, session):
+        """
+        Toglie dalla sessione la partita salvata prima dell'archivio dedicato. Le
+        chiavi condivise con un altro gioco restano finché serve anche a quello.
+        """
+        shared = {
+            key
+            for other in cls.games
+            if other is not cls and other.STATE_KEYS[HISTORY_FIELD] in session
+            for key in other.STATE_KEYS.values()
+        }
+        for key in [*cls.STATE_KEYS.values(), cls.VERSION_KEY]:
+            if key not in shared:
+                session.pop(key, None)
+
+    def track_version(self):
+        """Registra versione e stato di partenza del turno."""
+        self.version = self.session.get(self.VERSION_KEY, 0)
+        self.base = snapshot(self.state(), self.MERGE_RULES)
+
+    def state(self):
+        return {name: getattr(self, name) for name in self.STATE_KEYS}
+
+    def load_state(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def _rebase(self, state, version):
+        self.load_state(state)
+        self.version = version
+        self.base = snapshot(state, self.MERGE_RULES)
+
+    async def asave(self, request):
+        """
+        Salva lo stato con controllo di versione, fondendo i cambiamenti con quelli
+        salvati nel frattempo da altre richieste. Restituisce False se il turno è
+        stato rifiutato: in quel caso lo stato torna quello salvato.
+        """
+        if self.state() == self.base:
+            return True  # Niente da salvare
+        store = self.store
+        for _ in range(MAX_ATTEMPTS):
+            if await store.acompare_and_swap(self.version):
+                metrics.incr(f"gamestate.saved.{self.GAME_ID}")
+                self._rebase(self.state(), self.version + 1)
+                if self.from_session:
+                    self.forget_session(request.session)
+                    self.from_session = False
+                return True
+
+            theirs, version = await store.aload()
+            try:
+                merged = merge(self.base, self.state(), theirs, self.MERGE_RULES)
+            except StateConflict as e:
+                logger.warning(f"{self.GAME_ID}: turno in conflitto sul campo {e}, scartato")
+                break
+            metrics.incr(f"gamestate.merged.{self.GAME_ID}")
+            logger.info(f"{self.GAME_ID}: turno fuso con uno salvato nel frattempo (versione {version})")
+            self.load_state(merged)
+            self.base = snapshot(theirs, self.MERGE_RULES)
+            self.version = version
+        else:
+            theirs, version = await store.aload()
+
+        metrics.incr(f"gamestate.rejected.{self.GAME_ID}")
+        self._rebase(theirs, version)
+        flash.warning(request, CONFLICT_MESSAGE)
+        return False
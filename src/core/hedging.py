@@ -0,0 +1,206 @@
+"""
+Richieste "hedged" e fallback automatico tra modelli.
+
+Ogni gioco può avere in `LLM_GAMES[<gioco>]` una catena di modelli di riserva
+(`fallbacks`). La risposta arriva dal primo modello della catena che produce
+il primo token:
+-   se il modello principale fallisce prima di rispondere, si passa al successivo;
+-   con `hedge` attivo, se il primo token non arriva entro il percentile
+    configurato del suo tempo di risposta abituale (`LLM_HEDGING`), la stessa
+    richiesta parte anche verso il modello di riserva e si usa chi risponde
+    per primo. L'altra richiesta viene annullata.
+
+Metriche: `llm.ttft.<modello>` (tempo al primo token), `hedge.turns.<gioco>`,
+`hedge.fired.<gioco>` (richieste duplicate), `hedge.wins.<gioco>` (vinte dalla
+riserva) e `hedge.fallbacks.<gioco>` (modello principale in errore).
+"""
+
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+
+from core import brownout, llm, metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _has_payload(chunk):
+    """Vero se il chunk porta il primo token vero e proprio (testo o chiamate agli strumenti)."""
+    if not chunk.choices:
+        return False
+    delta = chunk.choices[0].delta
+    return bool(delta.content or delta.tool_calls)
+
+
+async def _close(stream):
+    close = getattr(stream, "aclose", None) or stream.close
+    try:
+        await close()
+    except Exception as e:
+        logger.debug(f"Errore nella chiusura di uno stream: {e}")
+
+
+class HedgedStream:
+    """Lo stream del modello che ha risposto per primo, compresi i chunk già letti."""
+
+    def __init__(self, model, stream, iterator, buffered):
+        self.model = model
+        self._stream = stream
+        self._iterator = iterator
+        self._buffered = buffered
+        self.on_close = None
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        try:
+            for chunk in self._buffered:
+                yield chunk
+            async for chunk in self._iterator:
+                yield chunk
+        finally:
+            await self.close()
+
+    async def close(self):
+        await _close(self._stream)
+        on_close, self.on_close = self.on_close, None
+        if on_close:
+            on_close()
+
+
+async def _open(model, messages, kwargs):
+    """Apre lo stream e lo legge fino al primo token, misurandone il tempo."""
+    started = time.monotonic()
+    stream = await llm.astream_chat_completion(model, messages, **kwargs)
+    iterator = stream.__aiter__()
+    buffered = []
+    try:
+        while True:
+            try:
+                chunk = await iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            buffered.append(chunk)
+            if _has_payload(chunk):
+                break
+    except BaseException:
+        # Anche se annullata perché ha perso la gara: la connessione va chiusa
+        await _close(stream)
+        raise
+    ttft = time.monotonic() - started
+    metrics.observe(f"llm.ttft.{model}", ttft)
+    brownout.observe_ttft(ttft)
+    return HedgedStream(model, stream, iterator, buffered)
+
+
+def hedge_delay(model):
+    """Attesa del primo token oltre cui parte la richiesta di riserva."""
+    options = settings.LLM_HEDGING
+    observed = metrics.percentile(f"llm.ttft.{model}", options["percentile"])
+    delay = observed if observed is not None else options["default_delay"]
+    return max(delay, options["min_delay"])
+
+
+async def _discard(tasks):
+    """Annulla le richieste che hanno perso e chiude gli stream già aperti."""
+    for task in tasks:
+        task.cancel()
+    for task in tasks:
+        try:
+            stream = await task
+        except BaseException:
+            continue
+        await stream.close()
+
+
+async def astream_chat_completion(game_id, model, messages, **kwargs):
+    """
+    Come `llm.astream_chat_completion`, ma con la catena di riserva del gioco e le
+    regole di brownout. Restituisce un `HedgedStream`: `.model` è il modello che ha risposto.
+    """
+    # Sotto carico: risposte più corte e, se previsto, un modello più veloce
+    model, kwargs = brownout.adjust(model, kwargs)
+    brownout.request_started()
+    try:
+        stream = await _race(game_id, model, messages, kwargs)
+    except BaseException:
+        brownout.request_finished()
+        raise
+    stream.on_close = brownout.request_finished
+    return stream
+
+
+async def _race(game_id, model, messages, kwargs):
+    """Restituisce lo stream del primo modello della catena che produce il primo token."""
+    options = settings.LLM_GAMES.get(game_id, {})
+    chain = iter([model, *options.get("fallbacks", [])])
+    hedge = options.get("hedge", False)
+    metrics.incr(f"hedge.turns.{game_id}")
+
+    pending = set()
+    launched = []
+
+    def launch():
+        candidate = next(chain, None)
+        if candidate is None:
+            return False
+        task = asyncio.create_task(_open(candidate, messages, kwargs))
+        pending.add(task)
+        launched.append(task)
+        return True
+
+    launch()
+    hedged = False
+    last_error = None
+    try:
+        while pending:
+            timeout = hedge_delay(model) if hedge and not hedged else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # Primo token in ritardo: la stessa richiesta parte verso il modello di riserva
+                hedged = True
+                if launch():
+                    metrics.incr(f"hedge.fired.{game_id}")
+                    logger.info(f"{game_id}: {model} lento, richiesta duplicata sulla riserva")
+                continue
+
+            for task in done:
+                if task.exception() is None:
+                    winner = task.result()
+                    if winner.model != model:
+                        metrics.incr(f"hedge.wins.{game_id}" if hedged else f"hedge.fallbacks.{game_id}")
+                        logger.info(f"{game_id}: risposta servita da {winner.model}")
+                    await _discard([t for t in launched if t is not task])
+                    pending = set()
+                    return winner
+                last_error = task.exception()
+                logger.warning(f"{game_id}: errore prima del primo token: {last_error}")
+
+            # Tutte le richieste in corso sono fallite: si passa al modello successivo
+            if not pending and not launch():
+                break
+    finally:
+        if pending:
+            await _discard(list(pending))
+    raise last_error
+
+
+def hedge_stats():
+    """Per gioco: quota di turni con richiesta duplicata e quota di quelle vinte dalla riserva."""
+    counters = metrics.snapshot()["counters"]
+    stats = {}
+    for game_id in settings.LLM_GAMES:
+        turns = counters.get(f"hedge.turns.{game_id}", 0)
+        if not turns:
+            continue
+        fired = counters.get(f"hedge.fired.{game_id}", 0)
+        wins = counters.get(f"hedge.wins.{game_id}", 0)
+        stats[game_id] = {
+            "hedge_rate": round(fired / turns, 3),
+            "win_rate": round(wins / fired, 3) if fired else None,
+            "fallbacks": counters.get(f"hedge.fallbacks.{game_id}", 0),
+        }
+    return stats
@@ -0,0 +1,177 @@
+"""
+Cronologia delle partite salvate nel modello `GameMessage`, una riga per messaggio.
+
+La cronologia cresce solo in coda, quindi non serve mai riscriverla: ogni turno
+inserisce soltanto i suoi messaggi nuovi. In lettura si carica solo la finestra
+che serve, con una query per intervallo di `seq` sull'indice (partita, seq):
+-   il prompt di sistema (`seq` 0);
+-   i messaggi non ancora riassunti (`summary_upto` in poi), che vanno al modello;
+-   almeno gli ultimi `GAME_HISTORY["recent_messages"]`, mostrati nella chat.
+La finestra non supera comunque `max_window` messaggi, così il costo di un turno
+non dipende dalla lunghezza della campagna.
+
+`MessageLog` presenta la finestra con gli indici della cronologia completa:
+`len()`, `[i]`, `[a:b]`, `append` e `insert` si comportano come sulla lista
+intera, finché si resta dentro la finestra; indici e fette che toccano messaggi
+non caricati sollevano `IndexError` (per leggerli c'è `aslice_from`).
+L'iterazione restituisce solo i messaggi caricati.
+"""
+
+from django.conf import settings
+from django.db.models import Q
+
+from core import tokens
+from core.models import GameMessage
+
+# Chiavi del messaggio con una colonna dedicata; le altre finiscono in `extra`
+COLUMNS = ("role", "content", "tool_calls", "tool_call_id", "tokens")
+
+
+def to_row(game_id, seq, msg):
+    extra = {key: value for key, value in msg.items() if key not in COLUMNS}
+    return GameMessage(
+        game_id=game_id,
+        seq=seq,
+        role=msg["role"],
+        content=msg.get("content"),
+        tool_calls=msg.get("tool_calls"),
+        tool_call_id=msg.get("tool_call_id"),
+        extra=extra or None,
+        tokens=tokens.message_tokens(msg),
+    )
+
+
+def from_row(row):
+    msg = {"role": row.role, "content": row.content}
+    if row.tool_calls is not None:
+        msg["tool_calls"] = row.tool_calls
+    if row.tool_call_id is not None:
+        msg["tool_call_id"] = row.tool_call_id
+    msg.update(row.extra or {})
+    if row.tokens is not None:
+        msg["tokens"] = row.tokens
+    return msg
+
+
+def window_start(length, summary_upto):
+    """Primo indice da caricare dopo il prompt di sistema."""
+    options = settings.GAME_HISTORY
+    start = min(max(1, summary_upto or 0), length - options["recent_messages"])
+    return max(1, start, length - options["max_window"])
+
+
+def _window_query(game, start):
+    return GameMessage.objects.filter(Q(seq=0) | Q(seq__gte=start), game=game).order_by("seq")
+
+
+class MessageLog:
+    """Finestra della cronologia di una partita, con gli indici della cronologia completa."""
+
+    def __init__(self, head, start, window, game_id=None):
+        self.head = head      # prompt di sistema, o None se la finestra parte da 0
+        self.start = start    # indice del primo messaggio di `window`
+        self.window = window
+        self.game_id = game_id
+
+    @classmethod
+    def _from_rows(cls, game, rows, start):
+        messages = [from_row(row) for row in rows]
+        if start > 0 and messages and rows[0].seq == 0:
+            return cls(messages[0], start, messages[1:], game.pk)
+        return cls(None, 0, messages, game.pk)
+
+    @classmethod
+    async def aload(cls, game):
+        """Finestra della cronologia della riga `game` (un `Game`)."""
+        start = window_start(game.message_count, game.summary_upto)
+        rows = [row async for row in _window_query(game, start)]
+        return cls._from_rows(game, rows, start)
+
+    @classmethod
+    def load(cls, game):
+        start = window_start(game.message_count, game.summary_upto)
+        return cls._from_rows(game, list(_window_query(game, start)), start)
+
+    def __len__(self):
+        return self.start + len(self.window)
+
+    def __iter__(self):
+        if self.head is not None:
+            yield self.head
+        yield from self.window
+
+    def _position(self, index):
+        if index < 0:
+            index += len(self)
+        if index == 0 and self.head is not None:
+            return None
+        if not self.start <= index < len(self):
+            raise IndexError(f"Messaggio {index} fuori dalla finestra caricata ({self.start}-{len(self)})")
+        return index - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            first, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("Passo non supportato")
+            if max(first, 1) < min(stop, self.start):
+                # Mancherebbero i messaggi tra il prompt di sistema e la finestra
+                raise IndexError(f"Messaggi {first}-{stop} fuori dalla finestra caricata ({self.start}-{len(self)})")
+            messages = [self.head] if first == 0 and stop > 0 and self.head is not None else []
+            return messages + self.window[max(first - self.start, 0):max(stop - self.start, 0)]
+        position = self._position(index)
+        return self.head if position is None else self.window[position]
+
+    def append(self, msg):
+        self.window.append(msg)
+
+    def insert(self, index, msg):
+        self.window.insert(max(index, self.start) - self.start, msg)
+
+    def copy(self):
+        return MessageLog(self.head, self.start, list(self.window), self.game_id)
+
+    def __add__(self, messages):
+        return MessageLog(self.head, self.start, self.window + list(messages), self.game_id)
+
+    def __eq__(self, other):
+        if isinstance(other, MessageLog):
+            return (self.start, self.head, self.window) == (other.start, other.head, other.window)
+        return self.start == 0 and self.window == other
+
+    def startswith(self, base):
+        """Vero se questa cronologia prosegue `base`, confrontando i messaggi caricati in entrambe."""
+        if len(self) < len(base):
+            return False
+        if isinstance(base, MessageLog):
+            first = max(self.start, base.start)
+            return self[first:len(base)] == base[first:len(base)]
+        return self[self.start:len(base)] == base[self.start:]
+
+    def load_all(self):
+        """Tutta la cronologia salvata, con una query completa: solo per i file di salvataggio."""
+        return [from_row(row) for row in GameMessage.objects.filter(game_id=self.game_id).order_by("seq")]
+
+
+def first_loaded(messages):
+    """Primo indice dopo il prompt di sistema disponibile in memoria."""
+    return messages.start if isinstance(messages, MessageLog) else 0
+
+
+async def aslice_from(messages, start):
+    """`messages[start:]`, leggendo dal database i messaggi salvati prima della finestra caricata."""
+    loaded = first_loaded(messages)
+    if start >= loaded:
+        return messages[start:]
+    rows = GameMessage.objects.filter(game_id=messages.game_id, seq__gte=start, seq__lt=loaded).order_by("seq")
+    return [from_row(row) async for row in rows] + messages[loaded:]
+
+
+def full_history(messages):
+    """La cronologia completa, che sia una lista (sessione) o una finestra `MessageLog`."""
+    return messages.load_all() if isinstance(messages, MessageLog) else messages
+
+
+def new_rows(game_id, messages, saved_length):
+    """Righe da inserire per i messaggi aggiunti dopo i primi `saved_length`."""
+    return [to_row(game_id, seq, messages[seq]) for seq in range(saved_length, len(messages))]
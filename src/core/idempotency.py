@@ -0,0 +1,153 @@
+"""
+Invio idempotente dei turni: doppi clic e reinvii con F5 non avviano un secondo turno.
+
+Ogni form della chat porta una chiave casuale (`turn_key`), rinnovata a ogni
+invio. La prima richiesta con una certa chiave "prenota" il turno nella cache
+di Django (per gioco e per sessione) ed esegue la chiamata al modello; le
+richieste successive con la stessa chiave sono doppioni:
+-   se il turno è ancora in corso, aspettano che si concluda;
+-   poi ne ricevono il risultato: il redirect alla chat (che mostra lo stato
+    già salvato) o, in streaming, gli eventi del turno originale.
+
+Con una cache condivisa (es. Redis) i doppioni vengono riconosciuti anche se
+arrivano a un worker diverso. Se il turno originale fallisce la prenotazione
+viene rimossa, così il giocatore può riprovare.
+
+Metriche: `idempotency.duplicates.<gioco>` (richieste doppie soppresse) e
+`idempotency.bypassed.<gioco>` (turni eseguiti senza controllo, per chiave o sessione mancante).
+"""
+
+import asyncio
+import logging
+import re
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib import messages as flash
+from django.core.cache import cache
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+KEY_FIELD = "turn_key"
+KEY_PATTERN = re.compile(r"^[A-Za-z0-9-]{8,64}$")
+RUNNING = "in_corso"
+LOST_MESSAGE = "Il turno inviato due volte non si è concluso. Riprova."
+
+
+def new_key():
+    """Chiave per il prossimo invio del form della chat."""
+    return uuid.uuid4().hex
+
+
+class Turn:
+    """Un invio del form della chat, identificato da sessione e `turn_key`."""
+
+    def __init__(self, request, game_id):
+        self.game_id = game_id
+        key = request.POST.get(KEY_FIELD, "")
+        session_key = request.session.session_key
+        # Senza chiave (es. un form vecchio rimasto aperto) o senza sessione (cookie
+        # scaduto o bloccato: anche i doppioni ne avrebbero una nuova) il turno viene
+        # semplicemente eseguito
+        if not KEY_PATTERN.match(key):
+            self.key, self._bypass = None, "chiave del turno assente o non valida"
+        elif not session_key:
+            self.key, self._bypass = None, "sessione senza chiave"
+        else:
+            self.key, self._bypass = f"turn:{game_id}:{session_key}:{key}", None
+        self._claimed = False
+        self._events = []
+
+    async def claim(self):
+        """Vero se questa richiesta deve eseguire il turno, falso se è un doppione."""
+        if self.key is None:
+            metrics.incr(f"idempotency.bypassed.{self.game_id}")
+            logger.info(f"Turno su {self.game_id} senza controllo dei doppioni: {self._bypass}")
+            return True
+        if await cache.aadd(self.key, RUNNING, timeout=settings.TURN_IDEMPOTENCY["ttl"]):
+            self._claimed = True
+            return True
+        metrics.incr(f"idempotency.duplicates.{self.game_id}")
+        logger.info(f"Invio doppio su {self.game_id}: si attende il turno già avviato")
+        return False
+
+    def _remember(self, name, data):
+        # I frammenti di testo consecutivi vengono uniti: in cache finisce un solo evento per messaggio
+        if name == "token" and self._events and self._events[-1][0] == "token":
+            self._events[-1] = ("token", {"text": self._events[-1][1]["text"] + data["text"]})
+        else:
+            self._events.append((name, data))
+
+    async def finish(self):
+        """Pubblica il risultato del turno per i doppioni. Va chiamata dopo aver salvato la sessione."""
+        if self._claimed:
+            await cache.aset(self.key, self._events, timeout=settings.TURN_IDEMPOTENCY["ttl"])
+            self._claimed = False
+
+    async def settle(self, saved):
+        """
+        Conclude il turno del percorso classico dopo il salvataggio: se il turno è stato
+        scartato per un conflitto (`saved` falso) non c'è un risultato da pubblicare e
+        la prenotazione viene rimossa, così un reinvio lo rigioca.
+        """
+        if saved:
+            await self.finish()
+        else:
+            await self.abandon()
+
+    async def abandon(self):
+        """Rimuove la prenotazione di un turno fallito, così si può reinviare."""
+        if self._claimed:
+            await cache.adelete(self.key)
+            self._claimed = False
+
+    async def record(self, events):
+        """
+        Inoltra gli eventi del turno conservandone una copia. All'evento `done`
+        (stato già salvato) il risultato viene pubblicato; se il turno fallisce o
+        viene interrotto, la prenotazione viene rimossa.
+        """
+        try:
+            async for name, data in events:
+                self._remember(name, data)
+                if name == "done":
+                    await self.finish()
+                yield name, data
+        except BaseException:
+            await self.abandon()
+            raise
+        finally:
+            await events.aclose()
+
+    async def wait(self):
+        """
+        Attende la fine del turno originale e ne restituisce gli eventi, o None se
+        il turno è fallito o non si è concluso in tempo.
+        """
+        options = settings.TURN_IDEMPOTENCY
+        deadline = time.monotonic() + options["wait"]
+        while True:
+            result = await cache.aget(self.key)
+            if result != RUNNING:
+                return result
+            if time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(options["poll"])
+
+    async def follow(self, request):
+        """Percorso classico: il doppione attende il turno originale e poi torna alla chat."""
+        if await self.wait() is None:
+            flash.warning(request, LOST_MESSAGE)
+
+    async def replay(self):
+        """Eventi da inviare in streaming a un doppione: quelli del turno originale."""
+        events = await self.wait()
+        if events is None:
+            yield "notice", {"level": "warning", "text": LOST_MESSAGE}
+            yield "done", {}
+            return
+        for name, data in events:
+            yield name, data
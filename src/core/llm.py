@@ -0,0 +1,311 @@
+"""
+Client LLM condiviso da tutti i giochi.
+
+Ogni processo tiene un'unica istanza del client appoggiata a un pool di
+connessioni keep-alive: i turni successivi riusano la connessione TLS già
+aperta verso OpenRouter invece di rifare l'handshake ad ogni richiesta.
+
+Le viste di gioco usano il client asincrono (`AsyncOpenAI`), così un worker
+ASGI non resta bloccato durante l'attesa del modello; il client sincrono
+resta disponibile per i comandi di gestione e i lavori in background.
+
+Il client asincrono con il pool appartiene all'event loop del server ASGI,
+registrato all'avvio da `asgi_lifespan` (vedi `config/asgi.py`) e chiuso allo
+spegnimento. Gli event loop di breve vita (`async_to_sync`, runserver, test)
+ricevono un client senza connessioni keep-alive: ogni connessione si chiude a
+fine risposta, quindi non ne resta nessuna aperta quando il loop termina.
+
+Tutte le chiamate passano da `core/resilience.py`: ritentativi sugli errori
+transitori, scadenza del turno (`deadline`) e circuit breaker per modello. Per
+questo i client dell'SDK sono creati senza ritentativi propri.
+
+Dimensione del pool, timeout e impostazioni per modello sono in `config/settings.py`
+(`LLM_HTTP_POOL`, `LLM_TIMEOUTS`, `LLM_MODELS`, `LLM_PROMPT_CACHE_MODELS`, `LLM_RESILIENCE`).
+"""
+
+import asyncio
+import logging
+import threading
+import weakref
+
+import httpx
+from django.conf import settings
+from openai import AsyncOpenAI, OpenAI
+
+from core import metrics, resilience
+
+logger = logging.getLogger(__name__)
+
+_client = None
+_client_lock = threading.Lock()
+
+_async_client = None  # client con pool del server ASGI
+_async_loop = None    # event loop del server ASGI, registrato all'avvio
+# Client senza pool degli event loop di breve vita, uno per loop
+_transient_clients = weakref.WeakKeyDictionary()
+
+
+def _record_pool_event(state, event_name):
+    if event_name == "connection.connect_tcp.started":
+        state["new_connection"] = True
+    elif event_name.endswith("send_request_headers.started"):
+        metrics.incr("llm.pool.miss" if state["new_connection"] else "llm.pool.hit")
+
+
+def _trace_connection(request):
+    """
+    Hook di httpx: segue gli eventi di httpcore per capire se la richiesta
+    ha riusato una connessione del pool (hit) o ne ha dovuta aprire una nuova (miss).
+    """
+    state = {"new_connection": False}
+
+    def trace(event_name, info):
+        _record_pool_event(state, event_name)
+
+    request.extensions["trace"] = trace
+
+
+async def _atrace_connection(request):
+    """Versione asincrona di `_trace_connection` (httpcore richiede callback async)."""
+    state = {"new_connection": False}
+
+    async def trace(event_name, info):
+        _record_pool_event(state, event_name)
+
+    request.extensions["trace"] = trace
+
+
+def _http_options():
+    """Limiti del pool e timeout comuni ai client sincrono e asincrono."""
+    pool = settings.LLM_HTTP_POOL
+    timeouts = settings.LLM_TIMEOUTS
+    return {
+        "limits": httpx.Limits(
+            max_connections=pool["max_connections"],
+            max_keepalive_connections=pool["max_keepalive_connections"],
+            keepalive_expiry=pool["keepalive_expiry"],
+        ),
+        "timeout": httpx.Timeout(
+            connect=timeouts["connect"],
+            read=timeouts["read"],
+            write=timeouts["write"],
+            pool=timeouts["pool"],
+        ),
+    }
+
+
+def _build_client():
+    """Costruisce il client OpenAI con il pool HTTP configurato."""
+    http_client = httpx.Client(**_http_options(), event_hooks={"request": [_trace_connection]})
+    return OpenAI(
+        base_url=settings.LLM_API_URL,
+        api_key=settings.LLM_API_KEY,
+        http_client=http_client,
+        max_retries=0,  # I ritentativi li gestisce core.resilience
+    )
+
+
+def get_client():
+    """Restituisce il client condiviso del processo, creandolo alla prima chiamata."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = _build_client()
+                logger.info("Client LLM inizializzato (pool: %s)", settings.LLM_HTTP_POOL)
+    return _client
+
+
+def _build_async_client(pooled):
+    options = _http_options()
+    hooks = {"request": [_atrace_connection]}
+    if not pooled:
+        # Nessuna connessione resta aperta dopo la risposta, e le metriche del pool restano quelle del server
+        options["limits"] = httpx.Limits(
+            max_connections=settings.LLM_HTTP_POOL["max_connections"],
+            max_keepalive_connections=0,
+        )
+        hooks = {}
+    return AsyncOpenAI(
+        base_url=settings.LLM_API_URL,
+        api_key=settings.LLM_API_KEY,
+        http_client=httpx.AsyncClient(**options, event_hooks=hooks),
+        max_retries=0,
+    )
+
+
+def get_async_client():
+    """
+    Restituisce il client asincrono per l'event loop corrente: quello condiviso con
+    il pool sul loop del server ASGI, uno senza keep-alive sugli altri loop.
+    """
+    global _async_client
+    loop = asyncio.get_running_loop()
+    if loop is _async_loop:
+        if _async_client is None:
+            _async_client = _build_async_client(pooled=True)
+            logger.info("Client LLM asincrono inizializzato (pool: %s)", settings.LLM_HTTP_POOL)
+        return _async_client
+    client = _transient_clients.get(loop)
+    if client is None:
+        client = _transient_clients[loop] = _build_async_client(pooled=False)
+    return client
+
+
+def on_server_loop():
+    """Vero se il codice gira sull'event loop del server ASGI, che sopravvive alla richiesta."""
+    return _async_loop is not None and asyncio.get_running_loop() is _async_loop
+
+
+async def aclose_async_client():
+    """Chiude il client con pool del server ASGI e le sue connessioni."""
+    global _async_client, _async_loop
+    if _async_client is not None:
+        await _async_client.close()
+        logger.info("Client LLM asincrono chiuso")
+    _async_client = _async_loop = None
+
+
+def asgi_lifespan(app):
+    """
+    Avvolge l'applicazione ASGI per gestire gli eventi `lifespan` del server:
+    all'avvio il suo event loop diventa quello del client con pool, allo
+    spegnimento il client viene chiuso. Le richieste HTTP passano all'app.
+    """
+    async def application(scope, receive, send):
+        global _async_loop
+        if scope["type"] != "lifespan":
+            return await app(scope, receive, send)
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                _async_loop = asyncio.get_running_loop()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await aclose_async_client()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    return application
+
+
+def model_settings(model):
+    """Impostazioni specifiche del modello definite in `LLM_MODELS` (vuote se assenti)."""
+    return dict(settings.LLM_MODELS.get(model, {}))
+
+
+def supports_prompt_cache(model):
+    """Vero se per il modello vanno inviati i punti di cache (`cache_control`) sul prefisso del prompt."""
+    return model in settings.LLM_PROMPT_CACHE_MODELS
+
+
+def completion_kwargs(model, messages, **kwargs):
+    """
+    Unisce le impostazioni del modello, gli header di default e i parametri
+    passati dal chiamante (che hanno sempre la precedenza).
+    """
+    params = model_settings(model)
+    params.update(kwargs)
+    params["extra_headers"] = {**settings.LLM_DEFAULT_HEADERS, **kwargs.get("extra_headers", {})}
+    params["model"] = model
+    params["messages"] = messages
+    return params
+
+
+def _attempt_params(params, remaining):
+    """Parametri del singolo tentativo: il timeout non può superare il tempo rimasto al turno."""
+    if remaining is None:
+        return params
+    timeout = params.get("timeout", settings.LLM_TIMEOUTS["read"])
+    return {**params, "timeout": min(timeout, remaining)}
+
+
+def chat_completion(model, messages, deadline=None, **kwargs):
+    """
+    Esegue una chat completion con il client condiviso, con ritentativi e circuit breaker.
+    `deadline` (una `resilience.Deadline`) limita la durata complessiva dei tentativi.
+    """
+    params = completion_kwargs(model, messages, **kwargs)
+
+    def send(remaining):
+        metrics.incr("llm.requests")
+        return get_client().chat.completions.create(**_attempt_params(params, remaining))
+
+    return resilience.call(model, send, deadline)
+
+
+def stream_chat_completion(model, messages, **kwargs):
+    """
+    Come `chat_completion`, ma restituisce lo stream dei chunk man mano che arrivano.
+    L'ultimo chunk riporta il consumo di token (`usage`).
+    """
+    kwargs.setdefault("stream_options", {"include_usage": True})
+    return chat_completion(model, messages, stream=True, **kwargs)
+
+
+async def achat_completion(model, messages, deadline=None, **kwargs):
+    """Versione asincrona di `chat_completion`."""
+    params = completion_kwargs(model, messages, **kwargs)
+
+    async def send(remaining):
+        metrics.incr("llm.requests")
+        return await get_async_client().chat.completions.create(**_attempt_params(params, remaining))
+
+    return await resilience.acall(model, send, deadline)
+
+
+async def astream_chat_completion(model, messages, deadline=None, **kwargs):
+    """
+    Versione asincrona di `stream_chat_completion`. Si ritenta solo l'apertura dello
+    stream; con una `deadline` anche la lettura dei chunk si interrompe alla scadenza.
+    """
+    kwargs.setdefault("stream_options", {"include_usage": True})
+    stream = await achat_completion(model, messages, deadline=deadline, stream=True, **kwargs)
+    return resilience.guard_stream(stream, deadline) if deadline is not None else stream
+
+
+def cached_tokens(usage):
+    """Token del prompt letti dalla cache del provider (`prompt_tokens_details.cached_tokens`)."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return (getattr(details, "cached_tokens", None) or 0) if details else 0
+
+
+def record_usage(model, usage):
+    """
+    Registra i token consumati da una risposta, compresi quelli letti dalla
+    cache del provider (`prompt_tokens_details.cached_tokens`).
+    """
+    if usage is None:
+        return
+    cached = cached_tokens(usage)
+    metrics.incr("llm.tokens.prompt", usage.prompt_tokens or 0)
+    metrics.incr("llm.tokens.completion", usage.completion_tokens or 0)
+    metrics.incr("llm.tokens.cached", cached)
+    logger.info(
+        f"Token {model}: prompt {usage.prompt_tokens} (di cui {cached} dalla cache), "
+        f"risposta {usage.completion_tokens}"
+    )
+
+
+def usage_cost(model, usage):
+    """Costo in dollari di una risposta secondo i prezzi di `LLM_PRICES` (0 se il modello non è listato)."""
+    prices = settings.LLM_PRICES.get(model)
+    if usage is None or not prices:
+        return 0.0
+    return (
+        (usage.prompt_tokens or 0) * prices["prompt"]
+        + (usage.completion_tokens or 0) * prices["completion"]
+    ) / 1_000_000
+
+
+def pool_stats():
+    """Contatori di riuso del pool di connessioni (hit = connessione riusata)."""
+    counters = metrics.snapshot()["counters"]
+    hits = counters.get("llm.pool.hit", 0)
+    misses = counters.get("llm.pool.miss", 0)
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / total, 3) if total else None,
+    }
@@ -0,0 +1,79 @@
+import json
+import re
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from core.parsing import parse_reply
+
+DEFAULT_CORPUS = Path(__file__).resolve().parents[2] / "benchmarks" / "reply_corpus.json"
+
+
+def legacy_parse(reply):
+    """Il vecchio parsing a ricerche separate, tenuto solo come termine di paragone."""
+    result = {}
+    hp_status_match = re.search(r"(?:Punti ferita|HP) attuali:\s*(\d+)", reply, re.IGNORECASE)
+    if hp_status_match:
+        result["hp"] = int(hp_status_match.group(1))
+    else:
+        damage_match = re.search(r"Hai perso\s+(\d+)\s+punti ferita", reply, re.IGNORECASE)
+        if damage_match:
+            result["damage"] = int(damage_match.group(1))
+        heal_match = re.search(r"Hai guarito\s+(\d+)\s+punti ferita", reply, re.IGNORECASE)
+        if heal_match:
+            result["heal"] = int(heal_match.group(1))
+    class_match = re.search(r"\[CLASS_CHANGE\]\s*(\w+)", reply, re.IGNORECASE)
+    if class_match:
+        result["new_class"] = class_match.group(1)
+    collected_match = re.search(r"Hai raccolto:?\s*([^\]\.\[]+)", reply, re.IGNORECASE)
+    if collected_match:
+        result["items"] = [item.strip() for item in collected_match.group(1).split(",") if item.strip()]
+    obj_match = re.search(r"\[OBJECTIVE\]\s*(.*)", reply, re.IGNORECASE)
+    if obj_match:
+        result["objective"] = obj_match.group(1).strip()
+    return result
+
+
+def _load_corpus(path):
+    """Un file di corpus (lista di risposte) o un salvataggio di partita (risposte del DM)."""
+    data = json.loads(Path(path).read_text(encoding="utf-8"))
+    if isinstance(data, dict):
+        return [msg["content"] for msg in data.get("messages", []) if msg.get("role") == "assistant" and msg.get("content")]
+    return data
+
+
+class Command(BaseCommand):
+    help = "Misura il parser delle risposte del DM su un corpus di risposte reali, confrontandolo col vecchio parsing."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "paths", nargs="*",
+            help="File di corpus o salvataggi di partita (default: core/benchmarks/reply_corpus.json).",
+        )
+        parser.add_argument("--rounds", type=int, default=2000, help="Passate sull'intero corpus.")
+
+    def _measure(self, parse, corpus, rounds):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for reply in corpus:
+                parse(reply)
+        return (time.perf_counter() - start) / (rounds * len(corpus)) * 1e6
+
+    def handle(self, *args, **options):
+        corpus = []
+        for path in options["paths"] or [DEFAULT_CORPUS]:
+            corpus.extend(_load_corpus(path))
+        if not corpus:
+            self.stderr.write("Corpus vuoto.")
+            return
+
+        rounds = options["rounds"]
+        tagged = sum(1 for reply in corpus if parse_reply(reply).found)
+        legacy_us = self._measure(legacy_parse, corpus, rounds)
+        single_us = self._measure(parse_reply, corpus, rounds)
+
+        self.stdout.write(f"Corpus: {len(corpus)} risposte ({tagged} con tag), {rounds} passate")
+        self.stdout.write(f"Parsing a ricerche separate: {legacy_us:.2f} µs/risposta")
+        self.stdout.write(f"Parser a passata unica:      {single_us:.2f} µs/risposta")
+        self.stdout.write(self.style.SUCCESS(f"Rapporto: {legacy_us / single_us:.2f}x"))
@@ -0,0 +1,26 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.models import Game
+
+
+class Command(BaseCommand):
+    help = "Cancella le partite degli ospiti ferme da più della durata di una sessione (da lanciare con clearsessions)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days", type=int, default=None,
+            help="Giorni di inattività oltre cui cancellare (default: SESSION_COOKIE_AGE).",
+        )
+
+    def handle(self, *args, **options):
+        if options["days"] is not None:
+            age = timedelta(days=options["days"])
+        else:
+            age = timedelta(seconds=settings.SESSION_COOKIE_AGE)
+        # La sessione con la chiave d'ospite è ormai scaduta: la partita non è più raggiungibile
+        deleted, _ = Game.objects.filter(user=None, updated_at__lt=timezone.now() - age).delete()
+        self.stdout.write(self.style.SUCCESS(f"Cancellate {deleted} righe di partite da ospite."))
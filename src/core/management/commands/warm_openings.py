@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from core import openings
+
+
+class Command(BaseCommand):
+    help = "Riempie il pool di scene d'apertura pre-generate (da lanciare al deploy)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--game", action="append", choices=openings.games(),
+            help="Gioco da rifornire (ripetibile). Di default tutti.",
+        )
+        parser.add_argument(
+            "--depth", type=int, default=None,
+            help="Scene da tenere pronte per gioco (default: LLM_OPENINGS['target_depth']).",
+        )
+
+    def handle(self, *args, **options):
+        for game in options["game"] or openings.games():
+            created = openings.refill(game, options["depth"])
+            depth = openings.pool_depth(game)
+            self.stdout.write(self.style.SUCCESS(f"{game}: {created} nuove scene, {depth} pronte nel pool."))
@@ -0,0 +1,188 @@
+"""
+Memoria a lungo termine delle partite: riassunto progressivo dei turni vecchi.
+
+La cronologia completa resta salvata (in `GameManager.messages`, o nella tabella
+`GameMessage` per le partite nel database), ma all'AI viene inviato solo:
+    [prompt di sistema] + [STORIA FINORA] + [finestra recente alla lettera]
+(l'assemblaggio vero e proprio, con il budget di token, è in `core/context.py`).
+
+Quando i messaggi non ancora riassunti superano la soglia configurata in
+`LLM_MEMORY`, i più vecchi vengono "piegati" nel riassunto con una singola
+chiamata al modello. Riassunto e indice di piegatura (`summary`, `summary_upto`)
+vengono salvati con lo stato di gioco, quindi il lavoro si fa una volta sola.
+
+Il riassunto parte in background (`asummarize_later`) dopo che il turno è stato
+salvato: la risposta al giocatore e il posto in coda di `core/admission.py` non
+aspettano la seconda chiamata al modello. Il task rilegge la partita e la salva
+con il compare-and-swap di `core/gamestate.py`, fondendosi con i turni giocati
+nel frattempo.
+"""
+
+import asyncio
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+from core import brownout, gamestate, history, llm, metrics, tokens
+
+logger = logging.getLogger(__name__)
+
+# Riassunti in corso: il loop tiene solo riferimenti deboli ai task, che andrebbero persi a metà
+_background = set()
+
+SUMMARY_PROMPT = (
+    "Sei l'archivista di una partita di gioco di ruolo testuale. "
+    "Aggiorna il riassunto 'STORIA FINORA' integrando i nuovi eventi. "
+    "Conserva solo ciò che serve a proseguire la storia: luoghi visitati, personaggi incontrati e il loro atteggiamento, "
+    "oggetti ottenuti o persi, ferite subite, obiettivi raggiunti o in corso, promesse, debiti e misteri aperti. "
+    "Scrivi in italiano, in terza persona, al passato, in modo compatto. Niente commenti, solo il riassunto."
+)
+
+
+def first_unsummarized(game):
+    """Indice del primo messaggio non ancora riassunto (il prompt di sistema è sempre escluso)."""
+    return max(1, game.summary_upto or 0)
+
+
+def summary_message(game):
+    """Messaggio con la memoria riassunta da inviare dopo il prompt di sistema, o None."""
+    if not game.summary:
+        return None
+    return {"role": "user", "content": f"[STORIA FINORA] {game.summary}"}
+
+
+def _fold_point(pending, start):
+    """
+    Indice fino a cui riassumere, oppure None se non serve ancora. `pending` sono
+    i messaggi non ancora riassunti, dall'indice `start` in poi.
+    Il taglio cade sempre all'inizio di un turno del giocatore, così la finestra
+    recente non inizia con risposte di strumenti orfane della loro chiamata.
+    """
+    options = settings.LLM_MEMORY
+    pending_tokens = tokens.messages_tokens(pending)
+    if len(pending) <= options["trigger_messages"] and pending_tokens <= options["trigger_tokens"]:
+        return None
+
+    for offset in range(len(pending) - options["keep_recent"], len(pending)):
+        if offset > 0 and starts_turn(pending, offset):
+            return start + offset
+    return None
+
+
+def starts_turn(messages, index):
+    """
+    Vero se il messaggio apre un turno del giocatore e non cade in mezzo a uno scambio di strumenti.
+    Un turno può chiudersi con i risultati degli strumenti, se la narrazione è arrivata
+    insieme alle chiamate: il messaggio del giocatore che segue apre comunque un turno nuovo.
+    """
+    previous = messages[index - 1]
+    return messages[index].get("role") == "user" and not previous.get("tool_calls")
+
+
+def _transcript(messages):
+    """Trascrizione leggibile dei messaggi da riassumere."""
+    lines = []
+    for msg in messages:
+        role = msg.get("role")
+        if msg.get("local"):
+            continue
+        if role == "user":
+            lines.append(f"GIOCATORE: {msg.get('content')}")
+        elif role == "assistant":
+            if msg.get("content"):
+                lines.append(f"DM: {msg['content']}")
+            for call in msg.get("tool_calls") or []:
+                function = call.get("function", {})
+                lines.append(f"[EFFETTO DI GIOCO: {function.get('name')} {function.get('arguments')}]")
+    return "\n".join(lines)
+
+
+async def amaybe_summarize(game, model, extra_headers=None):
+    """
+    Piega i messaggi vecchi nel riassunto se la cronologia ha superato la soglia.
+    In caso di errore il riassunto resta invariato e si riproverà al turno successivo.
+    """
+    start = first_unsummarized(game)
+    # Con molti messaggi non riassunti (es. dopo un lungo brownout) parte di essi è fuori
+    # dalla finestra caricata: si leggono dal database, così il riassunto non ne salta nessuno
+    pending = await history.aslice_from(game.messages, start)
+    fold_at = _fold_point(pending, start)
+    if fold_at is None:
+        return False
+    # Sotto carico il riassunto aspetta: la cronologia resta comunque entro il budget di contesto
+    if brownout.skip_optional("summary"):
+        return False
+
+    options = settings.LLM_MEMORY
+    request = (
+        f"STORIA FINORA:\n{game.summary or '(nessuna)'}\n\n"
+        f"NUOVI EVENTI:\n{_transcript(pending[:fold_at - start])}"
+    )
+    try:
+        completion = await llm.achat_completion(
+            options.get("model") or model,
+            [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": request}],
+            extra_headers=extra_headers or {},
+            max_tokens=options["max_tokens"],
+            temperature=0.2,
+        )
+        summary = (completion.choices[0].message.content or "").strip()
+    except Exception as e:
+        logger.error(f"Errore durante il riassunto della partita: {e}")
+        metrics.incr("memory.summaries.failed")
+        return False
+
+    if not summary:
+        return False
+
+    game.summary = summary
+    game.summary_upto = fold_at
+    metrics.incr("memory.summaries")
+    logger.info(f"Riassunti {fold_at - start} messaggi (finestra recente: {len(game.messages) - fold_at})")
+    return True
+
+
+def fold_due(game):
+    """
+    Controllo rapido sui soli messaggi già caricati: vero se è probabile che serva
+    un riassunto. Quello esatto lo fa `amaybe_summarize`.
+    """
+    start = first_unsummarized(game)
+    if start < history.first_loaded(game.messages):
+        return True  # I messaggi non riassunti vanno oltre la finestra caricata
+    return _fold_point(game.messages[start:], start) is not None
+
+
+async def asummarize_later(request, game, model, extra_headers=None):
+    """
+    Avvia in background il riassunto dei turni vecchi. Va chiamata dopo aver salvato
+    il turno. Restituisce il task avviato, o None se il riassunto non serve.
+    Fuori dal server ASGI (runserver, `async_to_sync`) il loop si chiude con la
+    richiesta e annullerebbe il task: lì il riassunto si esegue subito.
+    """
+    if not fold_due(game):
+        return None
+    if not llm.on_server_loop():
+        await _summarize_saved(request, type(game), model, extra_headers)
+        return None
+    task = asyncio.create_task(_summarize_saved(request, type(game), model, extra_headers))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+
+async def _summarize_saved(request, game_class, model, extra_headers):
+    """Rilegge la partita salvata, la riassume e la salva: un solo riassunto per partita alla volta."""
+    lock = f"memory:fold:{game_class.GAME_ID}:{gamestate.player_key(request)}"
+    if not await cache.aadd(lock, 1, timeout=settings.LLM_MEMORY["fold_lock"]):
+        return
+    try:
+        game = await game_class.aload(request)
+        if await amaybe_summarize(game, model, extra_headers):
+            await game.asave(request)
+    except Exception as e:
+        logger.error(f"Errore durante il riassunto in background di {game_class.GAME_ID}: {e}")
+        metrics.incr("memory.summaries.failed")
+    finally:
+        await cache.adelete(lock)
@@ -0,0 +1,66 @@
+"""
+Metriche di processo per il livello LLM (contatori, indicatori e latenze).
+
+I valori vivono in memoria e sono per singolo worker: servono a osservare
+l'andamento del servizio e a tarare le impostazioni, non a fare contabilità.
+"""
+
+import threading
+from collections import defaultdict, deque
+
+# Numero di campioni conservati per ogni serie di latenze
+SAMPLE_SIZE = 500
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_gauges = {}
+_samples = defaultdict(lambda: deque(maxlen=SAMPLE_SIZE))
+
+
+def incr(name, amount=1):
+    """Incrementa un contatore."""
+    with _lock:
+        _counters[name] += amount
+
+
+def set_gauge(name, value):
+    """Imposta il valore corrente di un indicatore (es. profondità di una coda)."""
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name, value):
+    """Registra un campione (tipicamente una latenza in secondi)."""
+    with _lock:
+        _samples[name].append(value)
+
+
+def percentile(name, pct):
+    """Restituisce il percentile `pct` (0-100) dei campioni recenti, o None se non ce ne sono."""
+    with _lock:
+        values = sorted(_samples.get(name, ()))
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def snapshot():
+    """Fotografia di tutte le metriche, pronta per essere serializzata in JSON."""
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        series = {name: sorted(values) for name, values in _samples.items()}
+
+    latencies = {}
+    for name, values in series.items():
+        if not values:
+            continue
+        last = len(values) - 1
+        latencies[name] = {
+            "count": len(values),
+            "p50": values[int(round(0.50 * last))],
+            "p95": values[int(round(0.95 * last))],
+            "p99": values[int(round(0.99 * last))],
+        }
+    return {"counters": counters, "gauges": gauges, "latencies": latencies}
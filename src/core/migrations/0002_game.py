@@ -0,0 +1,40 @@
+# Generated by Django 5.2.1 on 2026-10-18 14:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Game',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('game', models.CharField(max_length=50)),
+                ('version', models.PositiveIntegerField(default=1)),
+                ('hp', models.IntegerField(null=True)),
+                ('max_hp', models.IntegerField(null=True)),
+                ('level', models.IntegerField(null=True)),
+                ('objectives_completed', models.IntegerField(null=True)),
+                ('current_objective', models.TextField(null=True)),
+                ('player_class', models.CharField(max_length=100, null=True)),
+                ('stats', models.JSONField(null=True)),
+                ('inventory', models.JSONField(null=True)),
+                ('messages', models.JSONField(null=True)),
+                ('summary', models.TextField(null=True)),
+                ('summary_upto', models.IntegerField(null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='games', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'game'), name='core_game_unique_player')],
+            },
+        ),
+    ]
@@ -0,0 +1,85 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+COLUMNS = ("role", "content", "tool_calls", "tool_call_id", "tokens")
+
+
+def split_messages(apps, schema_editor):
+    """Sposta la cronologia salvata nella colonna JSON in una riga per messaggio."""
+    Game = apps.get_model("core", "Game")
+    GameMessage = apps.get_model("core", "GameMessage")
+    for game in Game.objects.exclude(messages=None).iterator():
+        GameMessage.objects.bulk_create([
+            GameMessage(
+                game=game,
+                seq=seq,
+                role=msg["role"],
+                content=msg.get("content"),
+                tool_calls=msg.get("tool_calls"),
+                tool_call_id=msg.get("tool_call_id"),
+                extra={key: value for key, value in msg.items() if key not in COLUMNS} or None,
+                tokens=msg.get("tokens"),
+            )
+            for seq, msg in enumerate(game.messages)
+        ])
+        game.message_count = len(game.messages)
+        game.save(update_fields=["message_count"])
+
+
+def join_messages(apps, schema_editor):
+    """Operazione inversa: ricompone la cronologia nella colonna JSON."""
+    Game = apps.get_model("core", "Game")
+    for game in Game.objects.filter(message_count__gt=0).iterator():
+        messages = []
+        for row in game.history.order_by("seq"):
+            msg = {"role": row.role, "content": row.content}
+            if row.tool_calls is not None:
+                msg["tool_calls"] = row.tool_calls
+            if row.tool_call_id is not None:
+                msg["tool_call_id"] = row.tool_call_id
+            msg.update(row.extra or {})
+            if row.tokens is not None:
+                msg["tokens"] = row.tokens
+            messages.append(msg)
+        game.messages = messages
+        game.save(update_fields=["messages"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_game'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveIntegerField()),
+                ('role', models.CharField(max_length=20)),
+                ('content', models.TextField(null=True)),
+                ('tool_calls', models.JSONField(null=True)),
+                ('tool_call_id', models.CharField(max_length=100, null=True)),
+                ('extra', models.JSONField(null=True)),
+                ('tokens', models.PositiveIntegerField(null=True)),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='history', to='core.game')),
+            ],
+            options={
+                'ordering': ['seq'],
+                'constraints': [models.UniqueConstraint(fields=('game', 'seq'), name='core_gamemessage_seq')],
+            },
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(split_messages, join_messages),
+        migrations.RemoveField(
+            model_name='game',
+            name='messages',
+        ),
+    ]
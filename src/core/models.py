@@ -0,0 +1,75 @@
+from django.conf import settings
+from django.db import models
+
+
+class OpeningScene(models.Model):
+    """Scena d'apertura pre-generata, pronta per la prossima nuova partita di un gioco."""
+    game = models.CharField(max_length=50)
+    # Impronta dei messaggi iniziali usati per generarla: se il prompt cambia, la scena è superata
+    prompt_version = models.CharField(max_length=16)
+    model = models.CharField(max_length=100)
+    content = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["created_at"]
+        indexes = [models.Index(fields=["game", "prompt_version", "created_at"], name="core_opening_pool_idx")]
+
+    def __str__(self):
+        return f"{self.game} ({self.created_at:%Y-%m-%d %H:%M})"
+
+
+class Game(models.Model):
+    """
+    Stato salvato di una partita: una riga per giocatore e gioco (core/gamestate.py).
+    Il giocatore è un utente o, se anonimo, un ospite identificato da una chiave
+    nella sua sessione. Ogni gioco usa solo le colonne che gli servono; le altre restano vuote.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, related_name="games")
+    guest = models.CharField(max_length=32, null=True)  # chiave dell'ospite, per i giocatori anonimi
+    game = models.CharField(max_length=50)
+    version = models.PositiveIntegerField(default=1)  # per il salvataggio con compare-and-swap
+
+    hp = models.IntegerField(null=True)
+    max_hp = models.IntegerField(null=True)
+    level = models.IntegerField(null=True)
+    objectives_completed = models.IntegerField(null=True)
+    current_objective = models.TextField(null=True)
+    player_class = models.CharField(max_length=100, null=True)
+    stats = models.JSONField(null=True)
+    inventory = models.JSONField(null=True)
+    message_count = models.PositiveIntegerField(default=0)  # lunghezza della cronologia in GameMessage
+    summary = models.TextField(null=True)
+    summary_upto = models.IntegerField(null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "game"], name="core_game_unique_player"),
+            models.UniqueConstraint(fields=["guest", "game"], name="core_game_unique_guest"),
+        ]
+
+    def __str__(self):
+        return f"{self.game} di {self.user or 'ospite'} (v{self.version})"
+
+
+class GameMessage(models.Model):
+    """
+    Un messaggio della cronologia di una partita (core/history.py). La cronologia
+    cresce solo in coda: ogni turno inserisce le sue righe e si legge per intervalli di `seq`.
+    """
+    game = models.ForeignKey(Game, on_delete=models.CASCADE, related_name="history")
+    seq = models.PositiveIntegerField()  # posizione nella cronologia, da 0 (prompt di sistema)
+    role = models.CharField(max_length=20)
+    content = models.TextField(null=True)
+    tool_calls = models.JSONField(null=True)
+    tool_call_id = models.CharField(max_length=100, null=True)
+    extra = models.JSONField(null=True)  # altre chiavi del messaggio (es. `name`, `local`)
+    tokens = models.PositiveIntegerField(null=True)
+
+    class Meta:
+        ordering = ["seq"]
+        constraints = [models.UniqueConstraint(fields=["game", "seq"], name="core_gamemessage_seq")]
+
+    def __str__(self):
+        return f"{self.game_id}#{self.seq} ({self.role})"
@@ -0,0 +1,132 @@
+"""
+Pool di scene d'apertura pre-generate, una coda per gioco.
+
+Quando parte una nuova partita la vista preleva una scena già pronta, così il
+giocatore trova subito la narrazione invece di aspettare un giro completo
+dal modello. Ogni prelievo avvia in background il rifornimento del pool
+(client LLM sincrono, in un thread), e al deploy il comando
+`python manage.py warm_openings` lo riempie in anticipo.
+
+Le scene sono salvate nel database locale (`OpeningScene`), con l'impronta dei
+messaggi iniziali del gioco: se il prompt di sistema cambia, quelle vecchie
+vengono ignorate e sostituite.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+from importlib import import_module
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+from core import llm, metrics
+from core.models import OpeningScene
+
+logger = logging.getLogger(__name__)
+
+# Giochi con un rifornimento già in corso in questo processo
+_refilling = set()
+_refilling_lock = threading.Lock()
+
+
+def games():
+    """Giochi che hanno un pool di aperture."""
+    return list(settings.LLM_OPENINGS["games"])
+
+
+def _game_module(game):
+    """Modulo del gioco, che espone `MODEL` e `GameManager`."""
+    return import_module(settings.LLM_OPENINGS["games"][game])
+
+
+def _opening_request(game):
+    """Modello e messaggi iniziali di una nuova partita, con la loro impronta."""
+    module = _game_module(game)
+    manager = module.GameManager({})
+    manager.initialize_new_game()
+    fingerprint = json.dumps([module.MODEL, manager.messages], sort_keys=True, ensure_ascii=False)
+    return module.MODEL, manager.messages, hashlib.sha1(fingerprint.encode()).hexdigest()[:16]
+
+
+def pool_depth(game, prompt_version=None):
+    """Scene pronte per il gioco (aggiorna anche la metrica `openings.depth.<gioco>`)."""
+    if prompt_version is None:
+        prompt_version = _opening_request(game)[2]
+    depth = OpeningScene.objects.filter(game=game, prompt_version=prompt_version).count()
+    metrics.set_gauge(f"openings.depth.{game}", depth)
+    return depth
+
+
+def refill(game, depth=None):
+    """Genera scene finché il pool del gioco non arriva a `depth`. Restituisce quante ne ha create."""
+    depth = depth or settings.LLM_OPENINGS["target_depth"]
+    model, messages, prompt_version = _opening_request(game)
+
+    # Le scene generate con un prompt diverso non verranno più usate
+    OpeningScene.objects.filter(game=game).exclude(prompt_version=prompt_version).delete()
+
+    created = 0
+    for _ in range(depth - pool_depth(game, prompt_version)):
+        try:
+            completion = llm.chat_completion(model, messages, extra_headers={"X-Title": f"{game} (apertura)"})
+            content = (completion.choices[0].message.content or "").strip()
+        except Exception as e:
+            logger.error(f"Errore nella generazione di un'apertura per {game}: {e}")
+            metrics.incr("openings.refill_errors")
+            break
+        if content:
+            OpeningScene.objects.create(game=game, prompt_version=prompt_version, model=model, content=content)
+            created += 1
+
+    pool_depth(game, prompt_version)
+    if created:
+        logger.info(f"Pool aperture {game}: {created} nuove scene")
+    return created
+
+
+def _refill_worker(game):
+    try:
+        refill(game)
+    except Exception as e:
+        logger.error(f"Rifornimento del pool aperture {game} fallito: {e}")
+    finally:
+        with _refilling_lock:
+            _refilling.discard(game)
+        close_old_connections()
+
+
+def refill_in_background(game):
+    """Avvia il rifornimento in un thread, se non ce n'è già uno in corso per lo stesso gioco."""
+    with _refilling_lock:
+        if game in _refilling:
+            return
+        _refilling.add(game)
+    threading.Thread(target=_refill_worker, args=(game,), name=f"openings-{game}", daemon=True).start()
+
+
+def take(game):
+    """
+    Preleva la scena più vecchia del pool, o None se il pool è vuoto.
+    L'eliminazione fa da prenotazione: se due richieste prendono la stessa
+    scena, solo una riesce a cancellarla e l'altra passa alla successiva.
+    """
+    prompt_version = _opening_request(game)[2]
+    content = None
+    for _ in range(3):
+        scene = OpeningScene.objects.filter(game=game, prompt_version=prompt_version).first()
+        if scene is None:
+            break
+        deleted, _ = OpeningScene.objects.filter(pk=scene.pk).delete()
+        if deleted:
+            content = scene.content
+            break
+
+    metrics.incr("openings.hits" if content else "openings.misses")
+    refill_in_background(game)
+    return content
+
+
+atake = sync_to_async(take)
@@ -0,0 +1,186 @@
+"""
+Parser unico delle risposte del DM per i giochi a "frasi magiche" (blamPunk, bmovie).
+
+Tutti i tag riconosciuti sono alternative di un'unica espressione precompilata:
+la risposta viene scandita una sola volta e, per ogni tag trovato, il contenuto
+viene letto con un pattern ancorato alla posizione del tag. Aggiungere un tag
+significa aggiungere un'alternativa, non un'altra passata sul testo.
+
+Vale solo la prima occorrenza di ogni tag (come con `re.search`) e uno stato
+HP assoluto ("Punti ferita attuali: X") ha la precedenza su danni e cure.
+
+`IncrementalParser` applica le stesse regole a una risposta in streaming:
+riceve i frammenti man mano che arrivano e restituisce ogni tag appena è
+completo, anche se era spezzato tra due frammenti. Fanno eccezione danni e
+cure: di solito precedono lo stato HP assoluto che li annulla, quindi vengono
+trattenuti fino alla fine della risposta.
+"""
+
+import re
+from dataclasses import dataclass, field, fields
+
+# Tag che chiudono l'elenco degli oggetti raccolti se compaiono sulla stessa riga
+_TAGS = r"\[(?:OBJECTIVE|CLASS_CHANGE)\]"
+
+# Il lookahead iniziale elenca le lettere con cui può cominciare un tag: il motore
+# salta subito le posizioni che non possono combaciare invece di provare ogni
+# alternativa su ogni carattere. Un nuovo tag va aggiunto anche lì.
+TAG_PATTERN = re.compile(
+    r"(?=[\[HhPp])(?:"
+    r"(?P<hp>(?:Punti ferita|HP) attuali:)"
+    r"|(?P<damage>Hai perso)"
+    r"|(?P<heal>Hai guarito)"
+    r"|(?P<new_class>\[CLASS_CHANGE\])"
+    r"|(?P<items>Hai raccolto)"
+    r"|(?P<objective>\[OBJECTIVE\])"
+    r")",
+    re.IGNORECASE,
+)
+
+# Contenuto di ogni tag, letto subito dopo il tag stesso
+PAYLOAD_PATTERNS = {
+    "hp": re.compile(r"\s*(\d+)"),
+    "damage": re.compile(r"\s+(\d+)\s+punti ferita", re.IGNORECASE),
+    "heal": re.compile(r"\s+(\d+)\s+punti ferita", re.IGNORECASE),
+    "new_class": re.compile(r"\s*(\w+)"),
+    "items": re.compile(rf":?\s*((?:(?!{_TAGS})[^.\n])+)", re.IGNORECASE),
+    "objective": re.compile(r"\s*(.*)"),
+}
+
+# Separatori tra più oggetti raccolti insieme e caratteri di contorno da togliere
+ITEM_SEPARATOR = re.compile(r"[,*]")
+ITEM_STRIP = " \t[]\"'«»"
+
+
+@dataclass
+class ParsedReply:
+    """Cambiamenti di stato annunciati da una risposta del DM."""
+    hp: int | None = None
+    damage: int | None = None
+    heal: int | None = None
+    new_class: str | None = None
+    items: list[str] = field(default_factory=list)
+    objective: str | None = None
+
+    @property
+    def found(self):
+        """Vero se la risposta contiene almeno un tag."""
+        return any((
+            self.hp is not None, self.damage is not None, self.heal is not None,
+            self.new_class, self.items, self.objective,
+        ))
+
+
+def _convert(kind, value):
+    if kind in ("hp", "damage", "heal"):
+        return int(value)
+    if kind == "items":
+        return [item.strip(ITEM_STRIP) for item in ITEM_SEPARATOR.split(value) if item.strip(ITEM_STRIP)]
+    return value.strip()
+
+
+def _values_to_reply(values):
+    if "hp" in values:
+        # Lo stato assoluto è il più affidabile: danni e cure sono già conteggiati
+        values = {kind: value for kind, value in values.items() if kind not in ("damage", "heal")}
+    return ParsedReply(**values)
+
+
+def parse_reply(reply):
+    """Estrae in una sola passata tutti i tag di stato dalla risposta del DM."""
+    values = {}
+    for match in TAG_PATTERN.finditer(reply):
+        kind = match.lastgroup
+        if kind in values:
+            continue
+        payload = PAYLOAD_PATTERNS[kind].match(reply, match.end())
+        if payload:
+            values[kind] = _convert(kind, payload.group(1))
+
+    return _values_to_reply(values)
+
+
+def combine(updates):
+    """Riunisce in un solo `ParsedReply` gli aggiornamenti parziali di `IncrementalParser`."""
+    values = {}
+    for update in updates:
+        values.update({
+            attr.name: getattr(update, attr.name) for attr in fields(update)
+            if getattr(update, attr.name) not in (None, [])
+        })
+    return ParsedReply(**values)
+
+
+# Lunghezza massima dell'intestazione di un tag: la coda del testo più corta di così
+# può contenere un tag spezzato a metà e va riesaminata al frammento successivo
+_HEAD_WINDOW = 24
+# Testo massimo dopo l'intestazione entro cui un contenuto che non combacia ancora
+# è considerato "in arrivo" (es. "Hai perso 4 punt") invece che assente
+_PENDING_WINDOW = 32
+# Tag il cui contenuto finisce con del testo fisso: se combacia, è già completo
+_CLOSED_PAYLOADS = ("damage", "heal")
+
+
+class IncrementalParser:
+    """
+    Versione a spinta di `parse_reply` per le risposte in streaming.
+    `feed` restituisce, come `ParsedReply` di un solo campo, i tag completati dal
+    nuovo frammento; `finish` chiude lo stream e completa quelli rimasti in sospeso.
+    Danni e cure arrivano solo da `finish`, se la risposta non contiene uno stato
+    HP assoluto: così il giocatore non vede un avviso che `parse_reply` scarterebbe.
+    Alla fine `result` coincide con `parse_reply` applicato al testo intero.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._values = {}
+        self._held = []
+
+    def feed(self, text):
+        self._buffer += text
+        return self._scan(final=False)
+
+    def finish(self):
+        updates = self._scan(final=True)
+        if "hp" not in self._values:
+            updates = self._held + updates
+        self._held = []
+        return updates
+
+    @property
+    def result(self):
+        return _values_to_reply(self._values)
+
+    def _pending(self, kind, payload, head_end):
+        """Vero se il contenuto del tag potrebbe cambiare con i prossimi frammenti."""
+        remaining = len(self._buffer) - head_end
+        if payload is None:
+            return remaining < _PENDING_WINDOW and "\n" not in self._buffer[head_end:]
+        return kind not in _CLOSED_PAYLOADS and payload.end() == len(self._buffer)
+
+    def _scan(self, final):
+        updates = []
+        resume = None
+        last_end = self._pos
+        for match in TAG_PATTERN.finditer(self._buffer, self._pos):
+            kind = match.lastgroup
+            payload = PAYLOAD_PATTERNS[kind].match(self._buffer, match.end())
+            if not final and self._pending(kind, payload, match.end()):
+                resume = match.start()
+                break
+            last_end = match.end()
+            if payload is None or kind in self._values:
+                continue
+            value = _convert(kind, payload.group(1))
+            self._values[kind] = value
+            if kind in ("damage", "heal"):
+                # Trattenuti: uno stato HP assoluto più avanti li annullerebbe
+                self._held.append(ParsedReply(**{kind: value}))
+                continue
+            updates.append(ParsedReply(**{kind: value}))
+
+        if resume is None:
+            resume = len(self._buffer) if final else max(last_end, len(self._buffer) - _HEAD_WINDOW)
+        self._pos = max(self._pos, resume)
+        return updates
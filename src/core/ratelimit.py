@@ -0,0 +1,159 @@
+"""
+Limitazione della frequenza delle richieste (token bucket) sulle viste di gioco.
+
+Ogni POST alla chat costa una chiamata al modello: un client difettoso o
+malintenzionato potrebbe consumare da solo budget e capacità del servizio.
+Ogni giocatore ha un "secchiello" di gettoni per gioco e per endpoint: ogni
+richiesta ne consuma uno e i gettoni si ricaricano a velocità costante. Il
+secchiello è per utente autenticato o, per i giocatori anonimi, per indirizzo IP.
+
+Le regole sono in `RATE_LIMITS` (`config/settings.py`), per gioco con un
+default comune; lo stato vive nella cache di Django, quindi con una cache
+condivisa (es. Redis) il limite vale per tutti i worker. Lettura e scrittura
+del secchiello avvengono sotto un lucchetto nella cache: una raffica di
+richieste parallele non può leggere tutta lo stesso secchiello pieno.
+
+Le richieste in eccesso ricevono una risposta che la chat sa mostrare: un
+messaggio flash e il redirect per le viste classiche, un JSON 429 con
+`Retry-After` per lo streaming. Metrica: `ratelimit.throttled.<gioco>.<endpoint>`.
+"""
+
+import asyncio
+import logging
+import math
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.contrib import messages as flash
+from django.core.cache import cache
+from django.http import JsonResponse
+from django.shortcuts import redirect
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+LOCK_TIMEOUT = 2    # secondi di vita del lucchetto di un secchiello
+LOCK_WAIT = 1.0     # attesa massima del lucchetto: oltre, la richiesta viene limitata
+LOCK_POLL = 0.01
+
+
+def rule(game_id, endpoint):
+    """Regola `{"capacity", "per_minute"}` del gioco per l'endpoint, o None se non limitato."""
+    limits = settings.RATE_LIMITS
+    return limits.get(game_id, {}).get(endpoint) or limits["default"].get(endpoint)
+
+
+def client_ip(request):
+    # nginx (proxy_params) inoltra l'indirizzo del client in X-Real-IP; gunicorn ascolta
+    # solo sul socket locale, quindi l'intestazione non può arrivare da fuori
+    return request.META.get("HTTP_X_REAL_IP") or request.META.get("REMOTE_ADDR", "")
+
+
+def _identity(request, user):
+    if user.is_authenticated:
+        return f"user:{user.pk}"
+    return f"ip:{client_ip(request)}"
+
+
+def _refill(state, limit, now):
+    """Gettoni disponibili adesso, dato lo stato salvato `(gettoni, istante)`."""
+    tokens, updated = state if state else (limit["capacity"], now)
+    return min(limit["capacity"], tokens + (now - updated) * limit["per_minute"] / 60)
+
+
+def _consume(tokens, limit):
+    """Restituisce `(gettoni rimasti, secondi di attesa)`: attesa 0 se la richiesta passa."""
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) * 60 / limit["per_minute"]
+
+
+def _ttl(limit):
+    # Oltre il tempo di ricarica completa lo stato equivale a un secchiello pieno
+    return math.ceil(limit["capacity"] * 60 / limit["per_minute"]) + 60
+
+
+def take(key, limit):
+    """Consuma un gettone dal secchiello `key`; restituisce i secondi da attendere (0 = ok)."""
+    lock = f"{key}:lock"
+    deadline = time.monotonic() + LOCK_WAIT
+    while not cache.add(lock, 1, timeout=LOCK_TIMEOUT):
+        if time.monotonic() >= deadline:
+            return LOCK_WAIT  # Troppe richieste contemporanee sullo stesso secchiello
+        time.sleep(LOCK_POLL)
+    try:
+        now = time.time()
+        tokens, wait = _consume(_refill(cache.get(key), limit, now), limit)
+        cache.set(key, (tokens, now), timeout=_ttl(limit))
+        return wait
+    finally:
+        cache.delete(lock)
+
+
+async def atake(key, limit):
+    """Versione asincrona di `take`."""
+    lock = f"{key}:lock"
+    deadline = time.monotonic() + LOCK_WAIT
+    while not await cache.aadd(lock, 1, timeout=LOCK_TIMEOUT):
+        if time.monotonic() >= deadline:
+            return LOCK_WAIT  # Troppe richieste contemporanee sullo stesso secchiello
+        await asyncio.sleep(LOCK_POLL)
+    try:
+        now = time.time()
+        tokens, wait = _consume(_refill(await cache.aget(key), limit, now), limit)
+        await cache.aset(key, (tokens, now), timeout=_ttl(limit))
+        return wait
+    finally:
+        await cache.adelete(lock)
+
+
+def _throttled(request, game_id, endpoint, wait, redirect_to):
+    retry_after = max(1, math.ceil(wait))
+    metrics.incr(f"ratelimit.throttled.{game_id}.{endpoint}")
+    logger.info(f"Richiesta limitata su {game_id}/{endpoint} da {client_ip(request)} (riprova tra {retry_after}s)")
+    message = f"⏳ Stai andando troppo veloce: riprova tra {retry_after} secondi."
+    if "text/event-stream" in request.headers.get("Accept", ""):
+        response = JsonResponse({"error": message, "retry_after": retry_after}, status=429)
+        response["Retry-After"] = str(retry_after)
+        return response
+    flash.warning(request, message)
+    return redirect(redirect_to or request.path)
+
+
+def rate_limited(game_id, endpoint, methods=("POST",), redirect_to=None):
+    """
+    Decoratore per le viste (sincrone o asincrone) che applica la regola
+    `RATE_LIMITS` di `game_id`/`endpoint` alle richieste con metodo in `methods`
+    (tutte se None). `redirect_to` è la pagina su cui tornare se la richiesta è
+    limitata (di default la stessa URL).
+    """
+    def applies(request):
+        return methods is None or request.method in methods
+
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                limit = rule(game_id, endpoint)
+                if limit and applies(request):
+                    user = await request.auser()
+                    key = f"ratelimit:{game_id}:{endpoint}:{_identity(request, user)}"
+                    wait = await atake(key, limit)
+                    if wait:
+                        return _throttled(request, game_id, endpoint, wait, redirect_to)
+                return await view(request, *args, **kwargs)
+        else:
+            @wraps(view)
+            def wrapper(request, *args, **kwargs):
+                limit = rule(game_id, endpoint)
+                if limit and applies(request):
+                    key = f"ratelimit:{game_id}:{endpoint}:{_identity(request, request.user)}"
+                    wait = take(key, limit)
+                    if wait:
+                        return _throttled(request, game_id, endpoint, wait, redirect_to)
+                return view(request, *args, **kwargs)
+        return wrapper
+
+    return decorator
@@ -0,0 +1,246 @@
+"""
+Resilienza delle chiamate al modello.
+
+Ogni chiamata passa da qui (vedi `core/llm.py`):
+-   ritentativi con backoff esponenziale e jitter, solo per gli errori transitori
+    (connessione, timeout, 429, 5xx);
+-   una scadenza (`Deadline`) condivisa da tutte le chiamate dello stesso turno:
+    i tentativi e lo streaming non possono sforarla, così un provider lento non
+    tiene occupato il worker oltre il tempo concesso al turno;
+-   un circuit breaker per modello: dopo troppi errori consecutivi le chiamate
+    falliscono subito per un periodo di raffreddamento, poi un'unica richiesta di
+    prova decide se riaprire il traffico.
+
+I parametri sono in `LLM_RESILIENCE` (`config/settings.py`).
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import openai
+from django.conf import settings
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+# Codici HTTP per cui ha senso riprovare
+RETRYABLE_STATUS = {408, 409, 429}
+# Errori nella richiesta: il provider ha risposto, quindi il modello è sano
+REQUEST_ERROR_STATUS = {400, 422}
+
+
+class DeadlineExceeded(Exception):
+    """Il turno ha esaurito il tempo a disposizione."""
+
+
+class CircuitOpenError(Exception):
+    """Il modello è considerato non disponibile: la chiamata non viene nemmeno tentata."""
+
+
+class Deadline:
+    """Scadenza assoluta di un turno, da passare a tutte le sue chiamate al modello."""
+
+    def __init__(self, seconds=None):
+        if seconds is None:
+            seconds = settings.LLM_RESILIENCE["turn_deadline"]
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self):
+        if self.expired:
+            metrics.incr("llm.deadline_exceeded")
+            raise DeadlineExceeded("tempo del turno esaurito")
+
+
+class CircuitBreaker:
+    """
+    Interruttore per un modello: chiuso finché le chiamate vanno a buon fine, aperto
+    dopo `failure_threshold` errori consecutivi. Trascorso `cooldown` lascia passare
+    una sola chiamata di prova: se riesce si richiude, altrimenti si riapre.
+    """
+
+    def __init__(self, name, failure_threshold, cooldown):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        if self._probing or time.monotonic() - self._opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        """Vero se la chiamata può partire."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"Circuit breaker {self.name}: chiuso, il modello risponde di nuovo")
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def release(self):
+        """Esito che non dice nulla sulla salute del modello: la prova in corso termina senza cambiare stato."""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or (self._opened_at is None and self._failures >= self.failure_threshold):
+                logger.warning(f"Circuit breaker {self.name}: aperto dopo {self._failures} errori consecutivi")
+                metrics.incr(f"llm.breaker.opened.{self.name}")
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(model):
+    """Restituisce il circuit breaker del modello, creandolo alla prima chiamata."""
+    with _breakers_lock:
+        if model not in _breakers:
+            options = settings.LLM_RESILIENCE
+            _breakers[model] = CircuitBreaker(model, options["breaker_failures"], options["breaker_cooldown"])
+        return _breakers[model]
+
+
+def breaker_states():
+    """Stato dei circuit breaker del processo, per le metriche."""
+    with _breakers_lock:
+        return {model: b.state for model, b in _breakers.items()}
+
+
+def is_retryable(error):
+    """Vero per gli errori transitori del provider, per cui ha senso riprovare."""
+    if isinstance(error, openai.APIConnectionError):  # Comprende i timeout
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    return False
+
+
+def _backoff(attempt, deadline):
+    """Attesa prima del tentativo successivo (full jitter), entro la scadenza del turno."""
+    options = settings.LLM_RESILIENCE
+    delay = random.uniform(0, min(options["backoff_cap"], options["backoff_base"] * 2 ** attempt))
+    if deadline is not None:
+        delay = min(delay, deadline.remaining())
+    return delay
+
+
+def _before_attempt(model, circuit, deadline):
+    if not circuit.allow():
+        metrics.incr(f"llm.breaker.rejected.{model}")
+        raise CircuitOpenError(f"modello {model} temporaneamente non disponibile")
+    if deadline is not None:
+        deadline.check()
+    return deadline.remaining() if deadline is not None else None
+
+
+def _after_error(model, circuit, error, attempt):
+    """Registra l'errore e restituisce True se va ritentato."""
+    if not is_retryable(error):
+        if not isinstance(error, openai.APIStatusError):
+            # Errore nel nostro codice, non nel provider: non prova niente sul modello
+            circuit.release()
+        elif error.status_code in REQUEST_ERROR_STATUS:
+            # Il provider ha risposto (es. 400): è sano, l'errore è nella richiesta
+            circuit.record_success()
+        else:
+            # Chiave revocata, credito esaurito, modello rimosso (401/402/404...): ritentare
+            # è inutile, ma il modello non risponde e le chiamate devono passare alla riserva
+            circuit.record_failure()
+            metrics.incr(f"llm.errors.{model}")
+            logger.error(f"Errore non recuperabile da {model}: {error}")
+        return False
+    circuit.record_failure()
+    metrics.incr(f"llm.errors.{model}")
+    retry = attempt + 1 < settings.LLM_RESILIENCE["max_attempts"]
+    if retry:
+        metrics.incr("llm.retries")
+        logger.warning(f"Errore transitorio da {model} (tentativo {attempt + 1}): {error}")
+    return retry
+
+
+def call(model, send, deadline=None):
+    """
+    Esegue `send(timeout)` con ritentativi e circuit breaker. `timeout` è il tempo
+    rimasto al turno (None senza scadenza) e va usato come limite del singolo tentativo.
+    """
+    circuit = breaker(model)
+    attempt = 0
+    while True:
+        timeout = _before_attempt(model, circuit, deadline)
+        try:
+            result = send(timeout)
+        except Exception as e:
+            if not _after_error(model, circuit, e, attempt):
+                raise
+            time.sleep(_backoff(attempt, deadline))
+            attempt += 1
+            continue
+        circuit.record_success()
+        return result
+
+
+async def acall(model, send, deadline=None):
+    """Versione asincrona di `call`: `send(timeout)` è una coroutine."""
+    circuit = breaker(model)
+    attempt = 0
+    while True:
+        timeout = _before_attempt(model, circuit, deadline)
+        try:
+            result = await send(timeout)
+        except Exception as e:
+            if not _after_error(model, circuit, e, attempt):
+                raise
+            await asyncio.sleep(_backoff(attempt, deadline))
+            attempt += 1
+            continue
+        circuit.record_success()
+        return result
+
+
+async def guard_stream(stream, deadline):
+    """Inoltra i chunk di uno stream, interrompendolo se il turno supera la scadenza."""
+    iterator = stream.__aiter__()
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(iterator.__anext__(), deadline.remaining())
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                metrics.incr("llm.deadline_exceeded")
+                raise DeadlineExceeded("tempo del turno esaurito durante lo streaming") from None
+            yield chunk
+    finally:
+        await stream.close()
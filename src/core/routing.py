@@ -0,0 +1,131 @@
+"""
+Instradamento dei turni tra modelli di fascia diversa.
+
+Non tutti i turni meritano il modello più caro: "mi guardo intorno" può
+andare a un modello veloce ed economico, mentre combattimenti, tiri di dado e
+obiettivi in chiusura restano al modello premium. Il turno viene classificato
+in locale, senza chiamate aggiuntive, sommando alcuni segnali:
+-   lunghezza del messaggio del giocatore;
+-   risultato di un tiro di dado;
+-   parole da scena chiave (combattimento, scelte decisive) o che richiamano
+    l'obiettivo corrente, segno che potrebbe essere completato;
+-   livello del personaggio e HP bassi;
+-   strumenti usati di recente (uno scontro è probabilmente ancora in corso).
+
+Con un punteggio da `LLM_ROUTING["key_score"]` in su il turno è "key", altrimenti
+"routine". Il modello di ogni fascia è in `LLM_GAMES[<gioco>]["tiers"]`; senza
+tabella il gioco usa sempre il suo `MODEL`.
+
+Ogni decisione viene registrata con latenza, costo e token del prompt letti
+dalla cache del turno, per poter tarare la politica:
+`routing.turns|latency|cost_usd|prompt_tokens|cached_tokens.<gioco>.<fascia>`.
+Alternare i modelli può far perdere la cache del prefisso: la quota di token
+dalla cache per fascia (`cache_hit_rate`) dice se il risparmio è reale.
+"""
+
+import logging
+import re
+from dataclasses import dataclass, field
+
+from django.conf import settings
+
+from core import llm, metrics
+
+logger = logging.getLogger(__name__)
+
+ROUTINE = "routine"
+KEY = "key"
+
+DICE_PATTERN = re.compile(r"\*\*TIRO\b|\btiro\b|\bd20\b", re.IGNORECASE)
+KEY_SCENE_PATTERN = re.compile(
+    r"\b(attacc\w*|combatt\w*|uccid\w*|colpisc\w*|affront\w*|sfid\w*|duell\w*|tradi\w*|"
+    r"giur\w*|sacrific\w*|evoc\w*|incantesim\w*|scelgo|decido|consegn\w*)\b",
+    re.IGNORECASE,
+)
+WORD_PATTERN = re.compile(r"\w{5,}")
+
+
+@dataclass
+class Route:
+    """Decisione di instradamento di un turno."""
+    tier: str
+    model: str
+    score: int = 0
+    reasons: list = field(default_factory=list)
+
+
+def _signals(game, user_input):
+    """Segnali che indicano una scena chiave, come `(punti, motivo)`."""
+    options = settings.LLM_ROUTING
+    if len(user_input) >= options["long_input_chars"]:
+        yield 1, "messaggio lungo"
+    if DICE_PATTERN.search(user_input):
+        yield 2, "tiro di dado"
+    if KEY_SCENE_PATTERN.search(user_input):
+        yield 2, "scena chiave"
+    objective_words = {word.lower() for word in WORD_PATTERN.findall(game.current_objective or "")}
+    if objective_words & {word.lower() for word in WORD_PATTERN.findall(user_input)}:
+        yield 1, "obiettivo in gioco"
+    if game.level >= options["high_level"]:
+        yield 1, "livello alto"
+    if game.hp <= game.max_hp * options["low_hp_ratio"]:
+        yield 1, "HP bassi"
+    recent = game.messages[-options["recent_messages"]:]
+    if any(msg.get("role") == "tool" for msg in recent):
+        yield 1, "strumenti usati di recente"
+
+
+def route(game_id, game, user_input, default_model):
+    """Sceglie il modello del turno secondo la tabella delle fasce del gioco."""
+    tiers = settings.LLM_GAMES.get(game_id, {}).get("tiers")
+    if not tiers:
+        return Route(KEY, default_model)
+
+    score = 0
+    reasons = []
+    for points, reason in _signals(game, user_input):
+        score += points
+        reasons.append(reason)
+    tier = KEY if score >= settings.LLM_ROUTING["key_score"] else ROUTINE
+    return Route(tier, tiers.get(tier, default_model), score, reasons)
+
+
+def record(game_id, decision, elapsed, usages):
+    """
+    Registra latenza, costo e token dalla cache di un turno instradato. `usages`
+    sono le coppie `(modello, usage)` di tutte le chiamate del turno.
+    """
+    cost = sum(llm.usage_cost(model, usage) for model, usage in usages)
+    prompt = sum(usage.prompt_tokens or 0 for _, usage in usages if usage is not None)
+    cached = sum(llm.cached_tokens(usage) for _, usage in usages if usage is not None)
+    key = f"{game_id}.{decision.tier}"
+    metrics.incr(f"routing.turns.{key}")
+    metrics.observe(f"routing.latency.{key}", elapsed)
+    metrics.incr(f"routing.cost_usd.{key}", cost)
+    metrics.incr(f"routing.prompt_tokens.{key}", prompt)
+    metrics.incr(f"routing.cached_tokens.{key}", cached)
+    logger.info(
+        f"Routing {game_id}: {decision.tier} -> {decision.model} "
+        f"(punteggio {decision.score}: {', '.join(decision.reasons) or 'nessun segnale'}), "
+        f"{elapsed:.2f}s, ${cost:.5f}, {cached}/{prompt} token dalla cache"
+    )
+
+
+def routing_stats():
+    """Per gioco e fascia: turni, latenza mediana, costo medio per turno e quota di prompt dalla cache."""
+    counters = metrics.snapshot()["counters"]
+    stats = {}
+    for game_id in settings.LLM_GAMES:
+        for tier in (ROUTINE, KEY):
+            key = f"{game_id}.{tier}"
+            turns = counters.get(f"routing.turns.{key}", 0)
+            if not turns:
+                continue
+            prompt = counters.get(f"routing.prompt_tokens.{key}", 0)
+            stats.setdefault(game_id, {})[tier] = {
+                "turns": turns,
+                "latency_p50": metrics.percentile(f"routing.latency.{key}", 50),
+                "cost_per_turn": round(counters.get(f"routing.cost_usd.{key}", 0) / turns, 6),
+                "cache_hit_rate": round(counters.get(f"routing.cached_tokens.{key}", 0) / prompt, 3) if prompt else None,
+            }
+    return stats
@@ -0,0 +1,162 @@
+"""
+Motore di regole locale: risolve i comandi deterministici del giocatore senza chiamare l'AI.
+
+Riconosce solo frasi brevi e inequivocabili ("inventario", "hp", "aiuto",
+"usa pozione"...): tutto il resto, comprese le azioni narrative che nominano
+gli stessi concetti, prosegue verso il modello. A partita finita (HP a zero)
+nessun input arriva più all'AI.
+
+I messaggi di un turno risolto in locale restano in cronologia con la chiave
+`local`: il giocatore li rivede nella chat, ma non vengono inviati al modello.
+Fanno eccezione i comandi che cambiano lo stato (es. l'uso di un consumabile),
+che l'AI deve conoscere per proseguire la storia.
+"""
+
+import re
+
+from core import metrics
+
+GAME_OVER_TEXT = (
+    "💀 Il tuo personaggio è caduto e la sua storia finisce qui. "
+    "Inizia una nuova partita o carica un salvataggio per continuare."
+)
+
+ARTICLE = r"(?:(?:il|lo|la|i|gli|le|un|uno|una)\s+|l'|un')?"
+
+
+def is_game_over(game):
+    """Vero se il gioco tiene gli HP e il personaggio è a zero."""
+    hp = getattr(game, "hp", None)
+    return hp is not None and hp <= 0
+
+
+def _normalize(user_input):
+    return re.sub(r"\s+", " ", user_input.strip().lower()).rstrip("?!. ")
+
+
+def _inventory(game, match):
+    if not hasattr(game, "inventory"):
+        return None
+    if not game.inventory:
+        return "🎒 Il tuo inventario è vuoto."
+    return "🎒 Nel tuo inventario: " + ", ".join(item.capitalize() for item in game.inventory) + "."
+
+
+def _stats(game, match):
+    if not getattr(game, "stats", None):
+        return None
+    parts = []
+    if hasattr(game, "level"):
+        parts.append(f"Livello {game.level}.")
+    if getattr(game, "player_class", None):
+        parts.append(f"Classe: {game.player_class}.")
+    stats = ", ".join(f"{name.capitalize()} {value}" for name, value in game.stats.items())
+    parts.append(f"Caratteristiche: {stats}.")
+    return "⭐ " + " ".join(parts)
+
+
+def _hp(game, match):
+    if getattr(game, "hp", None) is None:
+        return None
+    return f"❤️ Punti ferita: {game.hp}/{game.max_hp}."
+
+
+def _objective(game, match):
+    if not getattr(game, "current_objective", None):
+        return None
+    return f"🎯 Obiettivo attuale: {game.current_objective}."
+
+
+def _use(game, match):
+    # None se l'oggetto non è un consumabile: l'uso creativo lo racconta l'AI
+    if not hasattr(game, "use_item"):
+        return None
+    return game.use_item(match.group(1))
+
+
+def _help(game, match):
+    commands = ["aiuto (questo elenco)"]
+    if hasattr(game, "inventory"):
+        commands.append("inventario (gli oggetti che porti con te)")
+    if getattr(game, "hp", None) is not None:
+        commands.append("hp (i tuoi punti ferita)")
+    if getattr(game, "stats", None):
+        commands.append("statistiche (livello e caratteristiche)")
+    if getattr(game, "current_objective", None):
+        commands.append("obiettivo (la missione in corso)")
+    if hasattr(game, "use_item"):
+        commands.append("usa <oggetto> (consuma un oggetto curativo)")
+    return (
+        "📜 Comandi rapidi, con risposta immediata: " + ", ".join(commands) + ". "
+        "Qualsiasi altra frase viene narrata dal DM."
+    )
+
+
+# (nome, frase riconosciuta, gestore, il risultato va ricordato all'AI)
+COMMANDS = (
+    ("help", re.compile(r"aiuto|help|comandi"), _help, False),
+    ("inventory", re.compile(r"inventario|inv|zaino|cosa (?:ho|porto)(?: con me| addosso)?"), _inventory, False),
+    ("stats", re.compile(r"stat|statistiche|caratteristiche|scheda(?: personaggio)?"), _stats, False),
+    ("hp", re.compile(r"hp|pf|punti ferita|salute|come sto"), _hp, False),
+    ("objective", re.compile(r"obiettivo|missione|cosa devo fare"), _objective, False),
+    ("use", re.compile(rf"(?:usa|uso|bevi|bevo|mangia|mangio) {ARTICLE}(.+)"), _use, True),
+)
+
+
+def resolve(game, user_input):
+    """
+    Restituisce `(risposta, da_ricordare)` se il comando si risolve in locale,
+    altrimenti None e il turno va passato all'AI.
+    """
+    if is_game_over(game):
+        metrics.incr("rules.local_turns")
+        metrics.incr("rules.game_over")
+        return GAME_OVER_TEXT, False
+
+    text = _normalize(user_input)
+    for name, pattern, handler, remember in COMMANDS:
+        match = pattern.fullmatch(text)
+        if not match:
+            continue
+        reply = handler(game, match)
+        if reply is not None:
+            metrics.incr("rules.local_turns")
+            metrics.incr(f"rules.{name}")
+            return reply, remember
+    return None
+
+
+def local_turn(game, user_input, reply, remember=False):
+    """Registra un turno risolto in locale e produce gli stessi eventi di un turno dell'AI."""
+    extra = {} if remember else {"local": True}
+    game.messages.append({"role": "user", "content": user_input, **extra})
+    yield "user", {"content": user_input}
+    game.messages.append({"role": "assistant", "content": reply, **extra})
+    yield "message", {}
+    yield "token", {"text": reply}
+
+
+def use_consumable(game, item_name, consumables):
+    """
+    Consuma un oggetto dell'inventario secondo la tabella `consumables`
+    (parola chiave nel nome -> effetti) e restituisce il messaggio per il giocatore,
+    oppure None se l'oggetto non c'è o non è un consumabile.
+    """
+    wanted = (item_name or "").strip().lower()
+    if not wanted:
+        return None
+    item = next((i for i in game.inventory if i.lower() == wanted), None)
+    if item is None:
+        item = next((i for i in game.inventory if wanted in i.lower()), None)
+    if item is None:
+        return None
+
+    effect = next((effect for keyword, effect in consumables.items() if keyword in item.lower()), None)
+    if effect is None:
+        return None
+
+    game.inventory.remove(item)
+    old_hp = game.hp
+    game.hp = min(game.max_hp, game.hp + effect.get("heal", 0))
+    metrics.incr("rules.items_used")
+    return effect["message"].format(item=item.capitalize(), healed=game.hp - old_hp, hp=game.hp, max_hp=game.max_hp)
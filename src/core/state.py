@@ -0,0 +1,15 @@
+"""
+Accesso allo stato di gioco dalle viste asincrone.
+
+Sessione e utente di Django vengono caricati in modo pigro e con query sincrone:
+in una vista `async` vanno quindi risolti prima di usare `GameManager` o di
+renderizzare un template, altrimenti Django solleva `SynchronousOnlyOperation`.
+"""
+
+
+async def aload_request_state(request):
+    """Carica in modo asincrono la sessione e l'utente della richiesta."""
+    # Popola la cache della sessione: da qui in poi `session.get()` non fa query
+    await request.session.aitems()
+    # Sostituisce l'utente pigro con quello già caricato (usato anche dai template)
+    request.user = await request.auser()
@@ -0,0 +1,108 @@
+"""
+Streaming dei turni di gioco verso il browser tramite Server-Sent Events.
+
+Un turno è un generatore di eventi `(nome, dati)`:
+-   `user`: il messaggio del giocatore così come è stato registrato (es. col risultato del dado);
+-   `message`: inizia un nuovo messaggio del DM;
+-   `token`: un frammento di testo del DM;
+-   `state`: lo stato aggiornato per la sidebar (HP, inventario, obiettivo...);
+-   `notice`: una notifica da mostrare (equivalente dei messaggi flash);
+-   `done`: il turno è concluso e lo stato è stato salvato.
+"""
+
+import json
+
+from django.contrib import messages as flash
+from django.http import StreamingHttpResponse
+from openai.types.chat import ChatCompletionMessageToolCall
+from openai.types.chat.chat_completion_message_tool_call import Function
+
+
+def sse_event(event, data):
+    """Formatta un singolo evento SSE."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _format_events(events):
+    async for event, data in events:
+        yield sse_event(event, data)
+
+
+def sse_response(events):
+    """Avvolge un generatore asincrono di eventi `(nome, dati)` in una risposta `text/event-stream`."""
+    response = StreamingHttpResponse(_format_events(events), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # Evita che nginx bufferizzi lo stream
+    return response
+
+
+async def drain(events):
+    """Consuma un turno senza inoltrare gli eventi (percorso classico POST-redirect-GET)."""
+    async for _ in events:
+        pass
+
+
+def notice_events(request):
+    """
+    Trasforma i messaggi flash accodati durante il turno in eventi `notice`.
+    Con una risposta in streaming il middleware dei messaggi ha già chiuso la
+    richiesta, quindi le notifiche vanno consegnate dentro lo stream stesso.
+    """
+    for message in flash.get_messages(request):
+        yield "notice", {"level": message.level_tag, "text": str(message)}
+
+
+async def iter_text(stream):
+    """Restituisce i frammenti di testo di una chat completion in streaming."""
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+class StreamedReply:
+    """
+    Ricompone una chat completion in streaming: accumula il testo e le
+    chiamate agli strumenti, che arrivano a pezzi indicizzati.
+    """
+
+    def __init__(self):
+        self._parts = []
+        self._tool_calls = {}
+        self.usage = None
+
+    def feed(self, chunk):
+        """Assorbe un chunk e restituisce il testo nuovo (stringa vuota se non ce n'è)."""
+        if getattr(chunk, "usage", None):
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return ""
+        delta = chunk.choices[0].delta
+
+        for tool_delta in delta.tool_calls or []:
+            call = self._tool_calls.setdefault(tool_delta.index, {"id": "", "name": "", "arguments": ""})
+            if tool_delta.id:
+                call["id"] = tool_delta.id
+            if tool_delta.function:
+                call["name"] += tool_delta.function.name or ""
+                call["arguments"] += tool_delta.function.arguments or ""
+
+        if delta.content:
+            self._parts.append(delta.content)
+            return delta.content
+        return ""
+
+    @property
+    def content(self):
+        return "".join(self._parts)
+
+    @property
+    def tool_calls(self):
+        """Le chiamate agli strumenti ricomposte, nello stesso formato della risposta non in streaming."""
+        return [
+            ChatCompletionMessageToolCall(
+                id=call["id"],
+                type="function",
+                function=Function(name=call["name"], arguments=call["arguments"] or "{}"),
+            )
+            for _, call in sorted(self._tool_calls.items())
+        ]
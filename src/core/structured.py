@@ -0,0 +1,279 @@
+"""
+Modalità di output strutturato (JSON) per i giochi che non usano il tool calling.
+
+Invece di scrivere frasi magiche ("Punti ferita attuali: X", "Hai raccolto: ...")
+che poi vanno estratte con le regex, il modello risponde con un oggetto JSON
+validato da uno schema:
+    {"narration": "...testo per il giocatore...", "state": {...cambiamenti del turno...}}
+Il testo di `narration` viene inoltrato al browser man mano che arriva, lo
+`state` viene convertito nello stesso `ParsedReply` del parser a regex e applicato
+al `GameManager` in un colpo solo. Se il JSON manca o non rispetta lo schema,
+si ricade sul parsing a regex.
+
+La modalità si attiva per gioco con `LLM_GAMES[<gioco>]["structured_output"]`.
+Metriche: `structured.ok.<gioco>` / `structured.fallback.<gioco>` (tasso di
+successo del parsing) e `turns.<gioco>.<modalità>` / `turns.corrective.<gioco>.<modalità>`
+(turni in cui il giocatore corregge lo stato, per confrontare json e regex).
+"""
+
+import json
+import logging
+import re
+
+from django.conf import settings
+
+from core import metrics
+from core.parsing import IncrementalParser, ParsedReply, combine, parse_reply
+
+logger = logging.getLogger(__name__)
+
+# Schema JSON di ogni campo di stato; i giochi scelgono quali usare
+FIELD_SCHEMAS = {
+    "hp": {"type": ["integer", "null"], "description": "Punti ferita attuali se sono cambiati in questo turno, altrimenti null."},
+    "damage": {"type": "integer", "description": "Punti ferita persi in questo turno (0 se nessuno)."},
+    "heal": {"type": "integer", "description": "Punti ferita recuperati in questo turno (0 se nessuno)."},
+    "new_class": {"type": ["string", "null"], "description": "Nuovo archetipo del personaggio, oppure null."},
+    "items": {"type": "array", "items": {"type": "string"}, "description": "Oggetti raccolti in questo turno."},
+    "objective": {"type": ["string", "null"], "description": "Nuovo obiettivo principale, oppure null se invariato."},
+}
+
+FIELD_HINTS = {
+    "hp": "hp = punti ferita attuali se sono cambiati (altrimenti null)",
+    "damage": "damage = punti ferita persi (0 se nessuno)",
+    "heal": "heal = punti ferita recuperati (0 se nessuno)",
+    "new_class": "new_class = nuovo archetipo quando il personaggio cambia classe (altrimenti null)",
+    "items": "items = oggetti raccolti",
+    "objective": "objective = nuovo obiettivo principale (null se invariato)",
+}
+
+# Frasi con cui il giocatore segnala che lo stato tenuto dal gioco è sbagliato (euristica)
+CORRECTIVE_PATTERN = re.compile(
+    r"\b(?:non (?:ho|mi hai|hai) (?:perso|raccolto|dato|aggiunto|tolto|segnato|aggiornato)"
+    r"|dovrei avere|avevo già|hai dimenticato|ti sei dimenticato"
+    r"|(?:hp|punti ferita|inventario|obiettivo) (?:è |sono )?sbagliat"
+    r"|(?:manca|mancano) (?:nell'|dall')inventario)",
+    re.IGNORECASE,
+)
+
+
+def enabled(game_id):
+    """Vero se il gioco usa l'output strutturato."""
+    return settings.LLM_GAMES.get(game_id, {}).get("structured_output", False)
+
+
+def response_format(fields):
+    """Parametro `response_format` con lo schema del turno per i campi di stato indicati."""
+    state = {
+        "type": "object",
+        "properties": {name: FIELD_SCHEMAS[name] for name in fields},
+        "required": list(fields),
+        "additionalProperties": False,
+    }
+    schema = {
+        "type": "object",
+        "properties": {"narration": {"type": "string"}, "state": state},
+        "required": ["narration", "state"],
+        "additionalProperties": False,
+    }
+    return {"type": "json_schema", "json_schema": {"name": "turno_dm", "strict": True, "schema": schema}}
+
+
+def format_message(fields):
+    """Istruzione sul formato, da mettere in coda al prompt (non nel prompt di sistema, che resta stabile)."""
+    hints = "; ".join(FIELD_HINTS[name] for name in fields) or "nessun campo"
+    return {
+        "role": "user",
+        "content": (
+            "[FORMATO RISPOSTA] Rispondi SOLO con un oggetto JSON. In \"narration\" scrivi il testo per il "
+            "giocatore, senza frasi di servizio (\"Punti ferita attuali\", \"Hai raccolto\"...) e senza tag "
+            f"come [OBJECTIVE]. In \"state\" riporta i cambiamenti di questo turno: {hints}."
+        ),
+    }
+
+
+def _check(value, schema):
+    types = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+    checks = {
+        "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+        "string": lambda v: isinstance(v, str),
+        "null": lambda v: v is None,
+        "array": lambda v: isinstance(v, list) and all(isinstance(item, str) for item in v),
+    }
+    return any(checks[t](value) for t in types)
+
+
+def decode(raw, fields):
+    """
+    Valida la risposta JSON e restituisce `(narrazione, ParsedReply)`.
+    Solleva ValueError se la risposta non rispetta lo schema.
+    """
+    try:
+        data = json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"JSON non valido: {e}")
+    if not isinstance(data, dict) or not isinstance(data.get("narration"), str):
+        raise ValueError("campo 'narration' mancante")
+    state = data.get("state")
+    if not isinstance(state, dict):
+        raise ValueError("campo 'state' mancante")
+
+    values = {}
+    for name in fields:
+        if name not in state or not _check(state[name], FIELD_SCHEMAS[name]):
+            raise ValueError(f"campo di stato '{name}' mancante o del tipo sbagliato")
+        values[name] = state[name]
+
+    # Stesse convenzioni del parser a regex: 0 = nessun cambiamento, lo stato assoluto vince
+    for name in ("damage", "heal"):
+        if not values.get(name):
+            values.pop(name, None)
+    if values.get("hp") is not None:
+        values.pop("damage", None)
+        values.pop("heal", None)
+    values["items"] = [item.strip() for item in values.get("items", []) if item.strip()]
+    for name in ("new_class", "objective"):
+        if isinstance(values.get(name), str):
+            values[name] = values[name].strip() or None
+    return data["narration"].strip(), ParsedReply(**values)
+
+
+class NarrationStream:
+    """Estrae progressivamente il valore di "narration" da un JSON che arriva a pezzi."""
+
+    KEY = re.compile(r'"narration"\s*:\s*"')
+    ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = None
+        self.done = False
+
+    def feed(self, text):
+        """Aggiunge un frammento e restituisce il testo della narrazione decodificato finora non ancora restituito."""
+        self._buffer += text
+        if self.done:
+            return ""
+        if self._pos is None:
+            match = self.KEY.search(self._buffer)
+            if not match:
+                return ""
+            self._pos = match.end()
+
+        buffer, i, out = self._buffer, self._pos, []
+        while i < len(buffer):
+            char = buffer[i]
+            if char == '"':
+                self.done = True
+                i += 1
+                break
+            if char != "\\":
+                out.append(char)
+                i += 1
+                continue
+            # Sequenza di escape: se è spezzata tra due frammenti si aspetta il successivo
+            if i + 1 >= len(buffer):
+                break
+            if buffer[i + 1] != "u":
+                out.append(self.ESCAPES.get(buffer[i + 1], buffer[i + 1]))
+                i += 2
+                continue
+            length = 6
+            if i + 6 <= len(buffer):
+                try:
+                    if 0xD800 <= int(buffer[i + 2:i + 6], 16) <= 0xDBFF:
+                        length = 12  # coppia surrogata (es. emoji)
+                except ValueError:
+                    pass  # Escape malformato: ci pensa la decodifica qui sotto
+            if i + length > len(buffer):
+                break
+            try:
+                out.append(json.loads(f'"{buffer[i:i + length]}"'))
+            except ValueError:
+                # Escape malformato: si inoltra il testo così com'è invece di interrompere il turno
+                out.append(buffer[i:i + length])
+            i += length
+        self._pos = i
+        return "".join(out)
+
+
+class ReplyReader:
+    """
+    Legge la risposta del DM in streaming nella modalità configurata per il gioco.
+    In modalità regex il testo passa così com'è e i tag vengono riconosciuti man
+    mano che si completano: `updates` restituisce quelli da applicare subito.
+    """
+
+    def __init__(self, game_id, fields):
+        self.game_id = game_id
+        self.fields = fields
+        self.structured = enabled(game_id)
+        self.shown = False
+        self._parts = []
+        self._narration = NarrationStream() if self.structured else None
+        self._tags = None if self.structured else IncrementalParser()
+        self._updates = []
+
+    def request_kwargs(self):
+        """Parametri aggiuntivi per la chiamata al modello."""
+        return {"response_format": response_format(self.fields)} if self.structured else {}
+
+    def prompt_tail(self):
+        """Messaggi da aggiungere in coda al prompt."""
+        return [format_message(self.fields)] if self.structured else []
+
+    def record_turn(self, user_input):
+        """Conta il turno e, se il giocatore sta correggendo lo stato, il turno correttivo."""
+        mode = "json" if self.structured else "regex"
+        metrics.incr(f"turns.{self.game_id}.{mode}")
+        if CORRECTIVE_PATTERN.search(user_input):
+            metrics.incr(f"turns.corrective.{self.game_id}.{mode}")
+
+    def feed(self, text):
+        """Assorbe un frammento e restituisce il testo da mostrare al giocatore."""
+        self._parts.append(text)
+        if self.structured:
+            shown = self._narration.feed(text)
+        else:
+            shown = text
+            self._updates.extend(self._tags.feed(text))
+        if shown:
+            self.shown = True
+        return shown
+
+    def updates(self):
+        """Cambiamenti di stato completati dall'ultima chiamata (solo in modalità regex)."""
+        updates, self._updates = self._updates, []
+        return updates
+
+    def finish(self):
+        """
+        Restituisce `(testo del DM, ParsedReply)` a risposta completata. In modalità
+        regex il `ParsedReply` contiene solo i tag non ancora restituiti da `updates`.
+        """
+        raw = "".join(self._parts)
+        if not self.structured:
+            return raw, combine(self.updates() + self._tags.finish())
+        if not raw:
+            return raw, parse_reply(raw)
+        try:
+            narration, parsed = decode(raw, self.fields)
+            metrics.incr(f"structured.ok.{self.game_id}")
+            return narration, parsed
+        except ValueError as e:
+            logger.warning(f"Risposta strutturata non valida ({self.game_id}), uso le regex: {e}")
+            metrics.incr(f"structured.fallback.{self.game_id}")
+            # Se la narrazione è già stata mostrata si tiene quella, altrimenti il testo grezzo
+            narration = NarrationStream().feed(raw).strip() if self.shown else raw
+            return narration, parse_reply(narration)
+
+
+def success_rates():
+    """Tasso di risposte strutturate valide per gioco (None se non ce ne sono state)."""
+    counters = metrics.snapshot()["counters"]
+    rates = {}
+    for game_id in settings.LLM_GAMES:
+        ok = counters.get(f"structured.ok.{game_id}", 0)
+        fallback = counters.get(f"structured.fallback.{game_id}", 0)
+        if ok or fallback:
+            rates[game_id] = round(ok / (ok + fallback), 3)
+    return rates
@@ -0,0 +1,1142 @@
+import asyncio
+import time
+from collections import deque
+from types import SimpleNamespace
+from unittest import mock
+
+import httpx
+import openai
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db.models import QuerySet
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from core import (
+    admission, brownout, context, gamestate, hedging, history, idempotency, llm, memory, metrics, openings, ratelimit,
+    resilience, routing, rules, tokens, toolargs,
+)
+from core.context import build_prompt
+from core.gamestate import StateConflict, VersionedState
+from core.history import MessageLog
+from core.models import Game, OpeningScene
+from core.parsing import IncrementalParser, ParsedReply, combine, parse_reply
+from core.streaming import iter_text
+from core.structured import NarrationStream
+
+# La cache predefinita è nel database: i test che non lo usano lavorano su una cache in memoria
+LOCAL_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+REPLY = (
+    "Il drago ti colpisce con la coda. Hai perso 4 punti ferita.\n"
+    "Hai raccolto: spada, «scudo» * pozione. Poi prosegui.\n"
+    "[CLASS_CHANGE] Paladino\n"
+    "Hai perso 9 punti ferita, di nuovo.\n"
+    "[OBJECTIVE] Raggiungi la torre\n"
+)
+
+
+HP_REPLY = (
+    "Il colpo ti raggiunge. Hai perso 3 punti ferita.\n"
+    "Hai guarito 1 punti ferita con una pozione.\n"
+    "Punti ferita attuali: 12\n"
+    "[OBJECTIVE] Fuggi dal castello\n"
+)
+
+
+class ParseReplyTests(SimpleTestCase):
+    def test_tags_are_read_in_one_pass(self):
+        self.assertEqual(parse_reply(REPLY), ParsedReply(
+            damage=4, new_class="Paladino", items=["spada", "scudo", "pozione"], objective="Raggiungi la torre",
+        ))
+
+    def test_absolute_hp_wins_over_damage_and_heal(self):
+        parsed = parse_reply("Hai perso 3 punti ferita. Hai guarito 2 punti ferita. HP attuali: 11")
+        self.assertEqual((parsed.hp, parsed.damage, parsed.heal), (11, None, None))
+
+    def test_items_stop_at_other_tags(self):
+        parsed = parse_reply("Hai raccolto una chiave [OBJECTIVE] Apri la porta")
+        self.assertEqual(parsed.items, ["una chiave"])
+        self.assertEqual(parsed.objective, "Apri la porta")
+
+    def test_plain_reply_has_no_tags(self):
+        self.assertFalse(parse_reply("Il corridoio è buio e silenzioso.").found)
+
+
+class IncrementalParserTests(SimpleTestCase):
+    def stream(self, chunks):
+        parser = IncrementalParser()
+        updates = []
+        for chunk in chunks:
+            updates += parser.feed(chunk)
+        updates += parser.finish()
+        return parser, updates
+
+    def test_every_split_matches_parse_reply(self):
+        for reply in (REPLY, HP_REPLY):
+            expected = parse_reply(reply)
+            for cut in range(1, len(reply)):
+                parser, updates = self.stream([reply[:cut], reply[cut:]])
+                self.assertEqual(parser.result, expected, f"taglio a {cut}")
+                self.assertEqual(combine(updates), expected, f"taglio a {cut}")
+                if expected.hp is not None:
+                    # Nessun avviso di danni o cure che la risposta intera scarta
+                    self.assertFalse([update for update in updates if update.damage or update.heal])
+
+    def test_token_sized_chunks(self):
+        parser, _ = self.stream([REPLY[i:i + 3] for i in range(0, len(REPLY), 3)])
+        self.assertEqual(parser.result, parse_reply(REPLY))
+
+    def test_tag_is_applied_as_soon_as_complete(self):
+        parser = IncrementalParser()
+        self.assertEqual(parser.feed("[CLASS_CHANGE] Pala"), [])
+        self.assertEqual(parser.feed("dino\nIl drago"), [ParsedReply(new_class="Paladino")])
+
+    def test_damage_is_held_until_the_end(self):
+        parser = IncrementalParser()
+        self.assertEqual(parser.feed("Hai perso 4 punti ferita. Il drago si allontana.\n"), [])
+        self.assertEqual(parser.finish(), [ParsedReply(damage=4)])
+
+    def test_damage_before_absolute_hp_is_never_emitted(self):
+        parser = IncrementalParser()
+        self.assertEqual(parser.feed("Hai perso 3 punti ferita. Il drago ruggisce.\n"), [])
+        self.assertEqual(parser.feed("Punti ferita attuali: 12\n"), [ParsedReply(hp=12)])
+        self.assertEqual(parser.finish(), [])
+
+    def test_damage_after_absolute_hp_is_ignored(self):
+        _, updates = self.stream(["HP attuali: 8\n", "Hai perso 2 punti ferita.\n"])
+        self.assertEqual(updates, [ParsedReply(hp=8)])
+
+
+class FlashStore(list):
+    def add(self, level, message, extra_tags=""):
+        self.append(message)
+
+
+async def turn_events():
+    yield "token", {"text": "Il drago "}
+    yield "token", {"text": "si sveglia."}
+    yield "state", {"hp": 7}
+    yield "done", {}
+
+
+async def failing_events():
+    yield "token", {"text": "Il drago "}
+    raise openai.APIConnectionError(request=httpx.Request("POST", "https://llm.test"))
+
+
+@override_settings(
+    CACHES=LOCAL_CACHE,
+    TURN_IDEMPOTENCY={"ttl": 60, "wait": 0.05, "poll": 0.01},
+)
+class TurnIdempotencyTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def request(self, key="a1b2c3d4e5"):
+        return SimpleNamespace(
+            POST={idempotency.KEY_FIELD: key},
+            session=SimpleNamespace(session_key="sessione"),
+            _messages=FlashStore(),
+        )
+
+    async def run_turn(self, turn, events):
+        return [event async for event in turn.record(events())]
+
+    async def test_duplicate_replays_the_original_events(self):
+        original = idempotency.Turn(self.request(), "test")
+        self.assertTrue(await original.claim())
+        duplicate = idempotency.Turn(self.request(), "test")
+        self.assertFalse(await duplicate.claim())
+
+        await self.run_turn(original, turn_events)
+        replayed = [event async for event in duplicate.replay()]
+        self.assertEqual(replayed, [
+            ("token", {"text": "Il drago si sveglia."}),
+            ("state", {"hp": 7}),
+            ("done", {}),
+        ])
+
+    async def test_failed_turn_can_be_resent(self):
+        turn = idempotency.Turn(self.request(), "test")
+        self.assertTrue(await turn.claim())
+        with self.assertRaises(openai.APIConnectionError):
+            await self.run_turn(turn, failing_events)
+        self.assertTrue(await idempotency.Turn(self.request(), "test").claim())
+
+    async def test_rejected_turn_is_not_published(self):
+        turn = idempotency.Turn(self.request(), "test")
+        self.assertTrue(await turn.claim())
+        await turn.settle(saved=False)
+        self.assertTrue(await idempotency.Turn(self.request(), "test").claim())
+
+    async def test_saved_turn_is_published(self):
+        turn = idempotency.Turn(self.request(), "test")
+        self.assertTrue(await turn.claim())
+        await turn.settle(saved=True)
+        self.assertEqual(await idempotency.Turn(self.request(), "test").wait(), [])
+
+    async def test_duplicate_of_a_lost_turn_is_warned(self):
+        self.assertTrue(await idempotency.Turn(self.request(), "test").claim())
+        request = self.request()
+        await idempotency.Turn(request, "test").follow(request)
+        self.assertEqual(list(request._messages), [idempotency.LOST_MESSAGE])
+
+    async def test_missing_session_key_is_counted(self):
+        request = self.request()
+        request.session.session_key = None
+        before = metrics.snapshot()["counters"].get("idempotency.bypassed.test", 0)
+        with self.assertLogs("core.idempotency", "INFO") as logs:
+            self.assertTrue(await idempotency.Turn(request, "test").claim())
+        self.assertEqual(metrics.snapshot()["counters"]["idempotency.bypassed.test"], before + 1)
+        self.assertIn("sessione senza chiave", logs.output[0])
+
+    async def test_keys_are_per_game_and_well_formed(self):
+        self.assertTrue(await idempotency.Turn(self.request(), "test").claim())
+        self.assertTrue(await idempotency.Turn(self.request(), "altro").claim())
+        # Una chiave non valida non viene mai considerata un doppione
+        invalid = self.request("x")
+        self.assertTrue(await idempotency.Turn(invalid, "test").claim())
+        self.assertTrue(await idempotency.Turn(invalid, "test").claim())
+
+
+def conversation(length):
+    return [{"role": "system", "content": "prompt"}] + [
+        {"role": "user" if index % 2 else "assistant", "content": f"messaggio {index}"}
+        for index in range(1, length)
+    ]
+
+
+class Partita(VersionedState):
+    """Gioco minimo per i test dello stato versionato."""
+    GAME_ID = "test"
+    STATE_KEYS = {
+        "hp": "hp",
+        "max_hp": "max_hp",
+        "inventory": "inventario",
+        "current_objective": "objective",
+        "messages": "messages",
+        "summary": "summary",
+        "summary_upto": "summary_upto",
+    }
+    VERSION_KEY = "version"
+    MERGE_RULES = {"hp": "add", "inventory": "multiset", "messages": "append"}
+
+    def __init__(self, session):
+        self.session = session
+        self.hp = session.get("hp")
+        self.max_hp = session.get("max_hp")
+        self.inventory = session.get("inventario", [])
+        self.current_objective = session.get("objective", "")
+        self.messages = session.get("messages", [])
+        self.summary = session.get("summary", "")
+        self.summary_upto = session.get("summary_upto", 0)
+        self.track_version()
+
+    def is_initialized(self):
+        return self.hp is not None
+
+
+class MergeTests(SimpleTestCase):
+    rules = Partita.MERGE_RULES
+
+    def state(self, **changes):
+        state = {
+            "hp": 10, "max_hp": 20, "inventory": ["spada"], "current_objective": "Esplora",
+            "messages": conversation(3), "summary": "", "summary_upto": 0,
+        }
+        return {**state, **changes}
+
+    def test_concurrent_turns_are_merged(self):
+        base = self.state()
+        mine = self.state(hp=7, inventory=["spada", "chiave"], messages=base["messages"] + [{"role": "user", "content": "io"}])
+        theirs = self.state(hp=15, inventory=[], messages=base["messages"] + [{"role": "user", "content": "altro"}])
+        merged = gamestate.merge(base, mine, theirs, self.rules)
+        self.assertEqual(merged["hp"], 12)  # 10 - 3 + 5
+        self.assertEqual(merged["inventory"], ["chiave"])
+        self.assertEqual([msg["content"] for msg in merged["messages"][3:]], ["altro", "io"])
+
+    def test_hp_is_clamped_to_max(self):
+        merged = gamestate.merge(self.state(), self.state(hp=18), self.state(hp=19), self.rules)
+        self.assertEqual(merged["hp"], 20)
+
+    def test_conflicting_changes_are_rejected(self):
+        with self.assertRaises(StateConflict):
+            gamestate.merge(
+                self.state(), self.state(current_objective="Fuggi"), self.state(current_objective="Combatti"), self.rules,
+            )
+        with self.assertRaises(StateConflict):
+            # Partita ricominciata altrove: la cronologia non prosegue quella di partenza
+            gamestate.merge(self.state(), self.state(), self.state(messages=conversation(2)), self.rules)
+
+    def test_longest_valid_summary_wins(self):
+        base = self.state(messages=conversation(8))
+        mine = self.state(messages=conversation(8), summary="mio", summary_upto=5)
+        theirs = self.state(messages=conversation(8), summary="loro", summary_upto=3)
+        merged = gamestate.merge(base, mine, theirs, self.rules)
+        self.assertEqual((merged["summary"], merged["summary_upto"]), ("mio", 5))
+
+
+class VersionedStateTests(TestCase):
+    def request(self, session):
+        return SimpleNamespace(user=AnonymousUser(), session=session, _messages=FlashStore())
+
+    async def new_game(self, request):
+        game = await Partita.aload(request)
+        game.hp, game.max_hp, game.messages = 10, 20, conversation(2)
+        self.assertTrue(await game.asave(request))
+
+    async def test_second_save_merges_with_the_first(self):
+        session = {}
+        await self.new_game(self.request(session))
+        first, second = await Partita.aload(self.request(session)), await Partita.aload(self.request(session))
+        first.hp -= 3
+        first.messages.append({"role": "user", "content": "primo"})
+        second.inventory.append("chiave")
+        second.messages.append({"role": "user", "content": "secondo"})
+
+        self.assertTrue(await first.asave(self.request(session)))
+        self.assertTrue(await second.asave(self.request(session)))
+
+        saved = await Partita.aload(self.request(session))
+        self.assertEqual(saved.version, 3)
+        self.assertEqual((saved.hp, saved.inventory), (7, ["chiave"]))
+        self.assertEqual([msg["content"] for msg in saved.messages[2:]], ["primo", "secondo"])
+
+    async def test_conflicting_turn_is_rejected_and_rebased(self):
+        session = {}
+        await self.new_game(self.request(session))
+        first, second = await Partita.aload(self.request(session)), await Partita.aload(self.request(session))
+        first.current_objective = "Fuggi"
+        second.current_objective = "Combatti"
+        request = self.request(session)
+
+        self.assertTrue(await first.asave(self.request(session)))
+        self.assertFalse(await second.asave(request))
+        self.assertEqual(second.current_objective, "Fuggi")
+        self.assertEqual(list(request._messages), [gamestate.CONFLICT_MESSAGE])
+
+    async def test_players_do_not_share_games(self):
+        await self.new_game(self.request({}))
+        other = await Partita.aload(self.request({}))
+        self.assertFalse(other.is_initialized())
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class RateLimitTests(SimpleTestCase):
+    limit = {"capacity": 8, "per_minute": 10}
+
+    def setUp(self):
+        cache.clear()
+
+    def test_bucket_empties_after_capacity(self):
+        waits = [ratelimit.take("ratelimit:test", self.limit) for _ in range(10)]
+        self.assertEqual(waits[:8], [0] * 8)
+        self.assertTrue(all(wait > 0 for wait in waits[8:]))
+
+    def test_parallel_burst_respects_capacity(self):
+        async def burst():
+            return await asyncio.gather(*(ratelimit.atake("ratelimit:burst", self.limit) for _ in range(30)))
+
+        waits = asyncio.run(burst())
+        self.assertEqual(sum(1 for wait in waits if wait == 0), 8)
+
+
+class ToolArgumentsTests(SimpleTestCase):
+    inventory = {
+        "properties": {"items": {"type": "array", "items": {"type": "string"}}},
+        "required": ["items"],
+    }
+    damage = {
+        "properties": {"amount": {"type": "integer"}, "reason": {"type": "string"}},
+        "required": ["amount"],
+    }
+
+    def test_valid_arguments_are_not_repaired(self):
+        self.assertEqual(toolargs.repair('{"items": ["spada"]}'), ({"items": ["spada"]}, False))
+
+    def test_trailing_comma_and_single_quotes(self):
+        self.assertEqual(toolargs.repair('{"items": ["spada",],}')[0], {"items": ["spada"]})
+        self.assertEqual(toolargs.repair("{'items': ['spada']}")[0], {"items": ["spada"]})
+
+    def test_truncated_object_is_closed(self):
+        self.assertEqual(toolargs.repair('{"items": ["spada", "scudo"]')[0], {"items": ["spada", "scudo"]})
+        self.assertEqual(toolargs.repair('{"amount": 3, "reason": ')[0], {"amount": 3})
+
+    def test_value_cut_inside_a_string_is_dropped(self):
+        self.assertEqual(toolargs.repair('{"items": ["spada", "scu')[0], {"items": ["spada"]})
+        self.assertEqual(toolargs.repair('{"amount": 3, "reason": "cad')[0], {"amount": 3})
+        self.assertEqual(toolargs.repair('{"reason": "cad')[0], {})
+
+    def test_unrepairable_arguments(self):
+        with self.assertRaises(ValueError):
+            toolargs.repair("non è json")
+
+    def test_coercion_to_schema(self):
+        arguments, repaired = toolargs.parse_arguments('{"Items": "spada, scudo"}', self.inventory)
+        self.assertEqual(arguments, {"items": ["spada", "scudo"]})
+        self.assertTrue(repaired)
+        self.assertEqual(toolargs.parse_arguments('{"amount": "3 danni"}', self.damage)[0], {"amount": 3})
+
+    def test_null_is_never_turned_into_text(self):
+        self.assertEqual(toolargs.parse_arguments('{"items": [1, null]}', self.inventory)[0], {"items": ["1"]})
+        self.assertEqual(toolargs.parse_arguments('{"amount": 2, "reason": null}', self.damage)[0], {"amount": 2})
+        with self.assertRaises(ValueError):
+            toolargs.parse_arguments('{"amount": null}', self.damage)
+
+
+class NarrationStreamTests(SimpleTestCase):
+    def read(self, *chunks):
+        stream = NarrationStream()
+        return "".join(stream.feed(chunk) for chunk in chunks), stream.done
+
+    def test_narration_arrives_in_pieces(self):
+        text, done = self.read('{"narr', 'ation": "Ciao', ' \\"mondo\\"\\n", "hp": 3}')
+        self.assertEqual(text, 'Ciao "mondo"\n')
+        self.assertTrue(done)
+
+    def test_escape_split_between_chunks(self):
+        self.assertEqual(self.read('{"narration": "caff\\u00', 'e8 e ', '\\ud83d\\ude00"}')[0], "caffè e 😀")
+
+    def test_malformed_unicode_escape_is_forwarded_raw(self):
+        self.assertEqual(self.read('{"narration": "ciao \\u00', 'zz mondo"}')[0], "ciao \\u00zz mondo")
+
+
+def api_error(status):
+    request = httpx.Request("POST", "https://llm.example/v1/chat/completions")
+    return openai.APIStatusError(f"errore {status}", response=httpx.Response(status, request=request), body=None)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.circuit = resilience.CircuitBreaker("test", failure_threshold=2, cooldown=0)
+
+    def fail(self, error):
+        return resilience._after_error("test", self.circuit, error, attempt=0)
+
+    def test_request_errors_keep_the_model_healthy(self):
+        self.circuit.record_failure()
+        self.assertFalse(self.fail(api_error(400)))
+        self.assertEqual(self.circuit.state, "closed")
+        self.assertEqual(self.circuit._failures, 0)
+
+    def test_dead_model_trips_the_breaker_without_retrying(self):
+        self.assertFalse(self.fail(api_error(404)))
+        self.assertFalse(self.fail(api_error(401)))
+        self.assertNotEqual(self.circuit.state, "closed")
+
+    def test_failed_probe_does_not_close_the_breaker(self):
+        self.circuit.record_failure()
+        self.circuit.record_failure()
+        self.assertTrue(self.circuit.allow())  # chiamata di prova
+        self.fail(api_error(404))
+        self.assertIsNotNone(self.circuit._opened_at)
+
+    def test_local_bug_only_ends_the_probe(self):
+        self.circuit.record_failure()
+        self.circuit.record_failure()
+        self.assertTrue(self.circuit.allow())
+        self.fail(TypeError("bug"))
+        self.assertIsNotNone(self.circuit._opened_at)
+        self.assertTrue(self.circuit.allow())  # la prova successiva può partire
+
+    def test_server_errors_are_retried(self):
+        self.assertTrue(self.fail(api_error(503)))
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class GlobalAdmissionTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def options(self):
+        return override_settings(LLM_ADMISSION={**settings.LLM_ADMISSION, "global_max": 2, "global_poll": 0.01})
+
+    def test_global_slots_limit_turns_across_processes(self):
+        async def scenario():
+            first = await admission._acquire_global(time.monotonic() + 1)
+            second = await admission._acquire_global(time.monotonic() + 1)
+            with self.assertRaises(admission.Busy):
+                await admission._acquire_global(time.monotonic() + 0.05)
+            await admission._release_global(*first)
+            third = await admission._acquire_global(time.monotonic() + 1)
+            self.assertNotEqual(second[0], third[0])
+
+        with self.options():
+            asyncio.run(scenario())
+
+    def test_expired_slot_is_not_released_twice(self):
+        async def scenario():
+            slot, token = await admission._acquire_global(time.monotonic() + 1)
+            await cache.aset(slot, "altro turno")  # Scaduto e ripreso da un altro turno
+            await admission._release_global(slot, token)
+            self.assertEqual(await cache.aget(slot), "altro turno")
+
+        with self.options():
+            asyncio.run(scenario())
+
+
+
+
+class MessageLogTests(SimpleTestCase):
+    def setUp(self):
+        self.full = conversation(10)
+        self.log = MessageLog(self.full[0], 5, self.full[5:], game_id=1)
+
+    def test_indices_are_those_of_the_full_history(self):
+        self.assertEqual(len(self.log), 10)
+        self.assertEqual(self.log[0], self.full[0])
+        self.assertEqual(self.log[7], self.full[7])
+        self.assertEqual(self.log[-1], self.full[9])
+        self.assertEqual(self.log[:1], self.full[:1])
+        self.assertEqual(self.log[5:8], self.full[5:8])
+        self.assertEqual(self.log[-3:], self.full[-3:])
+        self.assertEqual(list(self.log), [self.full[0]] + self.full[5:])
+
+    def test_messages_before_the_window_are_not_silently_skipped(self):
+        with self.assertRaises(IndexError):
+            self.log[3]
+        with self.assertRaises(IndexError):
+            self.log[2:]
+        with self.assertRaises(IndexError):
+            self.log[:7]
+
+    def test_append_and_compare(self):
+        grown = self.log.copy()
+        grown.append({"role": "user", "content": "nuovo"})
+        self.assertEqual(len(grown), 11)
+        self.assertEqual(len(self.log), 10)
+        self.assertTrue(grown.startswith(self.log))
+        self.assertFalse(self.log.startswith(grown))
+        self.assertEqual(grown[len(self.log):], [{"role": "user", "content": "nuovo"}])
+        self.assertEqual(MessageLog(None, 0, self.full[:3]), self.full[:3])
+
+    def test_new_rows_only_for_appended_messages(self):
+        grown = self.log + [{"role": "user", "content": "nuovo"}]
+        rows = history.new_rows(1, grown, len(self.log))
+        self.assertEqual([(row.seq, row.content) for row in rows], [(10, "nuovo")])
+
+
+@override_settings(GAME_HISTORY={"recent_messages": 4, "max_window": 6})
+class MessageWindowTests(TestCase):
+    def setUp(self):
+        self.full = conversation(20)
+        self.row = Game.objects.create(guest="ospite", game="test", message_count=len(self.full))
+        history.GameMessage.objects.bulk_create(history.new_rows(self.row.pk, self.full, 0))
+
+    def test_only_the_window_is_loaded(self):
+        log = MessageLog.load(self.row)
+        self.assertEqual(log.start, 14)  # al massimo `max_window` messaggi
+        self.assertEqual(len(log), 20)
+        self.assertEqual(log[14:], self.full[14:])
+        self.assertEqual(log[0], self.full[0])
+
+    def test_unsummarized_messages_are_loaded_from_the_database(self):
+        self.row.summary_upto = 3
+        log = MessageLog.load(self.row)
+        self.assertEqual(async_to_sync(history.aslice_from)(log, 3), self.full[3:])
+        self.assertEqual(async_to_sync(history.aslice_from)(log, 16), self.full[16:])
+
+
+@override_settings(LLM_MEMORY={**settings.LLM_MEMORY, "trigger_messages": 4, "keep_recent": 2})
+class FoldPointTests(SimpleTestCase):
+    def test_fold_at_the_start_of_a_player_turn(self):
+        pending = conversation(12)[3:]
+        self.assertEqual(memory._fold_point(pending, 3), 11)
+
+    def test_no_fold_below_the_threshold(self):
+        self.assertIsNone(memory._fold_point(conversation(6)[3:], 3))
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class SnapshotTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_save_file_at_most_once_per_interval(self):
+        request = SimpleNamespace(user=AnonymousUser(), session={})
+        other = SimpleNamespace(user=AnonymousUser(), session={})
+        game_class = SimpleNamespace(GAME_ID="test")
+        due = [async_to_sync(gamestate.asnapshot_due)(request, game_class) for _ in range(3)]
+        self.assertEqual(due, [True, False, False])
+        self.assertTrue(async_to_sync(gamestate.asnapshot_due)(other, game_class))
+
+
+class AsyncClientTests(SimpleTestCase):
+    async def current_client(self):
+        return llm.get_async_client()
+
+    def test_pooled_client_lives_with_the_server_loop(self):
+        async def server():
+            messages = iter([{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}])
+            sent = []
+
+            async def receive():
+                message = next(messages)
+                if message["type"] == "lifespan.shutdown":
+                    clients.extend([llm.get_async_client(), llm.get_async_client()])
+                return message
+
+            async def send(message):
+                sent.append(message["type"])
+
+            await llm.asgi_lifespan(None)({"type": "lifespan"}, receive, send)
+            return sent
+
+        clients = []
+        sent = asyncio.run(server())
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+        self.assertIs(clients[0], clients[1])
+        self.assertTrue(clients[0].is_closed())
+        self.assertIsNone(llm._async_loop)
+
+    def test_short_lived_loops_get_their_own_client(self):
+        first, second = async_to_sync(self.current_client)(), async_to_sync(self.current_client)()
+        self.assertIsNot(first, second)
+        self.assertIsNone(llm._async_client)
+
+
+@override_settings(
+    CACHES=LOCAL_CACHE,
+    LLM_MEMORY={**settings.LLM_MEMORY, "trigger_messages": 4, "keep_recent": 2, "model": None},
+)
+class BackgroundSummaryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    async def test_turn_does_not_wait_for_the_summary(self):
+        request = SimpleNamespace(user=AnonymousUser(), session={}, _messages=FlashStore())
+        game = await Partita.aload(request)
+        game.hp, game.max_hp, game.messages = 10, 20, conversation(12)
+        self.assertTrue(await game.asave(request))
+
+        release = asyncio.Event()
+
+        async def slow_summary(*args, **kwargs):
+            await release.wait()
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="Il riassunto."))])
+
+        with (
+            mock.patch.object(llm, "achat_completion", slow_summary),
+            mock.patch.object(llm, "_async_loop", asyncio.get_running_loop()),
+        ):
+            task = await memory.asummarize_later(request, game, "modello")
+            # Il turno è già concluso mentre il riassunto aspetta ancora il modello
+            self.assertFalse(task.done())
+            self.assertEqual((await Partita.aload(request)).summary, "")
+            release.set()
+            await task
+
+        saved = await Partita.aload(request)
+        self.assertEqual((saved.summary, saved.summary_upto), ("Il riassunto.", 11))
+        self.assertEqual(len(saved.messages), 12)
+
+    async def test_short_history_is_not_summarized(self):
+        game = SimpleNamespace(summary_upto=0, messages=conversation(3))
+        self.assertIsNone(await memory.asummarize_later(None, game, "modello"))
+
+
+def chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text, tool_calls=None))])
+
+
+class FakeStream:
+    """Stream di chunk già pronti che ricorda se è stato chiuso."""
+
+    def __init__(self, *texts):
+        self.chunks = [chunk(text) for text in texts]
+        self.closed = False
+
+    async def __aiter__(self):
+        for item in self.chunks:
+            yield item
+
+    async def close(self):
+        self.closed = True
+
+
+@override_settings(
+    LLM_GAMES={"test": {"fallbacks": ["riserva"], "hedge": False}},
+    LLM_HEDGING={"percentile": 95, "default_delay": 0.05, "min_delay": 0.05},
+)
+class HedgingTests(SimpleTestCase):
+    def fake_open(self, **replies):
+        """`_open` finto: per ogni modello un'attesa in secondi oppure l'eccezione da sollevare."""
+        self.opened, self.cancelled = {}, []
+
+        async def _open(model, messages, kwargs):
+            reply = replies[model]
+            if isinstance(reply, Exception):
+                raise reply
+            try:
+                await asyncio.sleep(reply)
+            except asyncio.CancelledError:
+                self.cancelled.append(model)
+                raise
+            stream = self.opened[model] = FakeStream(f"risposta di {model}", " e poi il resto")
+            return hedging.HedgedStream(model, stream, stream.__aiter__(), [])
+
+        return mock.patch.object(hedging, "_open", _open)
+
+    def count(self, name):
+        return metrics.snapshot()["counters"].get(name, 0)
+
+    async def read(self, stream):
+        return "".join([text async for text in iter_text(stream)])
+
+    async def test_failing_model_falls_back_to_the_next(self):
+        fallbacks = self.count("hedge.fallbacks.test")
+        with self.fake_open(principale=api_error(503), riserva=0):
+            stream = await hedging.astream_chat_completion("test", "principale", [])
+        self.assertEqual(stream.model, "riserva")
+        self.assertEqual(await self.read(stream), "risposta di riserva e poi il resto")
+        self.assertEqual(self.count("hedge.fallbacks.test"), fallbacks + 1)
+
+    async def test_error_is_raised_when_every_model_fails(self):
+        with self.fake_open(principale=api_error(503), riserva=api_error(502)):
+            with self.assertRaises(openai.APIStatusError):
+                await hedging.astream_chat_completion("test", "principale", [])
+
+    @override_settings(LLM_GAMES={"test": {"fallbacks": ["riserva"], "hedge": True}})
+    async def test_slow_model_is_hedged_and_the_loser_cancelled(self):
+        fired, wins = self.count("hedge.fired.test"), self.count("hedge.wins.test")
+        with self.fake_open(principale=5, riserva=0):
+            started = time.monotonic()
+            stream = await hedging.astream_chat_completion("test", "principale", [])
+        self.assertEqual(stream.model, "riserva")
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)  # la riserva parte dopo `hedge_delay`
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(self.cancelled, ["principale"])
+        self.assertEqual((self.count("hedge.fired.test"), self.count("hedge.wins.test")), (fired + 1, wins + 1))
+        await stream.close()
+
+    @override_settings(LLM_GAMES={"test": {"fallbacks": ["riserva"], "hedge": True}})
+    async def test_fast_model_is_not_hedged(self):
+        fired = self.count("hedge.fired.test")
+        with self.fake_open(principale=0, riserva=0):
+            stream = await hedging.astream_chat_completion("test", "principale", [])
+        self.assertEqual(stream.model, "principale")
+        self.assertEqual(list(self.opened), ["principale"])
+        self.assertEqual(self.count("hedge.fired.test"), fired)
+        await stream.close()
+
+    async def test_discard_closes_streams_that_already_answered(self):
+        with self.fake_open(principale=0, riserva=5):
+            answered = asyncio.create_task(hedging._open("principale", [], {}))
+            waiting = asyncio.create_task(hedging._open("riserva", [], {}))
+            await answered
+            await hedging._discard([answered, waiting])
+        self.assertTrue(self.opened["principale"].closed)
+        self.assertEqual(self.cancelled, ["riserva"])
+
+    async def test_request_finishes_once_when_read_to_the_end(self):
+        with self.fake_open(principale=0), mock.patch.object(brownout, "request_finished") as finished:
+            stream = await hedging.astream_chat_completion("test", "principale", [])
+            await self.read(stream)
+            await stream.close()  # Come nelle viste: chiusura esplicita nel finally
+        finished.assert_called_once()
+        self.assertTrue(self.opened["principale"].closed)
+
+    async def test_request_finishes_once_on_error(self):
+        with (
+            self.fake_open(principale=api_error(503), riserva=api_error(503)),
+            mock.patch.object(brownout, "request_finished") as finished,
+        ):
+            with self.assertRaises(openai.APIStatusError):
+                await hedging.astream_chat_completion("test", "principale", [])
+        finished.assert_called_once()
+
+    async def test_request_finishes_once_when_the_reader_stops_early(self):
+        with self.fake_open(principale=0), mock.patch.object(brownout, "request_finished") as finished:
+            stream = await hedging.astream_chat_completion("test", "principale", [])
+            chunks = stream.__aiter__()
+            await chunks.__anext__()
+            await stream.close()
+            finished.assert_called_once()
+            await chunks.aclose()
+        finished.assert_called_once()
+        self.assertTrue(self.opened["principale"].closed)
+
+
+@override_settings(LLM_BROWNOUT={**settings.LLM_BROWNOUT, "inflight": [2, 4, 6], "latency": [1.0, 2.0, 3.0]})
+class BrownoutTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        clock = mock.patch.object(brownout, "time", SimpleNamespace(monotonic=lambda: self.now))
+        clock.start()
+        self.addCleanup(clock.stop)
+        state = mock.patch.multiple(brownout, _inflight=0, _ttft=deque(), _level=0, _calm_since=None)
+        state.start()
+        self.addCleanup(state.stop)
+
+    def load(self, inflight):
+        for _ in range(inflight - brownout._inflight):
+            brownout.request_started()
+        for _ in range(brownout._inflight - inflight):
+            brownout.request_finished()
+
+    def test_level_follows_requests_in_flight(self):
+        levels = []
+        for inflight in (0, 1, 2, 4, 6, 9):
+            self.load(inflight)
+            levels.append(brownout.level())
+        self.assertEqual(levels, [0, 0, 1, 2, 3, 3])
+
+    def test_level_follows_the_p90_time_to_first_token(self):
+        for _ in range(9):
+            brownout.observe_ttft(0.5)
+        brownout.observe_ttft(5.0)
+        self.assertEqual(brownout.level(), 0)  # un solo caso lento resta sopra il p90
+        for _ in range(3):
+            brownout.observe_ttft(2.5)
+        self.assertEqual(brownout.level(), 2)
+
+    def test_old_latency_samples_are_ignored(self):
+        for _ in range(5):
+            brownout.observe_ttft(5.0)
+        self.assertEqual(brownout.level(), 3)
+        self.now += settings.LLM_BROWNOUT["window"] + 1
+        self.assertEqual(brownout._pressure(self.now), 0)
+
+    def test_level_goes_down_only_after_the_recovery_time(self):
+        recovery = settings.LLM_BROWNOUT["recovery"]
+        self.load(6)
+        self.assertEqual(brownout.level(), 3)
+        self.load(1)
+        self.assertEqual(brownout.level(), 3)  # inizia il periodo di calma
+        self.now += recovery - 1
+        self.assertEqual(brownout.level(), 3)
+        self.now += 1
+        self.assertEqual(brownout.level(), 0)
+
+    def test_new_load_restarts_the_recovery_time(self):
+        recovery = settings.LLM_BROWNOUT["recovery"]
+        self.load(4)
+        brownout.level()
+        self.load(0)
+        brownout.level()
+        self.now += recovery - 1
+        self.load(4)
+        self.assertEqual(brownout.level(), 2)  # il carico è tornato: la calma riparte da zero
+        self.load(0)
+        brownout.level()
+        self.now += recovery - 1
+        self.assertEqual(brownout.level(), 2)
+        self.now += 1
+        self.assertEqual(brownout.level(), 0)
+
+    def test_adjust_at_each_level(self):
+        levels = settings.LLM_BROWNOUT["levels"]
+        adjusted = []
+        for inflight in (0, 2, 4, 6):
+            self.load(inflight)
+            adjusted.append(brownout.adjust("lento", {"max_tokens": 600, "temperature": 0.7}))
+            self.now += settings.LLM_BROWNOUT["recovery"]
+        self.assertEqual(adjusted, [
+            ("lento", {"max_tokens": 600, "temperature": 0.7}),
+            ("lento", {"max_tokens": min(600, levels[1]["max_tokens"]), "temperature": 0.7}),
+            ("lento", {"max_tokens": min(600, levels[2]["max_tokens"]), "temperature": 0.7}),
+            (levels[3]["fast_model"], {"max_tokens": min(600, levels[3]["max_tokens"]), "temperature": 0.7}),
+        ])
+
+    def test_adjust_caps_calls_without_max_tokens(self):
+        self.load(2)
+        model, kwargs = brownout.adjust("lento", {})
+        self.assertEqual(kwargs, {"max_tokens": settings.LLM_BROWNOUT["levels"][1]["max_tokens"]})
+        self.assertEqual(model, "lento")
+
+    def test_optional_calls_and_context_under_load(self):
+        levels = settings.LLM_BROWNOUT["levels"]
+        self.assertFalse(brownout.skip_optional("second_call"))
+        self.assertEqual(brownout.context_ratio(), 1.0)
+        self.load(2)
+        self.assertFalse(brownout.skip_optional("second_call"))
+        self.assertEqual(brownout.context_ratio(), levels[1]["context_ratio"])
+        skipped = metrics.snapshot()["counters"].get("brownout.skipped.second_call", 0)
+        self.load(4)
+        self.assertTrue(brownout.skip_optional("second_call"))
+        self.assertEqual(metrics.snapshot()["counters"]["brownout.skipped.second_call"], skipped + 1)
+
+
+def usage(prompt, cached=0, completion=10):
+    return SimpleNamespace(
+        prompt_tokens=prompt, completion_tokens=completion,
+        prompt_tokens_details=SimpleNamespace(cached_tokens=cached),
+    )
+
+
+@override_settings(
+    LLM_GAMES={"test": {"tiers": {"routine": "economico", "key": "premium"}}},
+    LLM_ROUTING={"key_score": 2, "long_input_chars": 40, "high_level": 3, "low_hp_ratio": 0.3, "recent_messages": 2},
+)
+class RoutingTests(SimpleTestCase):
+    def scene(self, **state):
+        defaults = {"current_objective": "Raggiungi la torre nera", "level": 1, "hp": 20, "max_hp": 20, "messages": []}
+        return SimpleNamespace(**{**defaults, **state})
+
+    def reasons(self, user_input, **state):
+        return [reason for _, reason in routing._signals(self.scene(**state), user_input)]
+
+    def test_quiet_turn_has_no_signals(self):
+        self.assertEqual(self.reasons("mi guardo intorno"), [])
+        decision = routing.route("test", self.scene(), "mi guardo intorno", "predefinito")
+        self.assertEqual((decision.tier, decision.model, decision.score), (routing.ROUTINE, "economico", 0))
+
+    def test_each_signal(self):
+        self.assertEqual(self.reasons("mi guardo intorno con calma, osservando ogni dettaglio della stanza"), ["messaggio lungo"])
+        self.assertEqual(self.reasons("**TIRO D20 (Forza): 14 = 14**"), ["tiro di dado"])
+        self.assertEqual(self.reasons("attacco il goblin"), ["scena chiave"])
+        self.assertEqual(self.reasons("cammino verso la torre"), ["obiettivo in gioco"])
+        self.assertEqual(self.reasons("aspetto", level=3), ["livello alto"])
+        self.assertEqual(self.reasons("aspetto", hp=6), ["HP bassi"])
+        tool = [{"role": "tool", "content": "ok"}, {"role": "assistant", "content": "Fatto."}]
+        self.assertEqual(self.reasons("aspetto", messages=tool), ["strumenti usati di recente"])
+        old_tool = tool + [{"role": "user", "content": "e poi?"}, {"role": "assistant", "content": "Niente."}]
+        self.assertEqual(self.reasons("aspetto", messages=old_tool), [])
+
+    def test_key_scene_goes_to_the_premium_model(self):
+        decision = routing.route("test", self.scene(), "attacco il drago", "predefinito")
+        self.assertEqual((decision.tier, decision.model), (routing.KEY, "premium"))
+        self.assertEqual(decision.reasons, ["scena chiave"])
+
+    def test_weak_signals_add_up(self):
+        self.assertEqual(routing.route("test", self.scene(level=4), "aspetto", "predefinito").tier, routing.ROUTINE)
+        decision = routing.route("test", self.scene(level=4, hp=2), "aspetto", "predefinito")
+        self.assertEqual((decision.tier, decision.score), (routing.KEY, 2))
+
+    @override_settings(LLM_GAMES={"test": {"tiers": None}})
+    def test_game_without_tiers_keeps_its_model(self):
+        decision = routing.route("test", self.scene(), "mi guardo intorno", "predefinito")
+        self.assertEqual((decision.tier, decision.model), (routing.KEY, "predefinito"))
+
+    def test_cached_tokens_are_recorded_per_tier(self):
+        counters = metrics.snapshot()["counters"]
+        before = {name: counters.get(f"routing.{name}.test.routine", 0) for name in ("prompt_tokens", "cached_tokens")}
+        decision = routing.route("test", self.scene(), "mi guardo intorno", "predefinito")
+        routing.record("test", decision, 0.5, [("economico", usage(1000, cached=600)), ("economico", None)])
+        counters = metrics.snapshot()["counters"]
+        self.assertEqual(counters["routing.prompt_tokens.test.routine"], before["prompt_tokens"] + 1000)
+        self.assertEqual(counters["routing.cached_tokens.test.routine"], before["cached_tokens"] + 600)
+        self.assertIsNotNone(routing.routing_stats()["test"]["routine"]["cache_hit_rate"])
+
+
+@override_settings(
+    LLM_CONTEXT={"default_budget": 2000, "budgets": {"piccolo": 700}, "condense_chars": 400},
+    LLM_PROMPT_CACHE_MODELS=[],
+)
+class PromptBudgetTests(SimpleTestCase):
+    TAIL = [{"role": "user", "content": "[CONTESTO PARTITA] vivo"}]
+
+    def setUp(self):
+        # Stima a caratteri (4 per token): i conti non dipendono dalla presenza di tiktoken
+        encoding = mock.patch.object(tokens, "_get_encoding", lambda: None)
+        encoding.start()
+        self.addCleanup(encoding.stop)
+
+    def game(self, turns=4):
+        messages = [{"role": "system", "content": "prompt"}]
+        for index in range(1, turns + 1):
+            messages += [
+                {"role": "user", "content": f"turno {index}"},
+                {"role": "assistant", "content": f"{index}" + "x" * 1999},
+            ]
+        return SimpleNamespace(messages=messages, summary="", summary_upto=0)
+
+    def build(self, game, model="medio"):
+        return build_prompt(game, model, tail=self.TAIL)
+
+    def replies(self, messages):
+        return [msg["content"] for msg in messages if msg["role"] == "assistant"]
+
+    def test_prompt_within_budget_is_sent_whole(self):
+        game = self.game(turns=2)
+        messages = self.build(game)
+        self.assertEqual([msg["content"] for msg in messages], [msg["content"] for msg in [*game.messages, *self.TAIL]])
+
+    def test_oldest_replies_are_condensed_first(self):
+        replies = self.replies(self.build(self.game()))
+        self.assertEqual(len(replies), 4)
+        self.assertTrue(replies[0].endswith(" […]"))
+        self.assertEqual(len(replies[0]), 404)
+        self.assertEqual([len(reply) for reply in replies[1:]], [2000, 2000, 2000])
+
+    def test_old_turns_are_dropped_when_condensing_is_not_enough(self):
+        messages = build_prompt(self.game(), "piccolo", tail=self.TAIL)
+        self.assertEqual([msg["content"] for msg in messages if msg["role"] == "user"][:-1], ["turno 3", "turno 4"])
+        replies = self.replies(messages)
+        self.assertTrue(replies[0].startswith("3") and replies[0].endswith(" […]"))
+        self.assertEqual(len(replies[1]), 2000)  # l'ultimo turno resta alla lettera
+
+    @override_settings(LLM_CONTEXT={"default_budget": 10, "budgets": {}, "condense_chars": 400})
+    def test_system_prompt_last_turn_and_tail_are_always_sent(self):
+        game = self.game()
+        game.summary = "Il drago è morto."
+        with self.assertLogs("core.context", "WARNING"):
+            messages = self.build(game)
+        self.assertEqual([msg["content"] for msg in messages], [
+            "prompt", "[STORIA FINORA] Il drago è morto.", "turno 4", "4" + "x" * 1999, self.TAIL[0]["content"],
+        ])
+
+    def test_local_turns_and_token_counts_are_not_sent(self):
+        game = self.game(turns=2)
+        game.messages[1:1] = [
+            {"role": "user", "content": "inventario", "local": True},
+            {"role": "assistant", "content": "Inventario: vuoto", "local": True},
+        ]
+        messages = self.build(game)
+        self.assertNotIn("inventario", [msg["content"] for msg in messages])
+        self.assertTrue(all(set(msg) <= set(context.API_FIELDS) for msg in messages))
+        self.assertIn("tokens", game.messages[-1])  # il conteggio resta nella cronologia salvata
+
+    def test_brownout_shrinks_the_budget(self):
+        self.assertEqual(context.model_budget("piccolo"), 700)
+        with mock.patch.object(brownout, "context_ratio", lambda: 0.5):
+            self.assertEqual(context.model_budget("piccolo"), 350)
+            self.assertEqual(context.model_budget("medio"), 1000)
+            replies = self.replies(self.build(self.game()))
+        # Con metà budget vanno accorciati tutti i turni vecchi, non solo il primo
+        self.assertEqual([reply.endswith(" […]") for reply in replies], [True, True, True, False])
+
+    def test_message_tokens_are_counted_once(self):
+        msg = {"role": "user", "content": "x" * 40}
+        self.assertEqual(tokens.message_tokens(msg), tokens.MESSAGE_OVERHEAD + 11)
+        msg["content"] = "x" * 400
+        self.assertEqual(tokens.message_tokens(msg), tokens.MESSAGE_OVERHEAD + 11)
+
+
+class OpeningPoolTests(TestCase):
+    def setUp(self):
+        self.version = "v2"
+        self.refills = []
+        for target, replacement in (
+            ("_opening_request", lambda game: ("modello", [{"role": "system", "content": "prompt"}], self.version)),
+            ("refill_in_background", self.refills.append),
+        ):
+            patcher = mock.patch.object(openings, target, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def scene(self, content, prompt_version="v2"):
+        return OpeningScene.objects.create(game="test", prompt_version=prompt_version, model="modello", content=content)
+
+    def test_scenes_are_taken_oldest_first_and_only_once(self):
+        self.scene("prima")
+        self.scene("seconda")
+        self.assertEqual([openings.take("test"), openings.take("test")], ["prima", "seconda"])
+        self.assertFalse(OpeningScene.objects.exists())
+        self.assertEqual(self.refills, ["test", "test"])
+
+    def test_scene_reserved_by_another_taker_is_skipped(self):
+        self.scene("prima")
+        self.scene("seconda")
+        first = QuerySet.first
+
+        def racing_first(queryset):
+            scene = first(queryset)
+            if scene is not None and scene.content == "prima":
+                # Un'altra richiesta ha letto e cancellato la stessa scena un attimo prima
+                OpeningScene.objects.filter(pk=scene.pk).delete()
+            return scene
+
+        with mock.patch.object(QuerySet, "first", racing_first):
+            self.assertEqual(openings.take("test"), "seconda")
+        self.assertFalse(OpeningScene.objects.exists())
+
+    def test_empty_pool_returns_none_and_starts_a_refill(self):
+        misses = metrics.snapshot()["counters"].get("openings.misses", 0)
+        self.assertIsNone(openings.take("test"))
+        self.assertEqual(self.refills, ["test"])
+        self.assertEqual(metrics.snapshot()["counters"]["openings.misses"], misses + 1)
+
+    def test_scenes_from_an_old_prompt_are_not_served(self):
+        self.scene("vecchia", prompt_version="v1")
+        self.assertIsNone(openings.take("test"))
+        self.assertEqual(openings.pool_depth("test"), 0)
+
+    def test_refill_replaces_stale_scenes(self):
+        self.scene("vecchia", prompt_version="v1")
+        self.scene("attuale")
+        completion = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=" nuova "))])
+        with mock.patch.object(llm, "chat_completion", return_value=completion) as chat:
+            self.assertEqual(openings.refill("test", depth=3), 2)
+        self.assertEqual(chat.call_count, 2)
+        self.assertEqual(
+            list(OpeningScene.objects.values_list("prompt_version", "content")),
+            [("v2", "attuale"), ("v2", "nuova"), ("v2", "nuova")],
+        )
+
+    def test_refill_stops_at_the_first_error(self):
+        with mock.patch.object(llm, "chat_completion", side_effect=api_error(503)) as chat:
+            self.assertEqual(openings.refill("test", depth=3), 0)
+        chat.assert_called_once()
+
+
+CONSUMABLES = {
+    "pozione": {"heal": 5, "message": "{item}: +{healed} HP, ora {hp}/{max_hp}"},
+}
+
+
+class RulesTests(SimpleTestCase):
+    def hero(self, **state):
+        defaults = {
+            "hp": 10, "max_hp": 20, "level": 2, "inventory": ["Pozione rossa", "spada"], "stats": {"forza": 3},
+            "current_objective": "Trova il tempio", "messages": [],
+        }
+        game = SimpleNamespace(**{**defaults, **state})
+        game.use_item = lambda name: rules.use_consumable(game, name, CONSUMABLES)
+        return game
+
+    def test_short_commands_are_resolved_locally(self):
+        game = self.hero()
+        self.assertEqual(rules.resolve(game, "  Inventario? "), ("🎒 Nel tuo inventario: Pozione rossa, Spada.", False))
+        self.assertEqual(rules.resolve(game, "punti ferita"), ("❤️ Punti ferita: 10/20.", False))
+        self.assertEqual(rules.resolve(game, "missione"), ("🎯 Obiettivo attuale: Trova il tempio.", False))
+
+    def test_commands_must_match_the_whole_input(self):
+        game = self.hero()
+        for user_input in ("inventario della guardia", "frugo nello zaino", "chiedo aiuto al mercante", "usa la spada"):
+            self.assertIsNone(rules.resolve(game, user_input), user_input)
+
+    def test_commands_the_game_does_not_support_go_to_the_ai(self):
+        game = SimpleNamespace(hp=None, messages=[])
+        self.assertIsNone(rules.resolve(game, "inventario"))
+        self.assertIsNone(rules.resolve(game, "hp"))
+
+    def test_game_over_answers_every_input(self):
+        game = self.hero(hp=0)
+        for user_input in ("attacco il drago", "inventario", "usa pozione"):
+            self.assertEqual(rules.resolve(game, user_input), (rules.GAME_OVER_TEXT, False))
+        self.assertEqual(game.inventory, ["Pozione rossa", "spada"])
+
+    def test_local_turn_is_tagged_and_yields_the_usual_events(self):
+        game = self.hero()
+        events = list(rules.local_turn(game, "hp", "❤️ Punti ferita: 10/20."))
+        self.assertEqual(events, [
+            ("user", {"content": "hp"}), ("message", {}), ("token", {"text": "❤️ Punti ferita: 10/20."}),
+        ])
+        self.assertEqual([msg.get("local") for msg in game.messages], [True, True])
+
+    def test_state_changes_are_remembered_for_the_ai(self):
+        game = self.hero()
+        reply, remember = rules.resolve(game, "bevo la pozione")
+        self.assertTrue(remember)
+        list(rules.local_turn(game, "bevo la pozione", reply, remember))
+        self.assertFalse(any("local" in msg for msg in game.messages))
+
+    def test_consumable_heals_up_to_max_hp(self):
+        game = self.hero(hp=18)
+        self.assertEqual(game.use_item("pozione"), "Pozione rossa: +2 HP, ora 20/20")
+        self.assertEqual((game.hp, game.inventory), (20, ["spada"]))
+
+    def test_missing_item_is_not_used(self):
+        game = self.hero()
+        self.assertIsNone(game.use_item("elisir"))
+        self.assertIsNone(game.use_item(""))
+        self.assertEqual((game.hp, game.inventory), (10, ["Pozione rossa", "spada"]))
+
+    def test_item_that_is_not_consumable_is_left_to_the_ai(self):
+        game = self.hero()
+        self.assertIsNone(game.use_item("spada"))
+        self.assertEqual(game.inventory, ["Pozione rossa", "spada"])
@@ -0,0 +1,65 @@
+"""
+Conteggio locale dei token, senza chiamate al provider.
+
+Usa `tiktoken` se installato (cl100k_base: non è il tokenizer esatto di Gemini
+o Claude, ma lo scarto è piccolo e costante); altrimenti ripiega su una stima
+di circa 4 caratteri per token. Il conteggio di ogni messaggio della cronologia
+viene salvato nel messaggio stesso (chiave `tokens`), così ogni turno conta
+solo i messaggi nuovi.
+"""
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Token fissi per messaggio (ruolo e separatori del formato chat)
+MESSAGE_OVERHEAD = 4
+
+_encoding = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:  # modulo assente o tabella BPE non scaricabile
+            logger.info(f"tiktoken non disponibile, uso la stima a caratteri: {e}")
+    return _encoding
+
+
+def count_text(text):
+    """Token di un testo."""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def _count(msg):
+    total = MESSAGE_OVERHEAD + count_text(msg.get("content"))
+    if msg.get("tool_calls"):
+        total += count_text(json.dumps(msg["tool_calls"], ensure_ascii=False))
+    return total
+
+
+def message_tokens(msg):
+    """Token di un messaggio, letti dalla cache nel messaggio o calcolati e memorizzati."""
+    if "tokens" not in msg:
+        msg["tokens"] = _count(msg)
+    return msg["tokens"]
+
+
+def messages_tokens(messages):
+    return sum(message_tokens(msg) for msg in messages)
+
+
+def tools_tokens(tools):
+    """Token occupati dagli schemi degli strumenti inviati con la richiesta."""
+    return count_text(json.dumps(tools, ensure_ascii=False)) if tools else 0
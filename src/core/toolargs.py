@@ -0,0 +1,171 @@
+"""
+Riparazione locale degli argomenti delle chiamate agli strumenti.
+
+I modelli a volte producono argomenti JSON malformati: virgole finali, apici
+singoli, oggetti troncati dal limite di token, liste passate come stringa.
+Scartare la chiamata significa perdere l'effetto (l'oggetto, l'obiettivo...) e
+costringere il giocatore a spendere un altro turno per recuperarlo: qui si prova
+prima a ripararli e poi ad adattarli allo schema dello strumento.
+"""
+
+import ast
+import json
+import re
+
+# Virgola subito prima della chiusura di un oggetto o di una lista
+TRAILING_COMMA_PATTERN = re.compile(r",\s*([}\]])")
+# Blocco di codice markdown attorno al JSON
+FENCE_PATTERN = re.compile(r"^```(?:json)?\s*|\s*```$")
+CLOSERS = {"{": "}", "[": "]"}
+
+
+def _scan(text):
+    """
+    Restituisce le parentesi rimaste aperte, l'eventuale stringa aperta e il punto
+    in cui inizia l'ultimo elemento: dopo l'ultima virgola o parentesi aperta fuori dalle stringhe.
+    """
+    stack = []
+    quote = None
+    escaped = False
+    last_comma = None
+    last_open = None
+    for index, char in enumerate(text):
+        if quote:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in "\"'":
+            quote = char
+        elif char in CLOSERS:
+            stack.append(CLOSERS[char])
+            last_open = index
+        elif char in "}]" and stack:
+            stack.pop()
+        elif char == ",":
+            last_comma = index
+    return stack, quote, last_comma, last_open
+
+
+def _close(text):
+    """Chiude le parentesi lasciate aperte da una risposta troncata."""
+    stack, quote, last_comma, last_open = _scan(text)
+    if quote:
+        # Troncato dentro una stringa: il valore è incompleto e non va preso per buono
+        start = last_open + 1 if last_open is not None else 0
+        text = text[:max(start, last_comma or 0)]
+        stack = _scan(text)[0]
+    return text.rstrip().rstrip(",") + "".join(reversed(stack))
+
+
+def _candidates(text):
+    """Varianti sempre più aggressive del testo da provare a decodificare."""
+    yield text
+    text = TRAILING_COMMA_PATTERN.sub(r"\1", text)
+    yield text
+    yield _close(text)
+    # Troncato a metà di una coppia chiave/valore: si scarta l'ultima coppia incompleta
+    last_comma = _scan(text)[2]
+    if last_comma is not None:
+        yield _close(text[:last_comma])
+
+
+def _loads(text):
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    try:
+        # Apici singoli e sintassi "alla Python" (True/None)
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+
+
+def repair(raw):
+    """
+    Decodifica gli argomenti di una chiamata, riparandoli se necessario.
+    Restituisce `(argomenti, riparati)`; solleva `ValueError` se non c'è nulla da salvare.
+    """
+    try:
+        arguments = json.loads(raw)
+        if isinstance(arguments, dict):
+            return arguments, False
+    except (json.JSONDecodeError, TypeError):
+        pass
+
+    text = FENCE_PATTERN.sub("", (raw or "").strip())
+    if not text:
+        return {}, True
+    for candidate in _candidates(text):
+        arguments = _loads(candidate)
+        if isinstance(arguments, dict):
+            return arguments, True
+    raise ValueError(f"argomenti non riparabili: {raw!r}")
+
+
+def _coerce_value(value, schema):
+    kind = schema.get("type")
+    if value is None and kind in ("integer", "string"):
+        raise ValueError(f"atteso un valore di tipo {kind}, ricevuto null")
+    if kind == "integer":
+        if isinstance(value, bool):
+            raise ValueError(f"atteso un intero, ricevuto {value!r}")
+        if isinstance(value, (int, float)):
+            return int(round(value))
+        match = re.search(r"-?\d+", str(value))
+        if not match:
+            raise ValueError(f"atteso un intero, ricevuto {value!r}")
+        return int(match.group())
+    if kind == "string":
+        if isinstance(value, list):
+            value = ", ".join(str(item) for item in value)
+        value = str(value).strip()
+        for option in schema.get("enum", []):
+            if option.lower() == value.lower():
+                return option
+        return value
+    if kind == "array":
+        if isinstance(value, str):
+            decoded = _loads(value)
+            value = decoded if isinstance(decoded, list) else value.split(",")
+        elif not isinstance(value, list):
+            value = [value]
+        item_schema = schema.get("items", {})
+        return [_coerce_value(item, item_schema) for item in value if item is not None and str(item).strip()]
+    return value
+
+
+def coerce(arguments, parameters):
+    """
+    Adatta gli argomenti allo schema `parameters` dello strumento: converte i tipi,
+    normalizza i valori enumerati e scarta le chiavi sconosciute.
+    Restituisce `(argomenti, modificati)`; solleva `ValueError` se manca un campo obbligatorio.
+    """
+    properties = parameters.get("properties", {})
+    by_lower_name = {name.lower(): name for name in properties}
+    coerced = {}
+    for key, value in arguments.items():
+        name = by_lower_name.get(key.lower())
+        # `null` vale come campo assente: se è obbligatorio la chiamata viene scartata
+        if name is not None and value is not None:
+            coerced[name] = _coerce_value(value, properties[name])
+
+    missing = [name for name in parameters.get("required", []) if name not in coerced]
+    if missing:
+        raise ValueError(f"campi obbligatori mancanti: {', '.join(missing)}")
+    return coerced, coerced != arguments
+
+
+def parse_arguments(raw, parameters=None):
+    """
+    Decodifica, ripara e adatta allo schema gli argomenti di una chiamata a uno strumento.
+    Restituisce `(argomenti, riparati)`; solleva `ValueError` se la chiamata è da scartare.
+    """
+    arguments, repaired = repair(raw)
+    if parameters is not None:
+        arguments, changed = coerce(arguments, parameters)
+        repaired = repaired or changed
+    return arguments, repaired
@@ -0,0 +1,16 @@
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import JsonResponse
+
+from core import hedging, llm, metrics, resilience, routing, structured
+
+
+@staff_member_required
+def metrics_view(request):
+    """Espone le metriche del worker corrente (solo staff)."""
+    data = metrics.snapshot()
+    data["pool"] = llm.pool_stats()
+    data["breakers"] = resilience.breaker_states()
+    data["hedging"] = hedging.hedge_stats()
+    data["routing"] = routing.routing_stats()
+    data["structured_output"] = structured.success_rates()
+    return JsonResponse(data)
@@ -25,18 +25,27 @@ import re
 from datetime import datetime
 #from huggingface_hub import InferenceClient
 
-from openai import OpenAI
-from decouple import config
+from asgiref.sync import sync_to_async
 from django.contrib import messages as flash
 from django.http import JsonResponse
+from django.views.decorators.http import require_POST
 from django.shortcuts import redirect, render
 from django.urls import reverse
 
+from core import admission, hedging, history, idempotency, memory, openings, resilience, rules
+from core.context import build_prompt
+from core.gamestate import VersionedState, asnapshot_due, clear_saved, replace_saved
+from core.ratelimit import rate_limited
+from core.structured import ReplyReader
+from core.state import aload_request_state
+from core.streaming import drain, iter_text, notice_events, sse_response
+
 # --- CONFIGURAZIONE E COSTANTI ---
 
-API_KEY = config("API_KEY")
-API_URL = "https://openrouter.ai/api/v1/"
 MODEL = "google/gemini-2.0-flash-001"
+GAME_ID = "hackergame"  # Chiave del gioco nelle impostazioni condivise (es. LLM_OPENINGS)
+# Il gioco non tiene stato: in modalità strutturata il JSON contiene solo la narrazione
+STATE_FIELDS = ()
 
 # Costanti del gioco
 LOG_DIR = "hackergame/saves"
@@ -44,6 +53,9 @@ MAX_SAVE_FILES = 10  # Limite massimo di file di salvataggio per utente
 
 # Costanti per le chiavi di sessione (evita "stringhe magiche")
 SESSION_MESSAGES = "hacker_messages"
+SESSION_SUMMARY = "hacker_summary"
+SESSION_SUMMARY_UPTO = "hacker_summary_upto"
+SESSION_VERSION = "hacker_version"  # versione dello stato, per il salvataggio con compare-and-swap
 
 SYSTEM_PROMPT = (
     "Agisci come un Dungeon Master AI immerso nei mondi di Tsutomu Nihei (Blame!, Biomega, Abara, Noise): "
@@ -176,6 +188,9 @@ def save_game_to_file(request, game_data):
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     file_path = _get_save_path(username, timestamp)
 
+    # Il file contiene la cronologia completa, anche se la partita ne ha caricata solo una finestra
+    game_data = {**game_data, "messages": history.full_history(game_data["messages"])}
+
     try:
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
         with open(file_path, "w", encoding="utf-8") as f:
@@ -198,13 +213,25 @@ def load_game_from_file(filename):
 
 # --- LIVELLO DI LOGICA DI BUSINESS (Game Logic Layer) ---
 
-class GameManager:
+class GameManager(VersionedState):
     """
     Gestisce lo stato e la logica del gioco per una sessione utente.
     """
+    GAME_ID = GAME_ID
+    STATE_KEYS = {
+        "messages": SESSION_MESSAGES,
+        "summary": SESSION_SUMMARY,
+        "summary_upto": SESSION_SUMMARY_UPTO,
+    }
+    VERSION_KEY = SESSION_VERSION
+    MERGE_RULES = {"messages": "append"}
+
     def __init__(self, session):
         self.session = session
         self.messages = session.get(SESSION_MESSAGES, [])
+        self.summary = session.get(SESSION_SUMMARY, "")
+        self.summary_upto = session.get(SESSION_SUMMARY_UPTO, 0)
+        self.track_version()
 
     def is_initialized(self):
         """Controlla se la sessione di gioco è già stata inizializzata."""
@@ -213,15 +240,15 @@ class GameManager:
     def initialize_new_game(self):
         """Imposta i valori per una nuova partita."""
         self.messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-
-    def save_state_to_session(self):
-        """Salva lo stato corrente del gioco nella sessione Django."""
-        self.session[SESSION_MESSAGES] = self.messages
+        self.summary = ""
+        self.summary_upto = 0
 
     def get_state_for_savefile(self):
         """Restituisce un dizionario con i dati da salvare su file."""
         return {
             "messages": self.messages,
+            "summary": self.summary,
+            "summary_upto": self.summary_upto,
         }
 
     def process_dice_roll(self, user_input):
@@ -238,65 +265,114 @@ class GameManager:
 
 # --- LIVELLO DI SERVIZIO (Service Layer) ---
 
-def get_ai_response(messages):
-    """Invia i messaggi all'API di OpenRouter e restituisce la risposta."""
+async def stream_ai_response(messages, **kwargs):
+    """Invia i messaggi all'API di OpenRouter e restituisce la risposta un frammento alla volta."""
     try:
-        client = OpenAI(
-            base_url=API_URL,
-            api_key=API_KEY,
-        )
-        completion = client.chat.completions.create(
+        stream = await hedging.astream_chat_completion(
+            GAME_ID,
+            MODEL,
+            messages,
             extra_headers={
-                "HTTP-Referer": "http://localhost",  # Optional. Site URL for rankings on openrouter.ai.
                 "X-Title": "HackerGame RPG",  # Optional. Site title for rankings on openrouter.ai.
             },
-            model=MODEL,
-            messages=messages,
-            timeout=30
+            **kwargs,
         )
-        return completion.choices[0].message.content
+        try:
+            async for text in iter_text(stream):
+                yield text
+        finally:
+            # Anche se chi legge si ferma prima o solleva un'eccezione
+            await stream.close()
     except Exception as e:
         logger.error(f"Errore nella chiamata API: {e}")
-        return None
+
+async def play_turn(request, game, user_input):
+    """Esegue un turno di gioco e produce gli eventi `(nome, dati)` per il client."""
+    # Comandi deterministici (inventario, HP, aiuto...) e partita finita: risposta locale, niente AI
+    resolved = rules.resolve(game, user_input)
+    if resolved is not None:
+        for event in rules.local_turn(game, user_input, *resolved):
+            yield event
+        return
+
+    # Turno con l'AI: prima serve un posto tra quelli del worker (coda equa per giocatore)
+    async for event in admission.admitted(request, play_ai_turn(request, game, user_input)):
+        yield event
+
+
+async def play_ai_turn(request, game, user_input):
+    """Parte di `play_turn` che coinvolge l'AI, eseguita solo dopo l'ammissione."""
+    # Gestione tiro di dado
+    if "d20" in user_input.lower():
+        user_input = game.process_dice_roll(user_input)
+
+    game.messages.append({"role": "user", "content": user_input})
+    yield "user", {"content": user_input}
+
+    reader = ReplyReader(GAME_ID, STATE_FIELDS)
+    reader.record_turn(user_input)
+    # I turni vecchi arrivano all'AI come riassunto "STORIA FINORA", entro il budget di token
+    messages_for_ai = build_prompt(game, MODEL, tail=reader.prompt_tail())
+    # Scadenza del turno: un provider lento o in errore non tiene occupato il worker oltre questo limite
+    deadline = resilience.Deadline()
+    async for text in stream_ai_response(messages_for_ai, deadline=deadline, **reader.request_kwargs()):
+        shown = reader.feed(text)
+        if shown:
+            yield "token", {"text": shown}
+    reply, _ = reader.finish()
+    if reply and not reader.shown:
+        yield "token", {"text": reply}
+
+    if reply:
+        game.messages.append({"role": "assistant", "content": reply})
+    else:
+        flash.add_message(request, flash.ERROR, "Errore nella risposta dell'AI. Riprova più tardi.")
 
 # --- LIVELLO DI PRESENTAZIONE (View Layer) ---
 
-def chat_view(request):
+@rate_limited(GAME_ID, "chat")
+async def chat_view(request):
     """
     Vista principale della chat, ora più snella e funge da orchestratore.
+
+    È asincrona: durante l'attesa dell'AI il worker resta libero di servire altre richieste.
     """
-    game = GameManager(request.session)
+    await aload_request_state(request)
+    game = await GameManager.aload(request)
 
     if not game.is_initialized():
         game.initialize_new_game()
-        game.save_state_to_session()
+        # Se il pool ha una scena d'apertura pronta, la partita parte già narrata
+        opening = await openings.atake(GAME_ID)
+        if opening:
+            game.messages.append({"role": "assistant", "content": opening})
+        await game.asave(request)
         return redirect(reverse("hackergame:hackergame-chat")) # Ricarica per mostrare il primo messaggio
 
     if request.method == "POST":
+        turn = None
         # Gestione dell'input dell'utente
         if "user_input" in request.POST:
             user_input = request.POST.get("user_input", "").strip()
             if user_input:
-                # Gestione tiro di dado
-                if "d20" in user_input.lower():
-                    user_input = game.process_dice_roll(user_input)
-
-                game.messages.append({"role": "user", "content": user_input})
-                
-                # Chiamata all'AI
-                reply = get_ai_response(game.messages)
-                
-                if reply:
-                    game.messages.append({"role": "assistant", "content": reply})
-                    
-                else:
-                    flash.add_message(request, flash.ERROR, "Errore nella risposta dell'AI. Riprova più tardi.")
+                turn = idempotency.Turn(request, GAME_ID)
+                if not await turn.claim():
+                    # Doppio clic o F5 durante l'attesa: si mostra il turno già avviato
+                    await turn.follow(request)
+                    return redirect(reverse("hackergame:hackergame-chat"))
+                await drain(turn.record(play_turn(request, game, user_input)))
 
         # Salvataggio dello stato dopo ogni azione POST
-        game.save_state_to_session()
-        
-        # Salvataggio asincrono su file
-        save_game_to_file(request, game.get_state_for_savefile())
+        saved = await game.asave(request)
+        if turn is not None:
+            # I doppioni di questo invio attendono lo stato salvato (o rigiocano un turno scartato)
+            await turn.settle(saved)
+        # I turni vecchi si riassumono in background: né la risposta né la coda aspettano
+        await memory.asummarize_later(request, game, MODEL, extra_headers={"X-Title": "HackerGame RPG"})
+
+        # Il file con la cronologia completa si scrive a intervalli, non a ogni turno
+        if await asnapshot_due(request, GameManager):
+            await sync_to_async(save_game_to_file)(request, game.get_state_for_savefile())
 
         # Reindirizza per evitare il reinvio del form con F5
         return redirect(reverse("hackergame:hackergame-chat"))
@@ -306,16 +382,48 @@ def chat_view(request):
     context = {
         'messages_log': messages_for_template,
         'username': request.user.username if request.user.is_authenticated else 'Giocatore',
+        'turn_key': idempotency.new_key(),
     }
     return render(request, "hackergame/chat-hacker-game.html", context)
 
+@require_POST
+@rate_limited(GAME_ID, "chat")
+async def chat_stream(request):
+    """Variante in streaming della chat: i token del DM arrivano al browser come Server-Sent Events."""
+    await aload_request_state(request)
+    game = await GameManager.aload(request)
+    user_input = request.POST.get("user_input", "").strip()
+    if not game.is_initialized() or not user_input:
+        return JsonResponse({"error": "Turno non valido."}, status=400)
+
+    turn = idempotency.Turn(request, GAME_ID)
+    if not await turn.claim():
+        # Stesso invio ripetuto: riceve gli eventi del turno originale
+        return sse_response(turn.replay())
+
+    async def events():
+        async for event in play_turn(request, game, user_input):
+            yield event
+        # La risposta è già partita: la partita va salvata qui, prima degli ultimi eventi
+        if not await game.asave(request):
+            # Turno scartato per un conflitto: i doppioni non devono riceverlo come concluso
+            await turn.abandon()
+        # I turni vecchi si riassumono in background, dopo il salvataggio
+        await memory.asummarize_later(request, game, MODEL, extra_headers={"X-Title": "HackerGame RPG"})
+        # Il file con la cronologia completa si scrive a intervalli, non a ogni turno
+        if await asnapshot_due(request, GameManager):
+            await sync_to_async(save_game_to_file)(request, game.get_state_for_savefile())
+        for event in notice_events(request):
+            yield event
+        yield "done", {}
+
+    return sse_response(turn.record(events()))
+
+@rate_limited(GAME_ID, "reset", methods=None, redirect_to="hackergame:hackergame-chat")
 def reset_session(request):
     """Pulisce la sessione di gioco e reindirizza alla chat."""
-    keys_to_clear = [
-        SESSION_MESSAGES 
-    ]
-    for key in keys_to_clear:
-        request.session.pop(key, None)
+    # I turni ancora in corso sulla vecchia partita non devono sovrascrivere quella nuova
+    clear_saved(request, GameManager)
     
     flash.add_message(request, flash.INFO, "Nuova partita iniziata.")
     return redirect(reverse("hackergame:hackergame-chat"))
@@ -344,8 +452,13 @@ def load_game_session(request, filename):
     session_data = load_game_from_file(filename)
     
     if session_data:
-        # Popola la sessione con i dati caricati
-        request.session[SESSION_MESSAGES] = session_data.get("messages", [])
+        # Sostituisce la partita salvata con i dati caricati
+        saved = {
+            SESSION_MESSAGES: session_data.get("messages", []),
+            SESSION_SUMMARY: session_data.get("summary", ""),
+            SESSION_SUMMARY_UPTO: session_data.get("summary_upto", 0),
+        }
+        replace_saved(request, GameManager, saved)
         
         flash.add_message(request, flash.SUCCESS, f"Partita '{filename}' caricata con successo!")
     else:
@@ -0,0 +1,199 @@
+// Streaming dei turni di gioco tramite Server-Sent Events.
+// Il form della chat viene inviato con fetch all'endpoint indicato in `data-stream-url`:
+// il testo del DM compare man mano che arriva e la sidebar si aggiorna appena il DM annuncia un cambiamento di stato.
+// Se il browser non supporta lo streaming, il form viene inviato normalmente.
+// Ogni invio porta una `turn_key` diversa: il server riconosce i doppi invii dello stesso turno.
+(function () {
+  const form = document.getElementById("chat-form");
+  const chatBox = document.getElementById("chat-box");
+  if (!form || !chatBox || !form.dataset.streamUrl || !window.fetch || !window.ReadableStream) return;
+
+  const input = form.querySelector('input[name="user_input"]');
+  const button = form.querySelector('button[type="submit"]');
+  const turnKey = form.querySelector('input[name="turn_key"]');
+  const username = form.dataset.username || "Giocatore";
+
+  const NOTICE_STYLES = {
+    success: "bg-green-100 border border-green-400 text-green-800",
+    error: "bg-red-100 border border-red-400 text-red-800",
+    warning: "bg-yellow-100 border border-yellow-400 text-yellow-800",
+    info: "bg-blue-100 border border-blue-400 text-blue-800",
+  };
+
+  let dmText = null;
+
+  function newTurnKey() {
+    if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return Date.now().toString(36) + "-" + Math.random().toString(36).slice(2);
+  }
+
+  function scrollToBottom() {
+    chatBox.scrollTo({ top: chatBox.scrollHeight, behavior: "smooth" });
+  }
+
+  // Crea una nuova riga della chat con lo stesso markup del template
+  function appendMessage(role, text) {
+    const row = document.createElement("div");
+    row.className = "pt-4" + (chatBox.children.length ? " border-t border-gray-700" : "");
+    const paragraph = document.createElement("p");
+    paragraph.className = "text-sm text-gray-400";
+    const author = document.createElement("strong");
+    author.className = role === "assistant" ? "text-red-500" : "text-green-400";
+    author.textContent = role === "assistant" ? "DM:" : username + ":";
+    const body = document.createElement("span");
+    body.textContent = text;
+    paragraph.append(author, " ", body);
+    row.appendChild(paragraph);
+    chatBox.appendChild(row);
+    scrollToBottom();
+    return body;
+  }
+
+  function showNotice(notice) {
+    let container = document.getElementById("stream-notices");
+    if (!container) {
+      container = document.createElement("div");
+      container.id = "stream-notices";
+      container.className = "fixed top-5 right-5 z-50 w-full max-w-sm space-y-3";
+      document.body.appendChild(container);
+    }
+    const alert = document.createElement("div");
+    alert.className = "p-4 rounded-lg shadow-lg transition-opacity duration-300 ease-in-out " +
+      (NOTICE_STYLES[notice.level] || NOTICE_STYLES.info);
+    alert.setAttribute("role", "alert");
+    alert.textContent = notice.text;
+    container.appendChild(alert);
+    setTimeout(() => {
+      alert.style.opacity = "0";
+      setTimeout(() => alert.remove(), 300);
+    }, 10000);
+  }
+
+  function setText(id, value) {
+    const element = document.getElementById(id);
+    if (element && value !== undefined) element.textContent = value;
+  }
+
+  function updateState(state) {
+    setText("state-hp", state.hp);
+    setText("state-level", state.level);
+    setText("state-objective", state.objective);
+
+    const stats = document.getElementById("state-stats");
+    if (stats && state.stats) {
+      stats.replaceChildren(...Object.entries(state.stats).map(([name, value]) => {
+        const line = document.createElement("p");
+        line.className = "text-gray-400";
+        line.textContent = name.charAt(0).toUpperCase() + name.slice(1) + ": " + value;
+        return line;
+      }));
+    }
+
+    const inventory = document.getElementById("state-inventory");
+    if (inventory && state.inventario) {
+      if (state.inventario.length) {
+        const list = document.createElement("ul");
+        list.className = "list-disc list-inside text-gray-300 text-sm";
+        state.inventario.forEach((item) => {
+          const entry = document.createElement("li");
+          entry.textContent = item.charAt(0).toUpperCase() + item.slice(1);
+          list.appendChild(entry);
+        });
+        inventory.replaceChildren(list);
+      } else {
+        const empty = document.createElement("p");
+        empty.className = "text-sm italic text-gray-400";
+        empty.textContent = "Nessun oggetto";
+        inventory.replaceChildren(empty);
+      }
+    }
+  }
+
+  function handleEvent(name, data, userText) {
+    switch (name) {
+      case "user":
+        userText.textContent = data.content;
+        break;
+      case "message":
+        dmText = null;
+        break;
+      case "token":
+        if (!dmText) dmText = appendMessage("assistant", "");
+        dmText.textContent += data.text;
+        scrollToBottom();
+        break;
+      case "state":
+        updateState(data);
+        break;
+      case "notice":
+        showNotice(data);
+        break;
+    }
+  }
+
+  // Un blocco SSE è fatto di righe "event: ..." e "data: ..."
+  function parseBlock(block) {
+    let name = "message";
+    const data = [];
+    block.split("\n").forEach((line) => {
+      if (line.startsWith("event:")) name = line.slice(6).trim();
+      else if (line.startsWith("data:")) data.push(line.slice(5).trim());
+    });
+    return [name, data.length ? JSON.parse(data.join("\n")) : {}];
+  }
+
+  form.addEventListener("submit", async function (event) {
+    const text = input.value.trim();
+    if (!text) return;
+    event.preventDefault();
+
+    const formData = new FormData(form);
+    // La chiave appena usata resta nel FormData; il prossimo turno ne avrà una nuova
+    if (turnKey) turnKey.value = newTurnKey();
+    input.value = "";
+    input.disabled = true;
+    button.disabled = true;
+    dmText = null;
+    const userText = appendMessage("user", text);
+
+    try {
+      const response = await fetch(form.dataset.streamUrl, {
+        method: "POST",
+        body: formData,
+        credentials: "same-origin",
+        headers: { "Accept": "text/event-stream" },
+      });
+      if (response.status === 429) {
+        // Troppe richieste: il messaggio non è stato inviato, lo si rimette nel campo
+        const data = await response.json();
+        userText.closest("div").remove();
+        input.value = text;
+        showNotice({ level: "warning", text: data.error });
+        return;
+      }
+      if (!response.ok || !response.body) throw new Error("HTTP " + response.status);
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let separator;
+        while ((separator = buffer.indexOf("\n\n")) !== -1) {
+          const [name, data] = parseBlock(buffer.slice(0, separator));
+          buffer = buffer.slice(separator + 2);
+          handleEvent(name, data, userText);
+        }
+      }
+    } catch (error) {
+      console.error("Streaming del turno fallito:", error);
+      showNotice({ level: "error", text: "Errore di comunicazione con il DM. Riprova." });
+    } finally {
+      input.disabled = false;
+      button.disabled = false;
+      input.focus();
+    }
+  });
+})();